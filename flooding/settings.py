@@ -155,6 +155,10 @@ CACHE_BACKEND = 'file://%s' % os.path.join(BUILDOUT_DIR, 'var', 'cache')
 # production environments
 # ^^^ TODO
 
+# Bytes of rendered animation frames to keep in memory, per process, see
+# flooding_lib.tools.pyramids.models
+ANIMATION_FRAME_CACHE_SIZE = 256 * 1024 * 1024
+
 INSTALLED_APPS = (
     'django.contrib.auth',
     'flooding',
@@ -274,6 +278,11 @@ GIS_DIR = os.path.join(BUILDOUT_DIR, 'var', 'gisdata')
 
 RASTER_SERVER_URL = "http://flooding.lizard.net/wms"
 
+# Zoom levels (first, last) of google mercator tiles to pre-render with
+# the raster server's bin/seedtiles after a pyramid has been generated.
+# The environment of the task worker needs RASTER_SERVER_SETTINGS.
+TILE_SEED_ZOOMLEVELS = None
+
 #location of directories for task execution. Pelase configure to local
 #installation root of HIS schade en slachtoffers module
 HISSSM_ROOT = ''
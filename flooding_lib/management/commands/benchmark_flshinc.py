@@ -0,0 +1,100 @@
+"""Time reading a synthetic fls_h.inc file of a given size with
+flshinc.Flsh, to check parser throughput on national scale scenarios
+without needing one."""
+
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from flooding_lib.util import flshinc
+
+NCOLS = 4000
+NROWS = 3000
+CELLS_PER_TIMESTEP = 500000
+NCLASSES = 50
+BLOCKS = 4  # Number of different timestep blocks that are repeated
+
+HEADER = """MAIN DIMENSIONS MMAX NMAX
+  {ncols}  {nrows}
+GRID DX X0 Y0
+  25.0  10000.0  300000.0
+CLASSES OF INCREMENTAL FILE
+{classes}
+ENDCLASSES
+"""
+
+
+def get_block():
+    """Return the 'row col class' lines of one timestep."""
+    cells = np.column_stack([
+        np.random.randint(1, NCOLS + 1, CELLS_PER_TIMESTEP),
+        np.random.randint(1, NROWS + 1, CELLS_PER_TIMESTEP),
+        np.random.randint(0, NCLASSES + 1, CELLS_PER_TIMESTEP)])
+    return '\n'.join(
+        '{} {} {}'.format(*cell) for cell in cells.tolist()
+    ).encode('utf8') + b'\n'
+
+
+def write_inc(path, megabytes):
+    """Write a synthetic .inc file of at least the given size and
+    return the number of timesteps in it."""
+    classes = '\n'.join(
+        '  {:.2f}  {:.2f}'.format(i * 0.1, i * 0.2)
+        for i in range(1, NCLASSES + 1))
+    blocks = [get_block() for i in range(BLOCKS)]
+
+    timesteps = 0
+    with open(path, 'wb') as f:
+        f.write(HEADER.format(
+            ncols=NCOLS, nrows=NROWS, classes=classes).encode('utf8'))
+        while f.tell() < megabytes * 1024 * 1024:
+            f.write('  {:.2f}  0  {}\n'.format(
+                timesteps * 0.25, 1 + timesteps % 2).encode('utf8'))
+            f.write(blocks[timesteps % BLOCKS])
+            timesteps += 1
+        f.write(b'\n')
+    return timesteps
+
+
+class Command(BaseCommand):
+    args = '[<megabytes>]'
+    help = """Write a synthetic .inc file of <megabytes> MB (default
+    2048) to a temporary directory and time iterating over it."""
+
+    def handle(self, *args, **options):
+        try:
+            megabytes = int(args[0]) if args else 2048
+        except ValueError:
+            raise CommandError("Size should be a number of megabytes.")
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'fls_h.inc')
+            start = time.time()
+            timesteps = write_inc(path, megabytes)
+            print("Wrote {} timesteps in {:.1f}s.".format(
+                timesteps, time.time() - start))
+
+            start = time.time()
+            count = 0
+            for timestamp, grid in flshinc.Flsh(path, mutate=True):
+                count += 1
+            seconds = time.time() - start
+
+            size = os.path.getsize(path) / (1024 * 1024)
+            print("Read {} timesteps, {:.0f} MB in {:.1f}s: "
+                  "{:.1f} MB/s, {:.2g} cells/s.".format(
+                      count, size, seconds, size / seconds,
+                      timesteps * CELLS_PER_TIMESTEP / seconds))
+        finally:
+            shutil.rmtree(tmp_dir)
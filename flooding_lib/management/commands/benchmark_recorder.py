@@ -0,0 +1,63 @@
+"""Time GridtaGridtdRecorder on synthetic grids, in nanoseconds per
+cell per timestep, for the dense and delta ways of registering."""
+
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+import time
+
+import numpy as np
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from flooding_lib.tasks.pyramid_generation import GridtaGridtdRecorder
+
+CHANGED = 0.01  # Fraction of cells that changes per timestep
+
+
+def get_grids(rows, cols, timesteps):
+    """Yield (grid, indices) for a slowly rising flood."""
+    grid = np.zeros((rows, cols))
+    for timestep in range(timesteps):
+        indices = np.unique(
+            np.random.randint(0, grid.size, int(grid.size * CHANGED)))
+        grid.flat[indices] += np.random.random(indices.size)
+        yield grid, indices
+
+
+class Command(BaseCommand):
+    args = '[<rows> <cols> <timesteps> [<tile_rows>]]'
+    help = """Register <timesteps> synthetic grids of <rows> by <cols>
+    (default 2000 by 2000, 50 timesteps) and print the ns per cell per
+    timestep."""
+
+    def handle(self, *args, **options):
+        if len(args) not in (0, 3, 4):
+            raise CommandError("Usage: benchmark_recorder {}".format(
+                self.args))
+        try:
+            rows, cols, timesteps = [int(a) for a in args[:3]] or [
+                2000, 2000, 50]
+            tile_rows = int(args[3]) if len(args) > 3 else None
+        except ValueError:
+            raise CommandError("Arguments should be integers.")
+
+        cells = rows * cols * timesteps
+        for name in ('register', 'register_delta'):
+            recorder = GridtaGridtdRecorder(
+                None, None, 0, tile_rows=tile_rows)
+            seconds = 0
+            for timestep, (grid, indices) in enumerate(
+                    get_grids(rows, cols, timesteps)):
+                start = time.time()
+                if name == 'register':
+                    recorder.register(timestep, grid)
+                else:
+                    recorder.register_delta(
+                        timestep, grid.shape, indices, grid.take(indices))
+                seconds += time.time() - start
+
+            print("{:>15}: {:.2f} ns/cell/timestep".format(
+                name, seconds * 1e9 / cells))
@@ -0,0 +1,33 @@
+"""Store the extents of results that don't have one yet, so that
+export runs don't need to open their files to find their boundary."""
+
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+from django.core.management.base import BaseCommand
+
+from flooding_lib import models
+from flooding_lib.tasks import calculate_export_maps
+
+# Result types that export runs use
+RESULT_TYPES = (
+    'gridmaxwaterdepth', 'gridmaxflowvelocity', 'computed_arrival_time',
+    'computed_difference', 'computed_time_of_max')
+
+
+class Command(BaseCommand):
+    args = '[<result type name> ...]'
+    help = """Read and store the extents of results of the given result
+    types (default: those used by export runs) that have none yet."""
+
+    def handle(self, *args, **options):
+        results = models.Result.objects.filter(
+            resulttype__name__in=args or RESULT_TYPES,
+            extent__isnull=True)
+
+        count = 0
+        for result in results.iterator():
+            if calculate_export_maps.update_result_extent(result):
+                count += 1
+        print("Stored {} extents.".format(count))
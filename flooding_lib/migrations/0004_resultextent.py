@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flooding_lib', '0003_auto_20200928_1652'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResultExtent',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('x_min', models.FloatField()),
+                ('x_max', models.FloatField()),
+                ('y_min', models.FloatField()),
+                ('y_max', models.FloatField()),
+                ('cellsize', models.FloatField()),
+                ('cols', models.IntegerField()),
+                ('rows', models.IntegerField()),
+                ('data_type', models.CharField(max_length=20)),
+                ('mtime', models.FloatField()),
+                ('result', models.OneToOneField(related_name='extent', to='flooding_lib.Result')),
+            ],
+            options={
+                'db_table': 'flooding_resultextent',
+            },
+        ),
+    ]
@@ -1979,6 +1979,34 @@ class Result(models.Model):
             .format(t=self.resulttype, i=self.scenario_id, n=self.scenario))
 
 
+class ResultExtent(models.Model):
+    """Extent of the grids in the file of a result, so that the extent
+    of many results can be found with one query instead of opening all
+    their files. See calculate_export_maps.update_result_extent.
+
+    Mtime is that of the file when its extent was read; extents of
+    files that changed since then aren't used."""
+    result = models.OneToOneField(Result, related_name='extent')
+
+    x_min = models.FloatField()
+    x_max = models.FloatField()
+    y_min = models.FloatField()
+    y_max = models.FloatField()
+    cellsize = models.FloatField()
+    cols = models.IntegerField()
+    rows = models.IntegerField()
+    data_type = models.CharField(max_length=20)  # GDAL data type name
+    mtime = models.FloatField()
+
+    class Meta:
+        db_table = 'flooding_resultextent'
+
+    def __unicode__(self):
+        return '{r}: ({x1}, {y1}, {x2}, {y2})'.format(
+            r=self.result, x1=self.x_min, y1=self.y_min,
+            x2=self.x_max, y2=self.y_max)
+
+
 class CutoffLocationSobekModelSetting(models.Model):
     """cutofflocationsobekmodelsettings properties:
 
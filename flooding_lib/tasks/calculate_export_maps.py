@@ -13,17 +13,30 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
+from collections import OrderedDict
+from collections import deque
 from collections import namedtuple
+from contextlib import closing
+from itertools import chain
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 
 import json
 import tempfile
+import threading
+import time
 import os
+import uuid
+import zlib
 from StringIO import StringIO
 
+from django.conf import settings
+
 from flooding_lib.models import ResultType
 from flooding_lib.tools.importtool.models import InputField
 from flooding_lib.tools.exporttool.models import ExportRun
 from flooding_lib.models import Result as FloodingResult
+from flooding_lib.models import ResultExtent
 from flooding_lib.tools.exporttool.models import Result
 from flooding_lib.util import files
 
@@ -32,6 +45,7 @@ import zipfile
 import shutil
 
 from osgeo import gdal
+from osgeo import gdal_array
 
 import logging
 log = logging.getLogger(__name__)
@@ -44,6 +58,34 @@ NO_DATA_VALUE = -9999
 
 TIFDRIVER = gdal.GetDriverByName(b'gtiff')
 AAIGRIDDRIVER = gdal.GetDriverByName(b'aaigrid')
+MEMDRIVER = gdal.GetDriverByName(b'mem')
+
+# Combined grids of an export run are kept in memory up to this many
+# bytes in total, over all products, after that they are memory mapped
+# temporary files. Override with the EXPORT_COMBINE_MEMORY setting.
+COMBINE_MEMORY_BUDGET = 4 * 1024 ** 3
+COMBINE_BLOCK_SIZE = 1024 ** 2  # Cells combined at once
+
+# Input files are reprojected on this many threads, at most this many
+# reprojected grids are kept waiting to be combined. Override with the
+# EXPORT_THREADS and EXPORT_MAX_GRIDS settings.
+COMBINE_THREADS = 4
+COMBINE_MAX_GRIDS = 8
+
+# Reprojected input grids are shared between the products of an
+# export run, in memory up to this many bytes and on disk up to this
+# many bytes. Override with the EXPORT_CACHE_MEMORY and
+# EXPORT_CACHE_DISK settings.
+CACHE_MEMORY_BUDGET = 2 * 1024 ** 3
+CACHE_DISK_BUDGET = 20 * 1024 ** 3
+
+# Ascii grids are written to the export zip in blocks of this many
+# cells, which are formatted and compressed on the EXPORT_THREADS.
+ZIP_BLOCK_SIZE = 1024 ** 2
+ZIP_COMPRESS_LEVEL = 6
+ASCII_HEADER_KEYS = (
+    'ncols', 'nrows', 'xllcorner', 'yllcorner', 'xllcenter', 'yllcenter',
+    'cellsize', 'dx', 'dy', 'nodata_value')
 
 SizeInfo = namedtuple(
     'Size', 'x_min x_max y_min y_max size_x size_y gridsize')
@@ -92,25 +134,6 @@ def maxwaterdepth_geotransform(scenario):
         return None
 
 
-def mktemp():
-    log.debug("mktemp()")
-    """Make a temp file
-
-    You are responsible for deleting it.
-    """
-    f = tempfile.NamedTemporaryFile(delete=False, prefix='task_200_')
-    pathname = f.name
-    f.close()
-    return pathname
-
-
-def remove_mkstemp(fd, path):
-    """Close a temporary file that was opened with mkstemp()."""
-    if os.path.isfile(path):
-        os.close(fd)
-        os.remove(path)
-
-
 def is_valid_zipfile(linux_filename):
     """Check if the passed file is a valid zipfile."""
     # log.debug disabled due error
@@ -173,23 +196,15 @@ def generate_export_meta(export_run, dst_filename):
     return export_meta
 
 
-def create_json_meta_file(tmp_zip_filename, export_run, dst_filename):
+def create_json_meta_file(export_zip, export_run, dst_filename):
     """Create meta file."""
     log.debug("create_json_meta_file({t}, {e}, {d})"
-              .format(t=tmp_zip_filename, e=export_run, d=dst_filename))
+              .format(t=export_zip, e=export_run, d=dst_filename))
     export_meta = generate_export_meta(export_run, dst_filename)
     io = StringIO()
     json.dump(export_meta, io, indent=4)
-    meta_filename = mktemp()
-    meta_file = open(meta_filename, 'wb')
-    meta_file.write(io.getvalue())
-    meta_file.close()
-    add_to_zip(tmp_zip_filename,
-               [{'filename': meta_filename,
-                 'arcname': "meta.json",
-                 'delete_after': True}])
-    if not io.closed:
-        io.close()
+    export_zip.writestr("meta.json", io.getvalue())
+    io.close()
 
 
 def np_max(list_of_arrays):
@@ -201,97 +216,278 @@ def np_max(list_of_arrays):
     return reduce(np.maximum, list_of_arrays)
 
 
-def write_masked_array(
-    filename, masked_array, geo_transform, driver=AAIGRIDDRIVER):
-    """
-    Use gdal to write a masked_array to a ascii file (or other type of file if
-    a driver is passed). Normal (non-masked) arrays work as well.
-    """
-    log.debug("write_masked_array({f}, {m}, {g}, {d})"
-              .format(f=filename, m=masked_array, g=geo_transform, d=driver))
-    filename = fix_path(filename)  # GDAL wants bytestring filenames
-
-    if hasattr(masked_array, 'fill_value'):
-        masked_array.fill_value = NO_DATA_VALUE
-        filled = masked_array.filled()
-    else:
-        filled = masked_array  # Not masked at all
-    size_y, size_x = filled.shape
-    num_bands = 1
+class ExportZip(object):
+    """The zip file of an export run, open during the whole run.
+
+    Grids are written as ascii grid members straight from their
+    arrays, without temporary files. Blocks of rows are formatted by
+    GDAL in memory and deflated on a pool of threads. Every block but
+    the last is flushed to a byte boundary, so that the compressed
+    blocks can be concatenated into the deflate stream of the member."""
+
+    def __init__(self, filename, threads=None, max_blocks=None):
+        self.zipfile = zipfile.ZipFile(
+            filename, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.threads = threads or getattr(
+            settings, 'EXPORT_THREADS', COMBINE_THREADS)
+        self.max_blocks = max_blocks or getattr(
+            settings, 'EXPORT_MAX_GRIDS', COMBINE_MAX_GRIDS)
+
+    def writestr(self, arcname, data):
+        self.zipfile.writestr(arcname, data)
+
+    def write_grid(self, arcname, array, geo_transform, nodata):
+        """Write array as an ascii grid member."""
+        rows, cols = array.shape
+        if cols == 0:
+            raise ValueError(
+                "Can't write {} without columns.".format(arcname))
+        block_rows = max(1, ZIP_BLOCK_SIZE // cols)
+        blocks = (
+            (array[start:start + block_rows], start + block_rows >= rows)
+            for start in range(0, rows, block_rows))
+
+        header = get_ascii_header(array.shape, geo_transform, nodata)
+        chunks = map_bounded(
+            format_block, blocks, self.threads, self.max_blocks)
+        with closing(chunks):
+            self.write_chunks(
+                arcname, chain([(header, deflate(header, rows == 0))], chunks))
+
+    def write_chunks(self, arcname, chunks):
+        """Write a deflated member from (data, deflated data) chunks,
+        of which the last one is finished and the others are flushed.
+
+        This mirrors ZipFile.write of Python 2.7's zipfile, including
+        its use of the private _writecheck, _didModify, fp, filelist
+        and NameToInfo. The local header always has room for zip64
+        sizes, as the size isn't known up front; ZipFile.close writes
+        zip64 entries in the central directory where needed."""
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+        zinfo.external_attr = 0o644 << 16
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.file_size = zinfo.compress_size = zinfo.CRC = 0
+
+        fp = self.zipfile.fp
+        zinfo.header_offset = fp.tell()
+        self.zipfile._writecheck(zinfo)
+        self.zipfile._didModify = True
+        fp.write(zinfo.FileHeader(zip64=True))
+
+        crc = 0
+        for data, deflated in chunks:
+            crc = zlib.crc32(data, crc)
+            zinfo.file_size += len(data)
+            zinfo.compress_size += len(deflated)
+            fp.write(deflated)
+        zinfo.CRC = crc & 0xffffffff
+
+        # Rewrite the local header with the sizes and crc
+        position = fp.tell()
+        fp.seek(zinfo.header_offset, 0)
+        fp.write(zinfo.FileHeader(zip64=True))
+        fp.seek(position, 0)
+        self.zipfile.filelist.append(zinfo)
+        self.zipfile.NameToInfo[zinfo.filename] = zinfo
+
+    def close(self):
+        self.zipfile.close()
+
+
+def get_ascii_header(shape, geo_transform, nodata):
+    rows, cols = shape
+    x_min, cellsize, _, y_max, _, dy = geo_transform
+    return (
+        'ncols        {}\n'
+        'nrows        {}\n'
+        'xllcorner    {!r}\n'
+        'yllcorner    {!r}\n'
+        'cellsize     {!r}\n'
+        'NODATA_value  {}\n'.format(
+            cols, rows, float(x_min), float(y_max + rows * dy),
+            float(cellsize), nodata)).encode('ascii')
+
+
+def deflate(data, final=False):
+    """Return data as a raw deflate stream, finished if final, flushed
+    to a byte boundary otherwise."""
+    compressor = zlib.compressobj(
+        ZIP_COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+def format_block(block_and_final):
+    """Return (text, deflated text) of the ascii grid rows of a block
+    of an array."""
+    block, final = block_and_final
+    dataset = gdal_array.OpenArray(np.ascontiguousarray(block))
+    path = b'/vsimem/task_200_{}.asc'.format(uuid.uuid4().hex)
+    try:
+        AAIGRIDDRIVER.CreateCopy(path, dataset)
+        del dataset
+        f = gdal.VSIFOpenL(path, b'rb')
+        gdal.VSIFSeekL(f, 0, 2)
+        size = gdal.VSIFTellL(f)
+        gdal.VSIFSeekL(f, 0, 0)
+        text = gdal.VSIFReadL(1, size, f)
+        gdal.VSIFCloseL(f)
+    finally:
+        gdal.Unlink(path)
+
+    # Skip the header of the block
+    start = 0
+    while True:
+        end = text.index(b'\n', start) + 1
+        words = text[start:end].split()
+        if not words or words[0].lower() not in ASCII_HEADER_KEYS:
+            break
+        start = end
+    text = text[start:]
+    return text, deflate(text, final)
+
+
+EXTENT_FIELDS = (
+    'x_min', 'x_max', 'y_min', 'y_max', 'cellsize', 'cols', 'rows',
+    'data_type')
+
+
+def get_dataset_extent(dataset):
+    """Return dict with the extent, cellsize, shape and data type of
+    a dataset, as stored in ResultExtent."""
+    geo_transform = dataset.GetGeoTransform()
+    # something like (183050.0, 25.0, 0.0, 521505.0, 0.0, -25.0)
+    x_min, y_max = geo_transform[0], geo_transform[3]
+    return {
+        'x_min': x_min,
+        'x_max': x_min + dataset.RasterXSize * geo_transform[1],
+        'y_min': y_max + dataset.RasterYSize * geo_transform[5],
+        'y_max': y_max,
+        'cellsize': abs(geo_transform[1]),
+        'cols': dataset.RasterXSize,
+        'rows': dataset.RasterYSize,
+        'data_type': gdal.GetDataTypeName(
+            dataset.GetRasterBand(1).DataType),
+        }
+
+
+def union_extent(extents):
+    """Return the extent covering all extents, None if there are
+    none. Cellsize and data type are those of the first, the shape is
+    that of the union at that cellsize."""
+    extents = list(extents)
+    if not extents:
+        return None
 
-    ds = TIFDRIVER.Create(filename, size_x, size_y, num_bands,
-                          gdal.GDT_Byte)
-    band = ds.GetRasterBand(1)
-    band.WriteArray(filled)
-    band.SetNoDataValue(NO_DATA_VALUE)
-    ds.SetGeoTransform(geo_transform)
+    union = dict(extents[0])
+    union.update(
+        x_min=min(e['x_min'] for e in extents),
+        x_max=max(e['x_max'] for e in extents),
+        y_min=min(e['y_min'] for e in extents),
+        y_max=max(e['y_max'] for e in extents))
+    union['cols'] = int(round(
+            (union['x_max'] - union['x_min']) / union['cellsize']))
+    union['rows'] = int(round(
+            (union['y_max'] - union['y_min']) / union['cellsize']))
+    return union
+
+
+def read_extent(filenames):
+    """Return the union extent of the datasets in filenames, None if
+    none of them can be opened."""
+    extents = []
+    for filename in filenames:
+        dataset = gdal_open(filename)
+        if dataset is None:
+            log.debug("Not found: {}".format(filename))
+            continue  # Skip, corrupt file
+        extents.append(get_dataset_extent(dataset))
+        del dataset
+    return union_extent(extents)
 
-    # Now it gets written to the disk as ascii
-    driver.CreateCopy(filename, ds)
 
+def update_result_extent(result, path=None, filenames=None):
+    """Read the extent of the datasets in the file of a result and store
+    it as its ResultExtent. Path is the absolute path of the file, give
+    filenames if it was already unzipped. Return the extent."""
+    if path is None:
+        path = result.absolute_resultloc
+    path = fix_path(path)
+    if not os.path.isfile(path):
+        return None
 
-def add_to_zip(output_zipfile, zip_result):
-    """
-    Zip all files listed in zip_result
+    mtime = os.path.getmtime(path)
+    if filenames is None:
+        extent = read_extent(all_files_in(path))
+    else:
+        extent = read_extent(filenames)
 
-    zip_result is a list of dictionaries with keys:
-    - filename: filename on disc
-    - arcname: target filename in archive
-    - delete_after: set this to remove file from file system after zipping
-    """
-    log.debug("add_to_zip({o}, {z})".format(o=output_zipfile, z=zip_result))
-    with zipfile.ZipFile(
-        output_zipfile, 'a', zipfile.ZIP_DEFLATED, allowZip64=True) as myzip:
-        for file_in_zip in zip_result:
-            myzip.write(file_in_zip['filename'], file_in_zip['arcname'])
-            if file_in_zip.get('delete_after', False):
-                os.remove(file_in_zip['filename'])
+    if extent is None:
+        ResultExtent.objects.filter(result=result).delete()
+    else:
+        ResultExtent.objects.update_or_create(
+            result=result, defaults=dict(extent, mtime=mtime))
+    return extent
+
+
+def get_extents(input_files):
+    """Return a list of extents of the input files. Extents of results
+    are looked up in one query, the others are read, and stored if the
+    input file is a result."""
+    result_ids = set(
+        input_file['result'].id for input_file in input_files
+        if input_file.get('result') is not None)
+    stored = dict(
+        (extent.result_id, extent) for extent in
+        ResultExtent.objects.filter(result__in=result_ids))
+
+    extents = []
+    for input_file in input_files:
+        filename = fix_path(input_file['filename'])
+        result = input_file.get('result')
+        extent = stored.get(result.id) if result is not None else None
+        if extent is not None and os.path.isfile(filename) and (
+            os.path.getmtime(filename) == extent.mtime):
+            extents.append(dict(
+                    (field, getattr(extent, field))
+                    for field in EXTENT_FIELDS))
+        elif result is not None:
+            extent = update_result_extent(result, filename)
+            if extent is not None:
+                extents.append(extent)
+        else:
+            extent = read_extent(all_files_in(filename))
+            if extent is not None:
+                extents.append(extent)
+    return extents
 
 
 def find_boundary(input_files, gridsize):
     """Return a SizeInfo object that contains the size information of
     the bounding box of the input_files. Yields an exception if there
-    are 0 input files."""
-    log.debug(b"find_boundary({i}, {g})".format(i=input_files, g=gridsize))
-    x_min = None
-    x_max = None
-    y_max = None
-    y_min = None
+    are 0 input files.
 
+    Extents of input files that are results are taken from their
+    ResultExtent, files are only opened for results that don't have
+    one yet."""
+    log.debug(b"find_boundary({i}, {g})".format(i=input_files, g=gridsize))
     log.debug("Length of input_files: {}".format(len(input_files)))
 
     if len(input_files) == 0:
         raise ValueError("find_boundary() called without input_files.")
 
-    for input_file in input_files:
-        log.debug(input_file)
-        for filename in all_files_in(input_file['filename']):
-            dataset = gdal_open(filename)
-            if dataset is None:
-                log.debug("Not found: {}".format(filename))
-                continue  # Skip, corrupt file
-            dataset.RasterXSize, dataset.RasterYSize
-            geo_transform = dataset.GetGeoTransform()
-            # something like (183050.0, 25.0, 0.0, 521505.0, 0.0, -25.0)
-            this_x_min, this_y_max = geo_transform[0], geo_transform[3]
-            this_x_max = (
-                this_x_min + dataset.RasterXSize * geo_transform[1])
-            this_y_min = (
-                this_y_max + dataset.RasterYSize * geo_transform[5])
-
-            if x_min is None or this_x_min < x_min:
-                x_min = this_x_min
-            if x_max is None or this_x_max > x_max:
-                x_max = this_x_max
-            if y_min is None or this_y_min < y_min:
-                y_min = this_y_min
-            if y_max is None or this_y_max > y_max:
-                y_max = this_y_max
-
-            del dataset
+    extent = union_extent(get_extents(input_files))
+    if extent is None:
+        raise ValueError("find_boundary() found no datasets.")
+    x_min, x_max = extent['x_min'], extent['x_max']
+    y_min, y_max = extent['y_min'], extent['y_max']
 
     size_x = int(abs((x_max - x_min) / gridsize))
     size_y = int(abs((y_max - y_min) / gridsize))
+    if size_x < 1 or size_y < 1:
+        raise ValueError(
+            "find_boundary() found an extent of {} by {}, smaller than "
+            "the gridsize {}.".format(x_max - x_min, y_max - y_min, gridsize))
 
     return SizeInfo(
         x_min=x_min, x_max=x_max, y_min=y_min, y_max=y_max,
@@ -306,283 +502,415 @@ def dataset2array(dataset):
     return np.ma.array(data, mask=mask)
 
 
-def get_dataset_line_masked_array(dataset, band, line):
-    # this debug line is too slow
-    #log.debug("get_dataset_line_masked_array({d}, {b}, {l})"
-    #          .format(d=dataset, b=band, l=line))
-    linearray = np.fromstring(
-        band.ReadRaster(
-            0, line, dataset.RasterXSize, 1), dtype=np.float64)
-
-    linemaskedarray = np.ma.array(
-        linearray,
-        mask=np.equal(linearray, NO_DATA_VALUE),
-        )
-    return linemaskedarray
-
-
-def get_dataset_line_byte(band, xsize, line):
-    return np.fromstring(
-        band.ReadRaster(
-            0, line, xsize, 1), dtype=np.int8)
-
-
-def combine_with_dijkring_datasets(
-    dijkring_datasets, dijkringnr, filename, size_info, combine_method='max'):
-    """Dijkring_datasets is a dictionary with keys dijkring numbers
-    and values combined datasets for that dijkring. This function adds
-    a new dataset to a given dijkring's dataset, using either 'max' or
-    'min' methods. Dataset values are float64."""
-    log.debug("combine_with_dijkring_datasets({dd}, {d}, {f}, {s}, {c})"
-              .format(dd=dijkring_datasets, d=dijkringnr, f=filename,
-                      s=size_info, c=combine_method))
-
-    reprojected_dataset = None
-    fd = None
-    tif_filename = None
-    for dataset_pathname in all_files_in(filename):
-        dataset = gdal_open(dataset_pathname)
-
-        # Reproject dataset into TIF
-        fd, tif_filename = tempfile.mkstemp()
-        reprojected_dataset = TIFDRIVER.Create(
-            tif_filename, size_info.size_x, size_info.size_y, 1,
-            gdal.gdalconst.GDT_Float64,
-            options=[b'COMPRESS=DEFLATE', b'BIGTIFF=YES']
-            )
-        reprojected_dataset.SetGeoTransform(
-            (size_info.x_min, size_info.gridsize, 0,
-             size_info.y_max, 0, -size_info.gridsize))
-        reprojected_band = reprojected_dataset.GetRasterBand(1)
-        reprojected_band.SetNoDataValue(NO_DATA_VALUE)
-        reprojected_band.Fill(NO_DATA_VALUE)
-        gdal.ReprojectImage(dataset, reprojected_dataset)
-        dataset = None
-        break
-
-    if reprojected_dataset is None:
-        # There were no files?
-        if fd is not None:
-            remove_mkstemp(fd, tif_filename)
-        return
-
-    if dijkringnr in dijkring_datasets:
-        # Combine with existing dataset
-        oldmaxdataset = gdal.Open(
-            str(dijkring_datasets[dijkringnr]),
-            gdal.GA_Update,
-            )
-        oldmax_band = oldmaxdataset.GetRasterBand(1)
-
-        for lineno in range(reprojected_dataset.RasterYSize):
-            # New line as masked array
-            newlinemaskedarray = get_dataset_line_masked_array(
-                reprojected_dataset, reprojected_band, lineno)
-
-            # Existing line as masked array
-            oldmaxlinemaskedarray = get_dataset_line_masked_array(
-                reprojected_dataset, oldmax_band, lineno)
-
-            # Combine
-            if combine_method == 'min':
-                newmaxlinemaskedarray = np.ma.array(
-                    [oldmaxlinemaskedarray, newlinemaskedarray]).min(0)
-            else:
-                # Default is max
-                newmaxlinemaskedarray = np.ma.array(
-                    [oldmaxlinemaskedarray, newlinemaskedarray]).max(0)
-
-            # Save to raster
-            oldmax_band.WriteRaster(
-                0, lineno, reprojected_dataset.RasterXSize, 1,
-                newmaxlinemaskedarray.filled(NO_DATA_VALUE)
-                .tostring())
-
-        oldmaxdataset = None
-        reprojected_dataset = None
-    else:
-        # Create new dijkring dataset
-        # The tempfile wil be removed at the end of export
-        tmp_file_name = tempfile.mkstemp(
-            prefix=str(dijkringnr), suffix='.tif')[1]
-        TIFDRIVER.CreateCopy(
-            tmp_file_name, reprojected_dataset,
-            options=[b'COMPRESS=DEFLATE', b'BIGTIFF=YES'])
-        dijkring_datasets[dijkringnr] = tmp_file_name
-        reprojected_dataset = None
-
-    # Remove reprojected dataset
-    remove_mkstemp(fd, tif_filename)
-
-
-def combine_with_dijkring_datasets_byte(
-    dijkring_datasets, dijkringnr, filename, size_info):
-    """Similar to combine_with_dijkring_datasets, but for datasets of
-    which the datatype is int8 (signed byte). The only combine method
-    so far is "bitwise or", used for the inundation sources map. Datasets
-    are filled with the nodata value 0 instead of -9999."""
-
-    dataset = gdal_open(filename)
-    if dataset is None:
-        return
-
-    # Reproject dataset into TIF of correct size
-    fd, tif_filename = tempfile.mkstemp()
-
-    reprojected_dataset = TIFDRIVER.Create(
-        tif_filename, size_info.size_x, size_info.size_y, 1,
-        gdal.gdalconst.GDT_Byte, options=['COMPRESS=DEFLATE'])
-
-    reprojected_dataset.SetGeoTransform(
-        (size_info.x_min, size_info.gridsize, 0,
-         size_info.y_max, 0, -size_info.gridsize))
-    reprojected_band = reprojected_dataset.GetRasterBand(1)
-    reprojected_band.SetNoDataValue(0)
-    reprojected_band.Fill(0)
-    log.debug("dataset {}".format(dataset))
-    log.debug("reprojected_dataset {}".format(reprojected_dataset))
-    gdal.ReprojectImage(dataset, reprojected_dataset)
-
-    if dijkringnr in dijkring_datasets:
-        # Combine with existing dataset
-        olddataset = gdal.Open(
-            str(dijkring_datasets[dijkringnr]),
-            gdal.GA_Update)
-        oldband = olddataset.GetRasterBand(1)
-
-        for lineno in range(reprojected_dataset.RasterYSize):
-            newline = get_dataset_line_byte(
-                reprojected_band, size_info.size_x, lineno)
-            oldline = get_dataset_line_byte(
-                oldband, size_info.size_x, lineno)
-
-            # Combine
-            newline = np.bitwise_or(
-                oldline.astype(np.int8),
-                newline.astype(np.int8))
-
-            # Save to raster
-            oldband.WriteRaster(
-                0, lineno, reprojected_dataset.RasterXSize, 1,
-                newline.tostring())
-
-        olddataset = None
-        reprojected_dataset = None
-    else:
-        # Create new dijkring dataset
-        # The tempfile wil be removed at the end of export
-        tmp_file_name = tempfile.mkstemp(
-            prefix=str(dijkringnr), suffix='.tif')[1]
-        TIFDRIVER.CreateCopy(
-            tmp_file_name, reprojected_dataset,
-            options=[b'COMPRESS=DEFLATE'])
-        dijkring_datasets[dijkringnr] = tmp_file_name
-        reprojected_dataset = None
-
-    # Remove reprojected dataset
-    remove_mkstemp(fd, tif_filename)
+class InputCache(object):
+    """Reprojected input grids of an export run, so that products that
+    use the same inputs read and reproject them only once.
+
+    Entries are lists of (window, data) tuples as returned by
+    Combiner.read, keyed on the input file and the grid it was
+    reprojected onto. They are kept in memory up to memory_budget
+    bytes. After that the least recently used ones are moved to a
+    temporary directory, up to disk_budget bytes, and the least
+    recently used ones there are dropped. Counts of hits, misses and
+    evictions are kept in stats. Call close() to remove the temporary
+    directory."""
+
+    def __init__(self, memory_budget=None, disk_budget=None):
+        self.memory_budget = memory_budget or getattr(
+            settings, 'EXPORT_CACHE_MEMORY', CACHE_MEMORY_BUDGET)
+        self.disk_budget = disk_budget or getattr(
+            settings, 'EXPORT_CACHE_DISK', CACHE_DISK_BUDGET)
+
+        self.memory = OrderedDict()  # key is (filename, grid)
+        self.disk = OrderedDict()
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.tmp_dir = None
+        self.lock = threading.Lock()
+        self.stats = dict.fromkeys((
+                'hits', 'disk_hits', 'misses', 'to_disk', 'dropped'), 0)
+
+    def get(self, key, read):
+        """Return the grids of key, calling read() to get them if they
+        aren't in the cache."""
+        with self.lock:
+            if key in self.memory:
+                self.stats['hits'] += 1
+                grids = self.memory.pop(key)
+                self.memory[key] = grids  # Most recently used
+                return grids
+            if key in self.disk:
+                self.stats['disk_hits'] += 1
+                nbytes, paths = self.disk.pop(key)
+                self.disk[key] = nbytes, paths
+                return [(window, np.load(path, mmap_mode='r'))
+                        for window, path in paths]
+            self.stats['misses'] += 1
+
+        # Read outside the lock, other threads can use the cache
+        grids = read()
+        with self.lock:
+            if key not in self.memory and key not in self.disk:
+                self.memory[key] = grids
+                self.memory_bytes += get_nbytes(grids)
+                self.evict()
+        return grids
+
+    def evict(self):
+        while self.memory_bytes > self.memory_budget:
+            key, grids = self.memory.popitem(last=False)
+            nbytes = get_nbytes(grids)
+            self.memory_bytes -= nbytes
+            if nbytes > self.disk_budget:
+                self.stats['dropped'] += 1
+                continue
+
+            while self.disk_bytes + nbytes > self.disk_budget:
+                self.drop_from_disk()
+            self.disk[key] = nbytes, self.save(grids)
+            self.disk_bytes += nbytes
+            self.stats['to_disk'] += 1
+
+    def save(self, grids):
+        if self.tmp_dir is None:
+            self.tmp_dir = tempfile.mkdtemp(prefix='task_200_')
+        paths = []
+        for window, data in grids:
+            fd, path = tempfile.mkstemp(suffix='.npy', dir=self.tmp_dir)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, data)
+            paths.append((window, path))
+        return paths
+
+    def drop_from_disk(self):
+        key, (nbytes, paths) = self.disk.popitem(last=False)
+        self.disk_bytes -= nbytes
+        for window, path in paths:
+            os.remove(path)
+        self.stats['dropped'] += 1
+
+    def close(self):
+        log.debug("Input cache: {}".format(self.stats))
+        self.memory.clear()
+        self.disk.clear()
+        self.memory_bytes = self.disk_bytes = 0
+        if self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir)
+            self.tmp_dir = None
+
+
+def get_nbytes(grids):
+    return sum(data.nbytes for window, data in grids)
+
+
+class MemoryBudget(object):
+    """Bytes that the combiners of an export run may allocate in
+    memory together. Combiners take bytes with reserve() and give
+    them back with release() when they are closed."""
+
+    def __init__(self, budget=None):
+        self.budget = budget or getattr(
+            settings, 'EXPORT_COMBINE_MEMORY', COMBINE_MEMORY_BUDGET)
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, nbytes):
+        """Return True if nbytes fit in the budget, and take them."""
+        with self.lock:
+            if self.nbytes + nbytes > self.budget:
+                return False
+            self.nbytes += nbytes
+            return True
+
+    def release(self, nbytes):
+        with self.lock:
+            self.nbytes -= nbytes
+
+
+class Combiner(object):
+    """Combine grids per dijkring into one grid per dijkring.
+
+    All grids are reprojected onto the grid described by size_info and
+    combined with combine_method: 'max', 'min' or 'or' (bitwise, for
+    the byte grids of the inundation sources map). Cells that are
+    nodata in a grid never change the combined grid.
+
+    The combined grids are preallocated arrays, in memory as long as
+    they fit in memory_budget, a MemoryBudget that is shared by the
+    combiners of an export run, and memory mapped temporary files
+    after that. Every grid is reprojected onto
+    the window of the grid that it covers only, and combined in blocks
+    of rows. Call close() to remove the temporary files.
+
+    With an InputCache, reprojected input grids are shared with other
+    combiners onto the same grid."""
+
+    def __init__(
+        self, size_info, combine_method='max', data_type=gdal.GDT_Float64,
+        nodata=NO_DATA_VALUE, memory_budget=None,
+        threads=None, max_grids=None, cache=None):
+        self.size_info = size_info
+        self.cache = cache
+        self.combine_method = combine_method
+        self.data_type = data_type
+        self.dtype = np.dtype(
+            gdal_array.GDALTypeCodeToNumericTypeCode(data_type))
+        self.nodata = nodata
+        self.memory_budget = memory_budget or MemoryBudget()
+        self.threads = threads or getattr(
+            settings, 'EXPORT_THREADS', COMBINE_THREADS)
+        self.max_grids = max_grids or getattr(
+            settings, 'EXPORT_MAX_GRIDS', COMBINE_MAX_GRIDS)
+
+        self.geo_transform = (
+            size_info.x_min, size_info.gridsize, 0,
+            size_info.y_max, 0, -size_info.gridsize)
+        self.shape = (size_info.size_y, size_info.size_x)
+        self.block_rows = max(1, COMBINE_BLOCK_SIZE // size_info.size_x)
+
+        self.arrays = {}  # key is dijkringnr
+        self.nbytes = 0  # Bytes allocated in memory
+        self.tmp_files = []
+
+    def allocate(self):
+        """Return a new grid filled with nodata."""
+        nbytes = self.shape[0] * self.shape[1] * self.dtype.itemsize
+        if self.memory_budget.reserve(nbytes):
+            array = np.empty(self.shape, dtype=self.dtype)
+            self.nbytes += nbytes
+        else:
+            fd, tmp_file = tempfile.mkstemp(prefix='task_200_')
+            os.close(fd)
+            self.tmp_files.append(tmp_file)
+            array = np.memmap(
+                tmp_file, dtype=self.dtype, mode='w+', shape=self.shape)
+        array.fill(self.nodata)
+        return array
+
+    def get_window(self, dataset):
+        """Return (xoff, yoff, xsize, ysize) of the part of the grid
+        that dataset covers, or None if it covers nothing."""
+        x0, dx, _, y0, _, dy = dataset.GetGeoTransform()
+        x1, x2 = sorted((x0, x0 + dataset.RasterXSize * dx))
+        y1, y2 = sorted((y0, y0 + dataset.RasterYSize * dy))
+
+        size_info = self.size_info
+        xoff = max(0, int(np.floor(
+            (x1 - size_info.x_min) / size_info.gridsize)))
+        xend = min(size_info.size_x, int(np.ceil(
+            (x2 - size_info.x_min) / size_info.gridsize)))
+        yoff = max(0, int(np.floor(
+            (size_info.y_max - y2) / size_info.gridsize)))
+        yend = min(size_info.size_y, int(np.ceil(
+            (size_info.y_max - y1) / size_info.gridsize)))
+
+        if xend <= xoff or yend <= yoff:
+            return None
+        return xoff, yoff, xend - xoff, yend - yoff
+
+    def reproject(self, dataset, xoff, yoff, xsize, ysize):
+        """Return an array with dataset reprojected onto a window of
+        the grid."""
+        p, a, b, q, c, d = self.geo_transform
+        block = MEMDRIVER.Create(b'', xsize, ysize, 1, self.data_type)
+        block.SetGeoTransform((p + xoff * a, a, b, q + yoff * d, c, d))
+        band = block.GetRasterBand(1)
+        band.SetNoDataValue(self.nodata)
+        band.Fill(self.nodata)
+        gdal.ReprojectImage(dataset, block)
+        return band.ReadAsArray()
+
+    def read(self, filename):
+        """Return a list of (window, data) tuples, one for every
+        dataset in filename that covers part of the grid. Data is the
+        dataset reprojected onto that window, it should not be changed.
+        This opens its own datasets, so it can run in any thread."""
+        if self.cache is None:
+            return self.reproject_file(filename)
+        key = (filename, self.geo_transform, self.shape, self.data_type)
+        return self.cache.get(key, lambda: self.reproject_file(filename))
+
+    def reproject_file(self, filename):
+        grids = []
+        for dataset_filename in all_files_in(filename):
+            dataset = gdal_open(dataset_filename)
+            if dataset is None:
+                log.debug("Not found: {}".format(dataset_filename))
+                continue  # Skip, corrupt file
+            window = self.get_window(dataset)
+            if window is not None:
+                grids.append((window, self.reproject(dataset, *window)))
+            del dataset
+        return grids
+
+    def add(self, dijkringnr, grids):
+        """Combine grids, as returned by read(), into the grid of
+        dijkringnr, in blocks of rows."""
+        if not grids:
+            return
+        if dijkringnr not in self.arrays:
+            self.arrays[dijkringnr] = self.allocate()
+        combined = self.arrays[dijkringnr]
+
+        for (xoff, yoff, xsize, ysize), data in grids:
+            for start in range(0, ysize, self.block_rows):
+                end = min(start + self.block_rows, ysize)
+                self.combine(
+                    combined[yoff + start:yoff + end, xoff:xoff + xsize],
+                    data[start:end])
+
+    def add_input_files(self, input_files, read=None):
+        """Read input files on a pool of threads and add them.
+
+        Input_files is a list with dicts 'dijkringnr' and 'filename'.
+        Read is a function that returns the grids of an input file, by
+        default read() of its filename.
+
+        At most max_grids files are read ahead of the one that is being
+        added, to bound memory use. Max, min and or don't depend on the
+        order in which grids are combined, so files are added in the
+        order in which they were given."""
+        if read is None:
+            def read(input_file):
+                return self.read(input_file['filename'])
+
+        grids = map_bounded(read, input_files, self.threads, self.max_grids)
+        with closing(grids):
+            for input_file, file_grids in izip(input_files, grids):
+                self.add(input_file['dijkringnr'] or 0, file_grids)
+
+    def combine(self, combined, data):
+        """Combine data into combined, in place."""
+        if self.combine_method == 'or':
+            # Nodata is 0, so it doesn't need to be masked
+            np.bitwise_or(combined, data, out=combined)
+            return
+
+        if self.combine_method == 'min':
+            better = np.less(data, combined)
+        else:
+            # Default is max
+            better = np.greater(data, combined)
+        better |= (combined == self.nodata)
+        better &= (data != self.nodata)
+        np.copyto(combined, data, where=better)
+
+    def close(self):
+        self.arrays.clear()
+        self.memory_budget.release(self.nbytes)
+        self.nbytes = 0
+        for tmp_file in self.tmp_files:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+        self.tmp_files = []
 
 
 def dijkring_arrays_to_zip(
-    input_files, zip_filename, gridtype='output', gridsize=50,
-    combine_method='max'):
+    input_files, export_zip, gridtype='output', gridsize=50,
+    combine_method='max', keep=False, cache=None, memory_budget=None):
     """
-    Return arrays in a dict with key 'dijkringnr'.
-    Value is a tif dataset
+    Combine the input files per dijkring and save them in the zip
+    file, with arcnames '<gridtype>_<dijkringnr>.asc'.
 
     Input_files is a list with dicts 'dijkringnr' and 'filename'
 
-    gridtype is used to generate useful arcnames
+    Cache is an optional InputCache for the export run, memory_budget
+    its MemoryBudget.
+
+    Return the Combiner if keep is set, so that its grids can be used
+    further. It should be closed after that.
     """
     if len(input_files) == 0:
-        return dict()
+        return None
 
     log.debug(b"dijkring_arrays_to_zip({i}, {z}, {g}, {gs}, {c})"
-              .format(i=input_files, z=zip_filename, g=gridtype,
+              .format(i=input_files, z=export_zip, g=gridtype,
                       gs=gridsize, c=combine_method))
 
-    dijkring_datasets = {}  # key is dijkringnr, values are tif
-                            # filenames of combined datasets
-
     # Extent over all input files
     size_info = find_boundary(input_files, gridsize)
 
-    for num, input_file in enumerate(input_files, 1):
-        dijkringnr = input_file['dijkringnr'] or 0
-        for filename in all_files_in(input_file['filename']):
-            combine_with_dijkring_datasets(
-                dijkring_datasets, dijkringnr, filename, size_info,
-                combine_method=combine_method)
-
-    save_dijkring_datasets_to_zip(
-        zip_filename, dijkring_datasets, gridtype)
-
-    return dijkring_datasets
-
+    combiner = Combiner(
+        size_info, combine_method=combine_method, cache=cache,
+        memory_budget=memory_budget)
+    try:
+        combiner.add_input_files(input_files)
+        save_dijkring_datasets_to_zip(export_zip, combiner, gridtype)
+    except Exception:
+        combiner.close()
+        raise
+
+    if not keep:
+        combiner.close()
+        return None
+    return combiner
 
-def save_dijkring_datasets_to_zip(zip_file, dijkring_datasets, gridtype):
-    log.debug(b"save_dijkring_datasets_to_zip({z}, {dd}, {g}"
-              .format(z=zip_file, dd=dijkring_datasets, g=gridtype))
 
-    for dijkringnr, dataset_filename in dijkring_datasets.items():
-        dataset = gdal_open(dataset_filename)
+def map_bounded(func, iterable, threads, size):
+    """Yield func(item) for the items of iterable, in order. The calls
+    are made on a pool of threads, at most size items ahead of the
+    consumer."""
+    pool = ThreadPool(threads)
+    pending = deque()
+    try:
+        for item in iterable:
+            if len(pending) >= size:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(func, (item,)))
+        while pending:
+            yield pending.popleft().get()
+    except BaseException:
+        # Also when the consumer stops early (GeneratorExit)
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
 
-        fd, ascii_filename = tempfile.mkstemp()
 
-        AAIGRIDDRIVER.CreateCopy(ascii_filename, dataset)
+def save_dijkring_datasets_to_zip(export_zip, combiner, gridtype):
+    log.debug(b"save_dijkring_datasets_to_zip({z}, {c}, {g}"
+              .format(z=export_zip, c=combiner, g=gridtype))
 
+    for dijkringnr in sorted(combiner.arrays):
         arc_name = '%s_%d.asc' % (gridtype, dijkringnr)
-        add_to_zip(
-            zip_file,
-            [{
-                    'filename': ascii_filename,
-                    'arcname': arc_name,
-                    'delete_after': True
-                    }])
-
-        remove_mkstemp(fd, ascii_filename)
+        export_zip.write_grid(
+            arc_name, combiner.arrays[dijkringnr], combiner.geo_transform,
+            combiner.nodata)
 
 
-def calc_max_waterdepths(tmp_zip_filename, export_run):
+def calc_max_waterdepths(
+    export_zip, export_run, cache=None, memory_budget=None, keep=True):
     log.debug('calc_max_waterdepths({t}, {e})'
-              .format(t=tmp_zip_filename, e=export_run))
+              .format(t=export_zip, e=export_run))
 
     gridtype = 'gridmaxwaterdepth'
     # Find out input files for this type
     input_files = export_run.input_files(gridtype)
     if not input_files:
         log.warn("No file to calc max waterdepths.")
-        return {}
-    dijkring_datasets = dijkring_arrays_to_zip(
-        input_files, tmp_zip_filename, gridtype,
-        gridsize=export_run.gridsize)
-    return dijkring_datasets
+        return None
+    return dijkring_arrays_to_zip(
+        input_files, export_zip, gridtype,
+        gridsize=export_run.gridsize, keep=keep, cache=cache,
+        memory_budget=memory_budget)
 
 
-def calc_sources_of_inundation(tmp_zip_filename, export_run):
+def calc_sources_of_inundation(
+    export_zip, export_run, cache=None, memory_budget=None):
     input_files = export_run.input_files('gridmaxwaterdepth')
     if not input_files:
         return
 
-    temp_dirs = []
-
     buitenwatertype_inputfield = InputField.objects.get(
         pk=INPUTFIELD_BUITENWATERTYPE)
 
     for input_file in input_files:
-        dataset = gdal_open(input_file['filename'])
-        if dataset is None:
-            log.debug(
-                "Dataset {f} not found.".format(f=input_file['filename']))
-            continue
-        geo_transform = dataset.GetGeoTransform()
-        maxarray = dataset2array(dataset)
-        del dataset
-
         buitenwater_type = input_file['scenario'].value_for_inputfield(
             buitenwatertype_inputfield)
 
-        buitenwater_type = {
+        input_file['source'] = {
             1: 1,
             2: 1,
             3: 2,
@@ -594,112 +922,94 @@ def calc_sources_of_inundation(tmp_zip_filename, export_run):
             9: 4,
             10: 4}[buitenwater_type]
 
-        log.debug("buitenwater_type: {}".format(buitenwater_type))
-        flooded_array = (maxarray >= 0.02).filled(0).astype(np.int8)
-        flooded_array *= buitenwater_type
-
-        temp_dir = tempfile.mkdtemp()
-        temp_dirs.append(temp_dir)
-        temp_file = os.path.join(temp_dir, b'temptif.tif')
-
-        write_masked_array(
-            temp_file, flooded_array, geo_transform,
-            driver=TIFDRIVER)
-
-        input_file['filename'] = temp_file
-
-    dijkring_datasets = {}  # key is dijkringnr, values are tif
-                            # filenames of combined datasets
-
     # Extent over all input files
     size_info = find_boundary(input_files, export_run.gridsize)
 
-    for num, input_file in enumerate(input_files, 1):
-        dijkringnr = input_file['dijkringnr'] or 0
-        combine_with_dijkring_datasets_byte(
-            dijkring_datasets, dijkringnr, input_file['filename'], size_info)
+    # The max waterdepths, reprojected, probably from the cache
+    maxdepths = Combiner(size_info, cache=cache)
 
-    save_dijkring_datasets_to_zip(
-        tmp_zip_filename, dijkring_datasets, 'grid_sources')
+    def read(input_file):
+        return [
+            (window, np.greater_equal(maxarray, 0.02).astype(np.uint8) *
+             np.uint8(input_file['source']))
+            for window, maxarray in maxdepths.read(input_file['filename'])]
 
-    for d in temp_dirs:
-        shutil.rmtree(d)
+    combiner = Combiner(
+        size_info, combine_method='or', data_type=gdal.GDT_Byte, nodata=0,
+        memory_budget=memory_budget)
+    try:
+        combiner.add_input_files(input_files, read)
+        save_dijkring_datasets_to_zip(
+            export_zip, combiner, 'grid_sources')
+    finally:
+        combiner.close()
 
 
-def calc_wavefronts(tmp_zip_filename, export_run):
+def calc_wavefronts(export_zip, export_run, cache=None, memory_budget=None):
     log.debug("calc_wavefronts({t}, {e})"
-              .format(t=tmp_zip_filename, e=export_run))
+              .format(t=export_zip, e=export_run))
 
     input_files = export_run.input_files('computed_arrival_time')
     if not input_files:
-        return {}
-
-    dijkring_datasets = dijkring_arrays_to_zip(
-        input_files, tmp_zip_filename, 'gridta',
-        gridsize=export_run.gridsize, combine_method='min')
+        return
 
-    return dijkring_datasets
+    dijkring_arrays_to_zip(
+        input_files, export_zip, 'gridta',
+        gridsize=export_run.gridsize, combine_method='min', cache=cache,
+        memory_budget=memory_budget)
 
 
-def calc_rise_period(tmp_zip_filename, export_run):
+def calc_rise_period(
+    export_zip, export_run, cache=None, memory_budget=None):
     log.debug("calc_rise_period({t}, {e})"
-              .format(t=tmp_zip_filename, e=export_run))
+              .format(t=export_zip, e=export_run))
 
     input_files = export_run.input_files('computed_difference')
     if not input_files:
-        return {}
-
-    temp_dirs = []
-    # Temporarily, re-compute the difference from time_of_max and
-    # arrival_time, because it was computed the wrong way.
-    new_input_files = []
-    for input_file in input_files:
-        filename = input_file['filename']
-        arrival_time = filename.replace(
-            'computed_difference', 'computed_arrival_time')
-        time_of_max = filename.replace(
-            'computed_difference', 'computed_time_of_max')
-
-        arrival_time_dataset = gdal_open(arrival_time)
-        if not arrival_time_dataset:
-            continue
-
-        grid = arrival_time_dataset.GetRasterBand(1).ReadAsArray()
-        del arrival_time_dataset
-
-        tmpdir = tempfile.mkdtemp()
-        temp_dirs.append(tmpdir)
-        tmpfile = os.path.join(tmpdir, b'computed_difference.tiff')
-
-        time_of_max_dataset = gdal_open(time_of_max)
-        if not time_of_max_dataset:
-            continue
-
-        difference_dataset = TIFDRIVER.CreateCopy(
-            tmpfile, time_of_max_dataset)
-
-        time_of_max_grid = (
-            time_of_max_dataset.GetRasterBand(1).ReadAsArray())
-
-        difference_grid = time_of_max_grid - grid
-        difference_dataset.GetRasterBand(1).WriteArray(difference_grid)
-        input_file['filename'] = tmpfile
-        new_input_files.append(input_file)
+        return
 
-    dijkring_datasets = dijkring_arrays_to_zip(
-        new_input_files, tmp_zip_filename, 'grid_rise_period',
-        gridsize=export_run.gridsize, combine_method='min')
+    # Extent over all input files
+    size_info = find_boundary(input_files, export_run.gridsize)
 
-    for tmpdir in temp_dirs:
-        shutil.rmtree(tmpdir)
+    # Temporarily, re-compute the difference from time_of_max and
+    # arrival_time, because it was computed the wrong way. The arrival
+    # times are probably in the cache already.
+    times = Combiner(size_info, cache=cache)
 
-    return dijkring_datasets
+    def read(input_file):
+        filename = input_file['filename']
+        arrival_times = times.read(filename.replace(
+                'computed_difference', 'computed_arrival_time'))
+        times_of_max = times.read(filename.replace(
+                'computed_difference', 'computed_time_of_max'))
+        grids = []
+        for (window, grid), (window2, time_of_max_grid) in zip(
+            arrival_times, times_of_max):
+            if window != window2:
+                log.warn("Arrival time and time of max of {} differ."
+                         .format(filename))
+                continue
+            difference_grid = np.subtract(time_of_max_grid, grid)
+            difference_grid[grid == NO_DATA_VALUE] = NO_DATA_VALUE
+            difference_grid[time_of_max_grid == NO_DATA_VALUE] = (
+                NO_DATA_VALUE)
+            grids.append((window, difference_grid))
+        return grids
+
+    combiner = Combiner(
+        size_info, combine_method='min', memory_budget=memory_budget)
+    try:
+        combiner.add_input_files(input_files, read)
+        save_dijkring_datasets_to_zip(
+            export_zip, combiner, 'grid_rise_period')
+    finally:
+        combiner.close()
 
 
-def calc_max_flowvelocity(tmp_zip_filename, export_run):
+def calc_max_flowvelocity(export_zip, export_run, memory_budget=None):
     # Calc max flow velocity
     log.debug('calc_max_flowvelocity({t}, {e})'
-              .format(t=tmp_zip_filename, e=export_run))
+              .format(t=export_zip, e=export_run))
 
     gridtype = 'gridmaxflowvelocity'
     export_result_type = ResultType.objects.get(name=gridtype)
@@ -707,46 +1017,28 @@ def calc_max_flowvelocity(tmp_zip_filename, export_run):
     input_files = export_run.input_files(export_result_type)
     if len(input_files) <= 0:
         log.warn("No file to calc max flowvelocity.")
-        return {}
-    dijkring_datasets = dijkring_arrays_to_zip(
-        input_files, tmp_zip_filename, gridtype,
-        gridsize=export_run.gridsize)
-    return dijkring_datasets
+        return
+    dijkring_arrays_to_zip(
+        input_files, export_zip, gridtype,
+        gridsize=export_run.gridsize, memory_budget=memory_budget)
 
 
-def calc_possible_flooded_area(tmp_zip_filename, max_waterdepths_datasets):
-    # Calculate the possible flooded area
+def calc_possible_flooded_area(export_zip, max_waterdepths):
+    """Calculate the possible flooded area from the Combiner of max
+    waterdepths."""
     log.debug('calc_possible_flooded_area({t}, {m})'
-              .format(t=tmp_zip_filename, m=max_waterdepths_datasets))
-
-    for dijkringnr, dataset_filename in max_waterdepths_datasets.items():
-
-        dataset = gdal_open(dataset_filename)
-
-        geo_transform = dataset.GetGeoTransform()
-        maxarray = dataset2array(dataset)
-
-        del dataset
+              .format(t=export_zip, m=max_waterdepths))
+    if max_waterdepths is None:
+        return
 
-        flooded_array = np.ma.zeros(maxarray.shape, dtype=np.int8)
-        flooded_array[np.ma.greater_equal(maxarray, 0.02)] = 1
+    geo_transform = max_waterdepths.geo_transform
+    for dijkringnr, maxarray in sorted(max_waterdepths.arrays.items()):
+        # Nodata is negative, so not flooded
+        flooded_array = np.greater_equal(maxarray, 0.02).astype(np.uint8)
 
-        fd, ascii_filename = tempfile.mkstemp()
-        if dijkringnr is None:
-            dijkringnr = 0
         arc_name = 'possibly_flooded_%d.asc' % (dijkringnr)
-
-        write_masked_array(
-            ascii_filename, flooded_array, geo_transform)
-
-        add_to_zip(
-            tmp_zip_filename,
-            [{'filename': ascii_filename,
-              'arcname': arc_name,
-              'delete_after': True}])
-        if os.path.isfile(ascii_filename):
-            os.close(fd)
-            os.remove(ascii_filename)
+        export_zip.write_grid(
+            arc_name, flooded_array, geo_transform, NO_DATA_VALUE)
 
 
 def calculate_export_maps(exportrun_id):
@@ -764,38 +1056,66 @@ def calculate_export_maps(exportrun_id):
     """
     log.debug("calculate_export_maps({e})".format(e=exportrun_id))
     export_run = ExportRun.objects.get(id=exportrun_id)
-    max_waterdepths = {}
-    max_flowvelocity = {}
 
-    zip_fd, tmp_zip_filename = tempfile.mkstemp()
-
-    if export_run.export_max_waterdepth or export_run.export_possibly_flooded:
-        max_waterdepths = calc_max_waterdepths(
-            tmp_zip_filename, export_run)
-
-    if export_run.export_max_flowvelocity:
-        max_flowvelocity = calc_max_flowvelocity(
-            tmp_zip_filename, export_run)
-
-    if export_run.export_possibly_flooded:
-        # Calculate the possible flooded area
-        calc_possible_flooded_area(tmp_zip_filename,
-                                   max_waterdepths)
-
-    if export_run.export_arrival_times:
-        calc_wavefronts(tmp_zip_filename, export_run)
-
-    if export_run.export_period_of_increasing_waterlevel:
-        calc_rise_period(tmp_zip_filename, export_run)
-
-    if export_run.export_inundation_sources:
-        calc_sources_of_inundation(tmp_zip_filename, export_run)
+    # Products that use the same inputs are computed one after the
+    # other, so that they are likely to be in the cache. Their combined
+    # grids share one memory budget.
+    cache = InputCache()
+    memory_budget = MemoryBudget()
 
-    dst_path = export_run.generate_dst_path()
-
-    create_json_meta_file(tmp_zip_filename, export_run, dst_path)
+    zip_fd, tmp_zip_filename = tempfile.mkstemp()
+    export_zip = ExportZip(tmp_zip_filename)
 
-    shutil.move(tmp_zip_filename, dst_path)
+    # The cache, the combiners and the zip file keep temporary files,
+    # which are removed also if a product fails
+    try:
+        if (export_run.export_max_waterdepth or
+                export_run.export_possibly_flooded):
+            # Only keep the grids if they are needed for the flooded area
+            max_waterdepths = calc_max_waterdepths(
+                export_zip, export_run, cache, memory_budget,
+                keep=export_run.export_possibly_flooded)
+            try:
+                if export_run.export_possibly_flooded:
+                    # Calculate the possible flooded area
+                    calc_possible_flooded_area(export_zip,
+                                               max_waterdepths)
+            finally:
+                # Release the kept grids before the next products
+                # allocate theirs
+                if max_waterdepths is not None:
+                    max_waterdepths.close()
+
+        if export_run.export_inundation_sources:
+            calc_sources_of_inundation(
+                export_zip, export_run, cache, memory_budget)
+
+        if export_run.export_arrival_times:
+            calc_wavefronts(export_zip, export_run, cache, memory_budget)
+
+        if export_run.export_period_of_increasing_waterlevel:
+            calc_rise_period(export_zip, export_run, cache, memory_budget)
+
+        cache.close()
+
+        if export_run.export_max_flowvelocity:
+            calc_max_flowvelocity(export_zip, export_run, memory_budget)
+
+        dst_path = export_run.generate_dst_path()
+
+        create_json_meta_file(export_zip, export_run, dst_path)
+        export_zip.close()
+
+        shutil.move(tmp_zip_filename, dst_path)
+    finally:
+        cache.close()
+        try:
+            export_zip.close()
+        finally:
+            # remove tmp files
+            os.close(zip_fd)
+            if os.path.isfile(tmp_zip_filename):
+                os.remove(tmp_zip_filename)
 
     # Make the zipfile readable for the Web server
     files.make_file_readable_for_all(dst_path)
@@ -808,17 +1128,4 @@ def calculate_export_maps(exportrun_id):
     export_run.save_result_file(dst_path)
     export_run.done()
 
-    # remove tmp files
-    if os.path.isfile(tmp_zip_filename):
-        os.close(zip_fd)
-        os.remove(tmp_zip_filename)
-
-    for tmp_file in max_waterdepths.values():
-        if os.path.isfile(tmp_file):
-            os.remove(tmp_file)
-
-    for tmp_file in max_flowvelocity.values():
-        if os.path.isfile(tmp_file):
-            os.remove(tmp_file)
-
     log.debug('Finished.')
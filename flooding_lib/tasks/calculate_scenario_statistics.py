@@ -132,17 +132,18 @@ def inundation_based_on_flsh(scenario):
     else:
         raise AssertionError("Neither resulttype for fls_h.inc found!")
 
-    with files.temporarily_unzipped(
-        result_zip(scenario, use_result_type_id)) as names:
+    zip_path = result_zip(scenario, use_result_type_id)
+    with files.temporarily_unzipped(zip_path) as names:
         for name in names:
             if os.path.basename(name) == 'fls_h.inc':
-                j = process_flsh(name)
+                j = process_flsh(name, zip_path)
                 save_inundation_json(scenario, j)
                 break
 
 
-def process_flsh(flsh_path):
-    flsh = flshinc.Flsh(flsh_path, one_per_hour=True)
+def process_flsh(flsh_path, source_path=None):
+    flsh = flshinc.Flsh(
+        flsh_path, one_per_hour=True, source_path=source_path)
     geo_transform = flsh.geo_transform()
 
     calculated_inundations = []
@@ -1,10 +1,15 @@
 from __future__ import unicode_literals
 
+import Queue
 import os
 import stat
+import subprocess
 import sys
+import threading
+import time
 
 import numpy as np
+import six
 from osgeo import gdal
 
 from django.conf import settings
@@ -14,6 +19,7 @@ from flooding_base.models import Setting
 from flooding_lib import models
 from flooding_lib.models import Scenario
 from flooding_lib.tools.importtool.models import InputField
+from flooding_lib.tools.pyramids import cube
 from flooding_lib.tools.pyramids import models as pyramidmodels
 from flooding_lib.tasks import calculate_export_maps
 from flooding_lib.util import files
@@ -24,6 +30,11 @@ logger = logging.getLogger(__name__)
 
 INPUTFIELD_STARTMOMENT_BREACHGROWTH_ID = 9
 
+# Number of frames that parsing an .inc file can be ahead of writing
+# them, and seconds between reports of the throughput
+FRAME_QUEUE_SIZE = 16
+REPORT_INTERVAL = 60
+
 __revision__ = "1.0"  # perform_task wants this
 
 
@@ -166,11 +177,15 @@ def generate_for_result(result, results_dir, base_output_dir, tmp_dir,
         # Unpack zip file
         with files.temporarily_unzipped(
             result_location, rezip=False, tmp_dir=tmp_dir) as unzipped:
+            calculate_export_maps.update_result_extent(
+                result, result_location, unzipped)
             pyramid_or_animation = compute_pyramids(
                 result, unzipped, result_to_correct_gridta, output_dir,
-                maxwaterdepth_geotransform)
+                maxwaterdepth_geotransform, source_path=result_location)
     else:
         # Just use the file itself
+        calculate_export_maps.update_result_extent(
+            result, result_location, [result_location])
         pyramid_or_animation = compute_pyramids(
             result, [result_location], result_to_correct_gridta,
             output_dir, maxwaterdepth_geotransform)
@@ -189,10 +204,39 @@ def generate_for_result(result, results_dir, base_output_dir, tmp_dir,
 
     result.save()
 
+    if result.raster is not None and not hasattr(
+            pyramid_or_animation, 'frames'):
+        seed_tiles(result)
+
+
+def seed_tiles(result):
+    """Pre-render png tiles of the result's raster for the zoom levels
+    in settings.TILE_SEED_ZOOMLEVELS, in the default style of each of
+    its presentation types. Does nothing if the setting is empty."""
+    zoomlevels = getattr(settings, 'TILE_SEED_ZOOMLEVELS', None)
+    if not zoomlevels:
+        return
+
+    command = os.path.join(settings.BUILDOUT_DIR, 'bin', 'seedtiles')
+    project = result.scenario.main_project
+
+    for presentationtype in result.resulttype.presentationtype.all():
+        colormap, maxvalue = presentationtype.colormap_info(project=project)
+        # Formatted the way the Javascript of the site does it
+        style = '{}:0:{:g}'.format(colormap, maxvalue)
+        logger.debug("Seeding tiles for {} in style {}".format(
+                result.raster.layer, style))
+        returncode = subprocess.call(
+            [command, result.raster.layer, '--style', style, '--zoom'] +
+            [str(z) for z in zoomlevels])
+        if returncode:
+            logger.warning("Seeding tiles failed with code {}".format(
+                    returncode))
+
 
 def compute_pyramids(
     result, input_files, result_to_correct_gridta, output_dir,
-    maxwaterdepth_geotransform):
+    maxwaterdepth_geotransform, source_path=None):
     # If we have an inc file, use that
     inc_file = next(
         (i for i in input_files if i.lower().endswith('.inc')), None)
@@ -213,7 +257,7 @@ def compute_pyramids(
         # amount, basename = generate_from_inc(inc_file)
         animation = animation_from_inc(
             inc_file, output_dir, maxwaterdepth_geotransform,
-            compute_arrival_times, startmoment_hours)
+            compute_arrival_times, startmoment_hours, source_path)
         if compute_arrival_times:
             generate_arrival_times_results(result.scenario, output_dir)
         return animation
@@ -240,6 +284,7 @@ def generate_arrival_times_results(scenario, output_dir):
             'computed_difference',
             'computed_time_of_max')
         if os.path.exists(os.path.join(output_dir, '{}.tiff'.format(f)))]
+    absolute_output_dir = output_dir
 
     if output_dir.startswith(destination_dir):
         if not destination_dir.endswith('/'):
@@ -267,55 +312,141 @@ def generate_arrival_times_results(scenario, output_dir):
         newresult.unit = resulttype.unit
         newresult.save()
 
+        calculate_export_maps.update_result_extent(
+            newresult,
+            os.path.join(absolute_output_dir, '{}.tiff'.format(name)))
+
 
-def save_to_tiff(filepath, grid, geotransform):
+def save_to_tiff(filepath, grid, geotransform, data_type=gdal.GDT_Float64):
+    """Save grid as a compressed geotiff of data_type, with a predictor
+    that suits the type."""
     rows, cols = grid.shape
     if isinstance(filepath, unicode):
         filepath = filepath.encode('utf8')
+    if data_type in (gdal.GDT_Float32, gdal.GDT_Float64):
+        predictor = 'PREDICTOR=3'  # floating point
+    else:
+        predictor = 'PREDICTOR=2'  # horizontal differencing
     dataset = GDAL_TIFF_DRIVER.Create(
         filepath,
-        cols, rows, 1, gdal.GDT_Float64, [
+        cols, rows, 1, data_type, [
             'BIGTIFF=YES', 'TILED=YES', 'SPARSE_OK=YES',
-            'COMPRESS=DEFLATE'])
+            'COMPRESS=DEFLATE', predictor])
     dataset.SetGeoTransform(geotransform)
     band = dataset.GetRasterBand(1)
     band.SetNoDataValue(0.0)
     band.WriteArray(grid)
 
 
+def in_background(iterable, size):
+    """Iterate over iterable in a separate thread, at most size items
+    ahead of the consumer, and yield its items. Exceptions in the
+    thread are raised in the consumer."""
+    items = Queue.Queue(maxsize=size)
+    stop = threading.Event()
+    errors = []
+    done = object()
+
+    def put(item):
+        # Give up when the consumer stopped listening
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception:
+            errors.append(sys.exc_info())
+        put(done)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+
+    if errors:
+        six.reraise(*errors[0])
+
+
+def log_throughput(frames, nbytes, seconds):
+    logger.info(
+        "{} frames in {:.0f}s: {:.1f} frames/s, {:.1f} MB/s.".format(
+            frames, seconds, frames / max(seconds, 1e-6),
+            nbytes / (1024.0 * 1024) / max(seconds, 1e-6)))
+
+
 def animation_from_inc(inc_file, output_dir, maxwaterdepth_geotransform,
-                       use_to_compute_arrival_times, startmoment_hours):
-    """Save each grid as a geotiff dataset so that images can be
-    quickly created on the fly from it."""
+                       use_to_compute_arrival_times, startmoment_hours,
+                       source_path=None):
+    """Save the grids as bands of an animation cube so that images can
+    be quickly created on the fly from it. Source_path is the zip file
+    that inc_file was unpacked from, if any.
+
+    The file is parsed in a separate thread, which passes only the
+    changed cells of each frame to this one through a bounded queue.
+    The cube compresses its blocks on all cpus when it is closed."""
     fls = flshinc.Flsh(
-        inc_file, one_per_hour=True, mutate=False,
-        helper_geotransform=maxwaterdepth_geotransform)
+        inc_file, one_per_hour=True,
+        helper_geotransform=maxwaterdepth_geotransform,
+        source_path=source_path)
     logger.debug("Generating animation from {}".format(inc_file))
 
     geotransform = fls.geo_transform()
 
-    maxvalue = None
+    maxvalue = 0.0  # Grids start as zeros
+    array = np.zeros((fls.nrows + 1, fls.ncols + 1))
 
     gridta_gridtd_recorder = GridtaGridtdRecorder(
         output_dir, geotransform, startmoment_hours)
 
-    for i, (timestamp, array) in enumerate(fls):
-        filename = b'dataset{:04d}.tiff'.format(i)
-        filepath = os.path.join(output_dir, filename)
-        logger.debug("Writing {}.".format(filepath))
-        if i == 0:
-            maxvalue = np.amax(array)
-        else:
-            maxvalue = max(maxvalue, np.amax(array))
-
-        gridta_gridtd_recorder.register(i, array)
-
-        save_to_tiff(filepath, array, geotransform)
+    writer = cube.Writer(
+        os.path.join(output_dir, cube.FILENAME), geotransform)
 
+    # Only look at the cells that changed, except for writing frames
+    deltas = (delta[:3] for delta in fls.iter_deltas())
+    start = last_report = time.time()
+    try:
+        for i, (timestamp, indices, values) in enumerate(
+                in_background(deltas, FRAME_QUEUE_SIZE)):
+            logger.debug("Adding frame {} (t={}, {} changed cells).".format(
+                i, timestamp, indices.size))
+            array.put(indices, values)
+            if values.size:
+                maxvalue = max(maxvalue, values.max())
+
+            gridta_gridtd_recorder.register_delta(
+                i, array.shape, indices, values)
+
+            writer.append(array, timestamp)
+
+            if time.time() - last_report > REPORT_INTERVAL:
+                log_throughput(
+                    i + 1, (i + 1) * array.size * 4, time.time() - start)
+                last_report = time.time()
+
+        frames = writer.close()
+    finally:
+        writer.abort()  # Don't leave the frames behind after an error
+    log_throughput(frames, frames * array.size * 4, time.time() - start)
     rows, cols = array.shape
 
     animation = pyramidmodels.Animation.objects.create(
-        frames=i + 1, cols=cols, rows=rows,
+        frames=frames, cols=cols, rows=rows,
         geotransform={'geotransform': geotransform},
         basedir=output_dir,
         maxvalue=maxvalue)
@@ -333,40 +464,44 @@ def animation_from_ascs(
     maxvalue = None
 
     gridta_gridtd_recorder = None
+    writer = None
     array = None
-    for i, input_file in enumerate(input_files):
-        filename = b'dataset{:04d}.tiff'.format(i)
-        filepath = os.path.join(output_dir, filename)
-
-        logger.debug("- {} -> {}".format(input_file, filepath))
-
-        dataset = gdal_open(input_file)
-        if dataset is None:
-            continue
-        array = dataset.GetRasterBand(1).ReadAsArray()
-        if maxvalue is None:
-            maxvalue = np.amax(array)
-        else:
-            maxvalue = max(maxvalue, np.amax(array))
-        geotransform = dataset.GetGeoTransform()
-
-        if gridta_gridtd_recorder is None:
-            gridta_gridtd_recorder = GridtaGridtdRecorder(
-                output_dir, geotransform, startmoment_hours)
-        gridta_gridtd_recorder.register(i, array)
-
-        save_to_tiff(
-            filepath,
-            array,
-            geotransform)
-
-    if array is None:
-        # No input files
-        return None
+    try:
+        for i, input_file in enumerate(input_files):
+            logger.debug("- {}".format(input_file))
+
+            dataset = gdal_open(input_file)
+            if dataset is None:
+                continue
+            array = dataset.GetRasterBand(1).ReadAsArray()
+            if maxvalue is None:
+                maxvalue = np.amax(array)
+            else:
+                maxvalue = max(maxvalue, np.amax(array))
+            geotransform = dataset.GetGeoTransform()
+
+            if gridta_gridtd_recorder is None:
+                gridta_gridtd_recorder = GridtaGridtdRecorder(
+                    output_dir, geotransform, startmoment_hours)
+                writer = cube.Writer(
+                    os.path.join(output_dir, cube.FILENAME), geotransform)
+            gridta_gridtd_recorder.register(i, array)
+
+            writer.append(array)
+
+        if array is None:
+            # No input files
+            return None
+
+        # Unreadable input files are skipped, they have no frame
+        frames = writer.close()
+    finally:
+        if writer is not None:
+            writer.abort()  # Don't leave the frames behind after an error
 
     rows, cols = array.shape
     animation = pyramidmodels.Animation.objects.create(
-        frames=i + 1, cols=cols, rows=rows,
+        frames=frames, cols=cols, rows=rows,
         geotransform={'geotransform': geotransform},
         basedir=output_dir,
         maxvalue=maxvalue)
@@ -440,13 +575,24 @@ def his_ssm(scenario_id, tmp_dir):
 
 
 class GridtaGridtdRecorder(object):
-    def __init__(self, output_dir, geotransform, startmoment_hours):
+    # Timesteps are hours, uint16 lasts for more than 7 years. Maximum
+    # depths are only compared, float32 precision is plenty for that.
+    TIMESTEP_TYPE = np.uint16
+    DEPTH_TYPE = np.float32
+
+    def __init__(self, output_dir, geotransform, startmoment_hours,
+                 tile_rows=None):
         # If they don't exist yet, we also create a
         # 'computed_arrival_time.tiff' and 'computed_time_of_max.tiff'
 
+        # register() works on bands of tile_rows rows at a time if
+        # given, so that its scratch buffers are that size instead of
+        # the size of the grid.
+
         self.output_dir = output_dir
         self.geotransform = geotransform
         self.startmoment_hours = startmoment_hours
+        self.tile_rows = tile_rows
 
         self.arrival_time = None
         self.time_of_max = None
@@ -454,32 +600,107 @@ class GridtaGridtdRecorder(object):
         self.first_moment_15m = None
         self.max_timestep = 0
 
+    def allocate(self, shape):
+        self.arrival_time = np.zeros(shape, dtype=self.TIMESTEP_TYPE)
+        self.time_of_max = np.zeros(shape, dtype=self.TIMESTEP_TYPE)
+        self.max_seen = np.zeros(shape, dtype=self.DEPTH_TYPE)
+        self.first_moment_15m = np.zeros(shape, dtype=self.TIMESTEP_TYPE)
+
+        # Scratch buffers for register(), reused for every timestep
+        rows, cols = shape
+        if self.tile_rows is not None:
+            rows = min(rows, self.tile_rows)
+        self.depth = np.empty((rows, cols), dtype=self.DEPTH_TYPE)
+        self.mask = np.empty((rows, cols), dtype=np.bool)
+        self.other_mask = np.empty((rows, cols), dtype=np.bool)
+
+    def next_timestep(self, timestep):
+        timestep += 1  # 1-based, so that 0 is no data
+
+        if timestep > np.iinfo(self.TIMESTEP_TYPE).max:
+            raise ValueError(
+                "Too many timesteps to record: {}".format(timestep))
+
+        self.max_timestep = timestep
+        return timestep
+
     def register(self, timestep, grid):
         # Grid is an array of values. Wherever it is greater than 0.01,
         # we record its value.
 
-        timestep += 1  # 1-based, so that 0 is no data
+        timestep = self.next_timestep(timestep)
 
-        self.max_timestep = timestep
+        if self.arrival_time is None:
+            self.allocate(grid.shape)
+
+        nrows = grid.shape[0]
+        step = self.tile_rows or nrows
+        for first in range(0, nrows, step):
+            self.register_rows(timestep, grid, slice(first, first + step))
+
+    def register_rows(self, timestep, grid, rows):
+        # Update the recorded grids for a band of rows, in place and
+        # without allocating full size temporaries.
+        grid = grid[rows]
+        size = grid.shape[0]
+        depth = self.depth[:size]
+        mask = self.mask[:size]
+        other_mask = self.other_mask[:size]
+
+        max_seen = self.max_seen[rows]
+        time_of_max = self.time_of_max[rows]
+        first_moment_15m = self.first_moment_15m[rows]
+        arrival_time = self.arrival_time[rows]
+
+        # Depth is the grid, with values under 0.01 set to 0
+        np.copyto(depth, grid)
+        np.less(grid, 0.01, out=mask)
+        np.putmask(depth, mask, 0)
+
+        np.greater(depth, max_seen, out=mask)
+        np.putmask(max_seen, mask, depth)
+        np.putmask(time_of_max, mask, timestep)
+
+        np.greater_equal(grid, 1.5, out=mask)
+        np.equal(first_moment_15m, 0, out=other_mask)
+        np.logical_and(mask, other_mask, out=mask)
+        np.putmask(first_moment_15m, mask, timestep)
+
+        np.greater(depth, 0, out=mask)
+        np.equal(arrival_time, 0, out=other_mask)
+        np.logical_and(mask, other_mask, out=mask)
+        np.putmask(arrival_time, mask, timestep)
+
+    def register_delta(self, timestep, shape, indices, values):
+        # Same as register(), for a grid of which only the cells at
+        # the (unique) flat indices changed since the previous call, see
+        # Flsh.iter_deltas(). Cells that did not change can't change
+        # what is recorded, so only the changed ones are looked at.
+
+        timestep = self.next_timestep(timestep)
 
         if self.arrival_time is None:
-            self.arrival_time = np.zeros(grid.shape, dtype=np.uint)
-            self.time_of_max = np.zeros(grid.shape, dtype=np.uint)
-            self.max_seen = np.zeros(grid.shape, dtype=np.float)
-            self.first_moment_15m = np.zeros(grid.shape, dtype=np.float)
+            self.allocate(shape)
+
+        values = np.where(values < 0.01, 0, values)
+        depths = values.astype(self.DEPTH_TYPE)
 
-        copy = grid.copy()
-        copy[grid < 0.01] = 0
+        # Flat views on the grids
+        max_seen = self.max_seen.ravel()
+        time_of_max = self.time_of_max.ravel()
+        first_moment_15m = self.first_moment_15m.ravel()
+        arrival_time = self.arrival_time.ravel()
 
-        where_greater_than_max = copy > self.max_seen
-        self.max_seen[where_greater_than_max] = copy[where_greater_than_max]
-        self.time_of_max[where_greater_than_max] = timestep
+        where_greater_than_max = depths > max_seen[indices]
+        max_seen[indices[where_greater_than_max]] = (
+            depths[where_greater_than_max])
+        time_of_max[indices[where_greater_than_max]] = timestep
 
-        self.first_moment_15m[
-            (self.first_moment_15m == 0) & (copy >= 1.5)] = timestep
+        first_moment_15m[indices[
+            (first_moment_15m[indices] == 0) & (values >= 1.5)]] = timestep
 
-        where_arrival = (copy > 0) & (self.arrival_time == 0)
-        self.arrival_time[where_arrival] = timestep
+        where_arrival = (values > 0) & (arrival_time[indices] == 0)
+        arrival_time[indices[where_arrival]] = timestep
 
     def save(self):
         # Fix grids
@@ -507,19 +728,19 @@ class GridtaGridtdRecorder(object):
 
         save_to_tiff(
             os.path.join(self.output_dir, 'computed_arrival_time.tiff'),
-            self.arrival_time, self.geotransform)
+            self.arrival_time, self.geotransform, gdal.GDT_UInt16)
 
         save_to_tiff(
             os.path.join(self.output_dir, 'computed_time_of_max.tiff'),
-            self.time_of_max, self.geotransform)
+            self.time_of_max, self.geotransform, gdal.GDT_UInt16)
 
         save_to_tiff(
             os.path.join(self.output_dir, 'computed_difference.tiff'),
-            difference, self.geotransform)
+            difference, self.geotransform, gdal.GDT_UInt16)
 
         save_to_tiff(
             os.path.join(self.output_dir, 'computed_time_15m.tiff'),
-            self.first_moment_15m, self.geotransform)
+            self.first_moment_15m, self.geotransform, gdal.GDT_UInt16)
 
 if __name__ == '__main__':
     pass
@@ -1,8 +1,17 @@
 from django.test import TestCase
 
+import os
+import tempfile
+import zipfile
+import zlib
+
 import mock
+import numpy as np
 
+from flooding_lib import models
 from flooding_lib.tasks import calculate_export_maps
+from flooding_lib.tests.test_models import ResultTypeF
+from flooding_lib.tests.test_models import ScenarioF
 
 
 def cem(attr):
@@ -52,3 +61,324 @@ class TestAllFilesIn(TestCase):
                 calculate_export_maps.all_files_in('/some/file/name'))
 
         self.assertEquals(files, files2)
+
+
+class TestCombiner(TestCase):
+    def setUp(self):
+        self.size_info = calculate_export_maps.SizeInfo(
+            x_min=1000, x_max=1040, y_min=1970, y_max=2000,
+            size_x=4, size_y=3, gridsize=10)
+
+    def test_get_window(self):
+        combiner = calculate_export_maps.Combiner(self.size_info)
+        dataset = mock.MagicMock(RasterXSize=2, RasterYSize=2)
+        dataset.GetGeoTransform.return_value = (
+            1010, 10, 0, 1990, 0, -10)
+        self.assertEquals(combiner.get_window(dataset), (1, 1, 2, 2))
+
+    def test_get_window_outside(self):
+        combiner = calculate_export_maps.Combiner(self.size_info)
+        dataset = mock.MagicMock(RasterXSize=2, RasterYSize=2)
+        dataset.GetGeoTransform.return_value = (
+            2000, 10, 0, 1990, 0, -10)
+        self.assertEquals(combiner.get_window(dataset), None)
+
+    def test_combine_max(self):
+        nodata = calculate_export_maps.NO_DATA_VALUE
+        combiner = calculate_export_maps.Combiner(self.size_info)
+        combined = np.array([nodata, 1, 2, nodata], dtype=np.float64)
+        combiner.combine(
+            combined, np.array([1, nodata, 3, nodata], dtype=np.float64))
+        self.assertEquals(combined.tolist(), [1, 1, 3, nodata])
+
+    def test_combine_min(self):
+        nodata = calculate_export_maps.NO_DATA_VALUE
+        combiner = calculate_export_maps.Combiner(
+            self.size_info, combine_method='min')
+        combined = np.array([nodata, 1, 2, nodata], dtype=np.float64)
+        combiner.combine(
+            combined, np.array([1, nodata, 3, nodata], dtype=np.float64))
+        self.assertEquals(combined.tolist(), [1, 1, 2, nodata])
+
+    def test_combine_or(self):
+        combiner = calculate_export_maps.Combiner(
+            self.size_info, combine_method='or',
+            data_type=calculate_export_maps.gdal.GDT_Byte, nodata=0)
+        combined = np.array([0, 1, 2], dtype=np.uint8)
+        combiner.combine(combined, np.array([4, 0, 1], dtype=np.uint8))
+        self.assertEquals(combined.tolist(), [4, 1, 3])
+
+    def test_spills_over_memory_budget(self):
+        combiner = calculate_export_maps.Combiner(
+            self.size_info,
+            memory_budget=calculate_export_maps.MemoryBudget(100))
+        in_memory = combiner.allocate()
+        spilled = combiner.allocate()
+        self.assertFalse(isinstance(in_memory, np.memmap))
+        self.assertTrue(isinstance(spilled, np.memmap))
+        self.assertEquals(len(combiner.tmp_files), 1)
+        self.assertTrue((spilled == combiner.nodata).all())
+        del spilled
+        combiner.close()
+        self.assertEquals(combiner.tmp_files, [])
+
+    def test_memory_budget_is_shared(self):
+        # Every grid is 96 bytes
+        budget = calculate_export_maps.MemoryBudget(100)
+        combiner = calculate_export_maps.Combiner(
+            self.size_info, memory_budget=budget)
+        other = calculate_export_maps.Combiner(
+            self.size_info, memory_budget=budget)
+        combiner.allocate()
+        self.assertTrue(isinstance(other.allocate(), np.memmap))
+
+        combiner.close()
+        self.assertEquals(budget.nbytes, 0)
+        self.assertFalse(isinstance(other.allocate(), np.memmap))
+        other.close()
+
+    def test_add_window(self):
+        combiner = calculate_export_maps.Combiner(self.size_info)
+        combiner.block_rows = 1
+        combiner.add(3, [((1, 1, 2, 2), np.ones((2, 2)))])
+        combined = combiner.arrays[3]
+        self.assertEquals(combined[1:, 1:3].tolist(), [[1, 1], [1, 1]])
+        self.assertEquals(
+            (combined == calculate_export_maps.NO_DATA_VALUE).sum(), 8)
+
+    def test_add_input_files(self):
+        combiner = calculate_export_maps.Combiner(
+            self.size_info, threads=2, max_grids=1)
+        input_files = [
+            {'dijkringnr': None, 'filename': 1},
+            {'dijkringnr': 7, 'filename': 2},
+            {'dijkringnr': 7, 'filename': 3}]
+        with mock.patch.object(
+            combiner, 'read',
+            side_effect=lambda f: [((0, 0, 4, 3), np.full((3, 4), f))]):
+            combiner.add_input_files(input_files)
+        self.assertEquals(sorted(combiner.arrays), [0, 7])
+        self.assertTrue((combiner.arrays[0] == 1).all())
+        self.assertTrue((combiner.arrays[7] == 3).all())
+
+    def test_add_input_files_raises(self):
+        combiner = calculate_export_maps.Combiner(self.size_info)
+        with mock.patch.object(combiner, 'read', side_effect=IOError):
+            self.assertRaises(
+                IOError, combiner.add_input_files,
+                [{'dijkringnr': 1, 'filename': 1}])
+
+    def test_read_uses_cache(self):
+        cache = calculate_export_maps.InputCache(
+            memory_budget=1000, disk_budget=1000)
+        combiner = calculate_export_maps.Combiner(
+            self.size_info, cache=cache)
+        other = calculate_export_maps.Combiner(self.size_info, cache=cache)
+        grids = [((0, 0, 4, 3), np.zeros((3, 4)))]
+        with mock.patch.object(
+            calculate_export_maps.Combiner, 'reproject_file',
+            return_value=grids) as reproject_file:
+            self.assertEquals(combiner.read('a'), grids)
+            self.assertEquals(other.read('a'), grids)
+        reproject_file.assert_called_once_with('a')
+        cache.close()
+
+
+class TestInputCache(TestCase):
+    def setUp(self):
+        # Every entry is 96 bytes
+        self.cache = calculate_export_maps.InputCache(
+            memory_budget=200, disk_budget=100)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def get(self, key):
+        return self.cache.get(
+            key, lambda: [((0, 0, 4, 3), np.full((3, 4), key))])
+
+    def test_hit(self):
+        self.get(1)
+        self.get(1)
+        self.assertEquals(self.cache.stats['misses'], 1)
+        self.assertEquals(self.cache.stats['hits'], 1)
+
+    def test_least_recently_used_go_to_disk(self):
+        self.get(1)
+        self.get(2)
+        self.get(1)
+        self.get(3)
+        self.assertEquals(list(self.cache.memory), [1, 3])
+        self.assertEquals(list(self.cache.disk), [2])
+        self.assertEquals(self.cache.stats['to_disk'], 1)
+
+        [(window, data)] = self.get(2)
+        self.assertEquals(self.cache.stats['disk_hits'], 1)
+        self.assertTrue((data == 2).all())
+
+    def test_dropped_when_disk_is_full(self):
+        for key in range(4):
+            self.get(key)
+        self.assertEquals(list(self.cache.disk), [1])
+        self.assertEquals(self.cache.stats['dropped'], 1)
+        self.assertEquals(self.cache.disk_bytes, 96)
+
+
+class TestExtents(TestCase):
+    def setUp(self):
+        self.extent = {
+            'x_min': 1000.0, 'x_max': 1040.0,
+            'y_min': 1970.0, 'y_max': 2000.0,
+            'cellsize': 10.0, 'cols': 4, 'rows': 3, 'data_type': 'Float64'}
+
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        self.result = models.Result.objects.create(
+            scenario=ScenarioF.create(), resulttype=ResultTypeF.create(),
+            resultloc=self.filename)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_union_extent(self):
+        other = dict(self.extent, x_max=1100.0, y_min=1900.0)
+        union = calculate_export_maps.union_extent([self.extent, other])
+        self.assertEquals(union['x_max'], 1100.0)
+        self.assertEquals(union['y_min'], 1900.0)
+        self.assertEquals((union['cols'], union['rows']), (10, 10))
+
+    @mock.patch(cem('get_extents'))
+    def test_boundary_smaller_than_gridsize_raises(self, get_extents):
+        get_extents.return_value = [dict(self.extent, x_max=1040.0)]
+        self.assertRaises(
+            ValueError, calculate_export_maps.find_boundary,
+            [{'filename': self.filename}], 50)
+
+    def test_union_extent_empty(self):
+        self.assertEquals(calculate_export_maps.union_extent([]), None)
+
+    def test_uses_stored_extent(self):
+        models.ResultExtent.objects.create(
+            result=self.result, mtime=os.path.getmtime(self.filename),
+            **self.extent)
+        with mock.patch(cem('read_extent')) as read_extent:
+            extents = calculate_export_maps.get_extents([
+                    {'filename': self.filename, 'result': self.result}])
+        self.assertFalse(read_extent.called)
+        self.assertEquals(extents, [self.extent])
+
+    def test_stores_missing_extent(self):
+        with mock.patch(
+            cem('read_extent'), return_value=self.extent) as read_extent:
+            for i in range(2):
+                extents = calculate_export_maps.get_extents([
+                        {'filename': self.filename, 'result': self.result}])
+        self.assertEquals(read_extent.call_count, 1)
+        self.assertEquals(extents, [self.extent])
+        self.assertEquals(self.result.extent.cols, 4)
+
+    def test_reads_changed_file(self):
+        models.ResultExtent.objects.create(
+            result=self.result, mtime=0, **self.extent)
+        changed = dict(self.extent, cols=5)
+        with mock.patch(cem('read_extent'), return_value=changed):
+            extents = calculate_export_maps.get_extents([
+                    {'filename': self.filename, 'result': self.result}])
+        self.assertEquals(extents, [changed])
+        self.assertEquals(
+            models.ResultExtent.objects.get(result=self.result).cols, 5)
+
+
+class TestExportZip(TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_ascii_header(self):
+        header = calculate_export_maps.get_ascii_header(
+            (3, 4), (1000.0, 10.0, 0.0, 2000.0, 0.0, -10.0), -999)
+        self.assertTrue(isinstance(header, bytes))
+        self.assertEquals(header.split(), [
+                b'ncols', b'4', b'nrows', b'3', b'xllcorner', b'1000.0',
+                b'yllcorner', b'1970.0', b'cellsize', b'10.0',
+                b'NODATA_value', b'-999'])
+
+    def test_deflated_chunks_form_one_stream(self):
+        chunks = [b'1 2 3\n' * 100, b'4 5 6\n' * 10, b'7 8 9\n']
+        deflated = b''.join(
+            calculate_export_maps.deflate(chunk, i == len(chunks) - 1)
+            for i, chunk in enumerate(chunks))
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.assertEquals(
+            decompressor.decompress(deflated), b''.join(chunks))
+        self.assertEquals(decompressor.unused_data, b'')
+
+    def test_write_chunks(self):
+        chunks = [b'header\n', b'1 2 3\n' * 100, b'4 5 6\n']
+        export_zip = calculate_export_maps.ExportZip(self.filename)
+        export_zip.writestr('meta.json', b'{}')
+        export_zip.write_chunks('grid_1.asc', [
+                (chunk, calculate_export_maps.deflate(
+                        chunk, i == len(chunks) - 1))
+                for i, chunk in enumerate(chunks)])
+        export_zip.close()
+
+        archive = zipfile.ZipFile(self.filename)
+        self.assertEquals(archive.testzip(), None)
+        self.assertEquals(archive.read('grid_1.asc'), b''.join(chunks))
+        self.assertEquals(archive.read('meta.json'), b'{}')
+
+
+    def test_write_chunks_zip64(self):
+        chunks = [b'header\n', b'1 2 3\n' * 100, b'4 5 6\n']
+        with mock.patch('zipfile.ZIP64_LIMIT', 100):
+            export_zip = calculate_export_maps.ExportZip(self.filename)
+            export_zip.write_chunks('grid_1.asc', [
+                    (chunk, calculate_export_maps.deflate(
+                            chunk, i == len(chunks) - 1))
+                    for i, chunk in enumerate(chunks)])
+            export_zip.writestr('meta.json', b'{}')
+            export_zip.close()
+
+            archive = zipfile.ZipFile(self.filename)
+            self.assertEquals(archive.testzip(), None)
+            self.assertEquals(
+                archive.getinfo('grid_1.asc').file_size, 613)
+            self.assertEquals(archive.read('grid_1.asc'), b''.join(chunks))
+            self.assertEquals(archive.read('meta.json'), b'{}')
+
+    def test_grid_without_columns_raises(self):
+        export_zip = calculate_export_maps.ExportZip(self.filename)
+        self.assertRaises(
+            ValueError, export_zip.write_grid, 'grid_1.asc',
+            np.zeros((3, 0)), (0, 10, 0, 0, 0, -10), -999)
+        export_zip.close()
+
+
+class TestCalculateExportMaps(TestCase):
+    @mock.patch(cem('InputCache'))
+    @mock.patch(cem('ExportRun'))
+    def test_cleans_up_when_a_product_fails(self, ExportRun, InputCache):
+        export_run = ExportRun.objects.get.return_value
+        export_run.export_max_waterdepth = True
+        export_run.export_possibly_flooded = False
+
+        created = []
+        mkstemp = tempfile.mkstemp
+
+        def record_mkstemp():
+            fd, path = mkstemp()
+            created.append(path)
+            return fd, path
+
+        with mock.patch('tempfile.mkstemp', side_effect=record_mkstemp):
+            with mock.patch(cem('calc_max_waterdepths'), side_effect=IOError):
+                self.assertRaises(
+                    IOError, calculate_export_maps.calculate_export_maps, 1)
+
+        self.assertTrue(InputCache.return_value.close.called)
+        self.assertEquals(len(created), 1)
+        self.assertFalse(os.path.exists(created[0]))
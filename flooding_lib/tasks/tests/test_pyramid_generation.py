@@ -0,0 +1,73 @@
+import numpy as np
+
+from django.test import TestCase
+
+from flooding_lib.tasks import pyramid_generation
+
+
+class TestGridtaGridtdRecorder(TestCase):
+    def test_register_delta_same_as_register(self):
+        dense = pyramid_generation.GridtaGridtdRecorder(None, None, 0)
+        sparse = pyramid_generation.GridtaGridtdRecorder(None, None, 0)
+
+        grid = np.zeros((10, 10))
+        for timestep in range(20):
+            indices = np.unique(np.random.randint(0, grid.size, 15))
+            grid.flat[indices] = np.random.random(indices.size) * 2
+
+            dense.register(timestep, grid)
+            sparse.register_delta(
+                timestep, grid.shape, indices, grid.take(indices))
+
+        for name in ('max_seen', 'time_of_max',
+                     'first_moment_15m', 'arrival_time'):
+            self.assertTrue(
+                (getattr(dense, name) == getattr(sparse, name)).all())
+
+    def test_tiles_same_as_whole_grid(self):
+        whole = pyramid_generation.GridtaGridtdRecorder(None, None, 0)
+        tiled = pyramid_generation.GridtaGridtdRecorder(
+            None, None, 0, tile_rows=3)
+
+        for timestep in range(20):
+            grid = np.random.random((10, 7)) * 2 * (timestep % 3)
+            whole.register(timestep, grid)
+            tiled.register(timestep, grid)
+
+        for name in ('max_seen', 'time_of_max',
+                     'first_moment_15m', 'arrival_time'):
+            self.assertTrue(
+                (getattr(whole, name) == getattr(tiled, name)).all())
+        self.assertEquals(tiled.depth.shape, (3, 7))
+
+    def test_compact_types(self):
+        recorder = pyramid_generation.GridtaGridtdRecorder(None, None, 0)
+        recorder.register(0, np.ones((2, 2)))
+        self.assertEquals(recorder.arrival_time.dtype, np.uint16)
+        self.assertEquals(recorder.max_seen.dtype, np.float32)
+
+    def test_too_many_timesteps(self):
+        recorder = pyramid_generation.GridtaGridtdRecorder(None, None, 0)
+        self.assertRaises(
+            ValueError, lambda: recorder.register(65535, np.ones((2, 2))))
+
+
+class TestInBackground(TestCase):
+    def test_yields_items_in_order(self):
+        self.assertEquals(
+            list(pyramid_generation.in_background(iter(range(100)), 3)),
+            range(100))
+
+    def test_raises_exceptions_of_iterable(self):
+        def iterable():
+            yield 1
+            raise ValueError()
+
+        items = pyramid_generation.in_background(iterable(), 3)
+        self.assertEquals(next(items), 1)
+        self.assertRaises(ValueError, lambda: next(items))
+
+    def test_consumer_can_stop_early(self):
+        items = pyramid_generation.in_background(iter(range(100)), 3)
+        self.assertEquals(next(items), 0)
+        items.close()
@@ -165,7 +165,8 @@ class ExportRun(models.Model):
         Return a list of dictionaries, containing:
             'scenario': a scenario object,
             'dijkringnr': a region's dijkring number,
-            'filename': the file containing this result type
+            'filename': the file containing this result type,
+            'result': the result object
 
         For each of this object's scenarios, for each of the regions
         of those scenarios, for the given result type (name or
@@ -187,7 +188,8 @@ class ExportRun(models.Model):
                     result.append({
                         'scenario': s,
                         'dijkringnr': r.dijkringnr,
-                        'filename': os.path.join(dest_dir, rs.resultloc)
+                        'filename': os.path.join(dest_dir, rs.resultloc),
+                        'result': rs,
                     })
 
         return result
@@ -0,0 +1,168 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+
+"""Animation cubes: all frames of an animation in a single GeoTIFF.
+
+Frame i is stored as Float32 band i + 1 of a tiled, compressed, band
+interleaved GeoTIFF. The band description holds the timestamp of the
+frame, so the bands double as the frame index. Large cubes get
+overviews for zoomed out reads. Reading any frame or pixel goes
+through one dataset, which is kept open between requests."""
+
+# Python 3 is coming
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import logging
+import os
+
+from osgeo import gdal
+import numpy as np
+
+from gislib import pyramids
+
+logger = logging.getLogger(__name__)
+
+FILENAME = b'animation.tiff'
+
+DRIVER = gdal.GetDriverByName(b'gtiff')
+OPTIONS = [
+    'BIGTIFF=IF_SAFER', 'TILED=YES', 'SPARSE_OK=YES', 'INTERLEAVE=BAND',
+    'COMPRESS=DEFLATE', 'PREDICTOR=3',  # floating point predictor
+    'NUM_THREADS=ALL_CPUS',  # compress blocks in parallel
+]
+
+# Overviews are built until they are smaller than this, so that
+# zoomed out views of large animations don't read every pixel.
+OVERVIEW_SIZE = 512
+
+# Open cubes, shared by all animations
+datasets = pyramids.DatasetPool(size=16)
+
+
+def get_overview_factors(rows, cols):
+    """Return list of overview factors for a frame of this size."""
+    factors = []
+    factor = 2
+    while max(rows, cols) // factor >= OVERVIEW_SIZE:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+class Writer(object):
+    """Collect frames and write them as a cube on close().
+
+    The number of bands of a GeoTIFF is fixed when it is created, and
+    the number of frames is not known up front. So appended frames go
+    to a raw float32 scratch file next to the cube first. Callers that
+    fail before close() should call abort(), so that the scratch file
+    doesn't stay behind."""
+
+    def __init__(self, path, geotransform, projection=None):
+        self.path = path
+        self.geotransform = geotransform
+        self.projection = projection
+
+        self.shape = None
+        self.timestamps = []
+        self.scratch = open(path + b'.frames', 'wb')
+
+    def append(self, array, timestamp=None):
+        if self.shape is None:
+            self.shape = array.shape
+        elif array.shape != self.shape:
+            raise ValueError(
+                "Frame has shape {}, earlier frames have {}."
+                .format(array.shape, self.shape))
+
+        array.astype(np.float32).tofile(self.scratch)
+        self.timestamps.append(timestamp)
+
+    def close(self):
+        """Write the cube and return the number of frames."""
+        self.scratch.close()
+        try:
+            if self.timestamps:
+                self._write()
+        finally:
+            self.abort()  # Only what the write left behind is removed
+        return len(self.timestamps)
+
+    def abort(self):
+        """Remove the scratch file and a partially written cube. Does
+        nothing after a successful close()."""
+        self.scratch.close()
+        for path in (self.scratch.name, self.path + b'.part'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _write(self):
+        rows, cols = self.shape
+        frames = np.memmap(
+            self.scratch.name, dtype=np.float32, mode='r',
+            shape=(len(self.timestamps), rows, cols))
+
+        # Write next to the cube first, so that readers never see a
+        # partial cube.
+        tmp_path = self.path + b'.part'
+        dataset = DRIVER.Create(
+            tmp_path, cols, rows, len(self.timestamps), gdal.GDT_Float32,
+            OPTIONS)
+        dataset.SetGeoTransform(self.geotransform)
+        if self.projection is not None:
+            dataset.SetProjection(self.projection)
+
+        for i, timestamp in enumerate(self.timestamps):
+            band = dataset.GetRasterBand(i + 1)
+            band.SetNoDataValue(0.0)
+            if timestamp is not None:
+                band.SetDescription(repr(timestamp))
+            band.WriteArray(frames[i])
+
+        overviews = get_overview_factors(rows, cols)
+        if overviews:
+            dataset.BuildOverviews(b'NEAREST', overviews)
+
+        dataset = None  # Close it
+        del frames
+        os.rename(tmp_path, self.path)
+        logger.debug("Wrote {} frames to {}.".format(
+            len(self.timestamps), self.path))
+
+
+def read_band(band, window=None, size=None):
+    """Return data of a band. Window is an optional (xoff, yoff, xsize,
+    ysize) tuple in pixels, size an optional (width, height) to read it
+    at. Smaller sizes are read decimated, from overviews if there are
+    any."""
+    if window is None:
+        window = (0, 0, band.XSize, band.YSize)
+    if size is None:
+        return band.ReadAsArray(*window)
+    return band.ReadAsArray(*(tuple(window) + tuple(size)))
+
+
+def read_frame(path, i, window=None, size=None):
+    """Return frame i as a float32 array. See read_band for window and
+    size."""
+    with datasets.borrow(path) as dataset:
+        return read_band(dataset.GetRasterBand(i + 1), window, size)
+
+
+def read_pixel(path, u, v):
+    """Return a float32 array with the value of pixel (u, v) in every
+    frame."""
+    with datasets.borrow(path) as dataset:
+        return dataset.ReadAsArray(u, v, 1, 1).reshape(-1)
+
+
+def get_timestamps(path):
+    """Return list of frame timestamps, None where unknown."""
+    with datasets.borrow(path) as dataset:
+        descriptions = [
+            dataset.GetRasterBand(i + 1).GetDescription()
+            for i in range(dataset.RasterCount)]
+    return [float(d) if d else None for d in descriptions]
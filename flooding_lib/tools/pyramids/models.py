@@ -11,11 +11,14 @@ from __future__ import print_function
 from __future__ import absolute_import
 from __future__ import division
 
+import io
 import logging
 import os
 import shutil
+import threading
+
+from multiprocessing.pool import ThreadPool
 
-from matplotlib import colors
 from PIL import Image
 from osgeo import gdal
 import numpy as np
@@ -25,8 +28,10 @@ from django.db import models
 from flooding_lib.fields import UUIDField, JSONField
 
 from gislib import pyramids
+from raster_server.cache import TileCache
 
-from flooding_lib.util.colormap import get_mpl_cmap
+from flooding_lib.tools.pyramids import cube
+from flooding_lib.util.colormap import get_lut
 
 
 logger = logging.getLogger(__name__)
@@ -35,6 +40,32 @@ SUBDIR_DEPTH = 6  # Number of characters of a UUID to use as directories
 
 LIMIT = 0.01  # Values below this are considered to be zero / nodata
 
+# Rendered whole animation frames are kept in a byte-bounded LRU cache
+# of ANIMATION_FRAME_CACHE_SIZE bytes (setting). When frames are played
+# in sequence, the next frames are rendered in the background on a
+# small pool of threads.
+FRAME_CACHE_SIZE = getattr(
+    settings, 'ANIMATION_FRAME_CACHE_SIZE', 256 * 1024 * 1024)
+PREFETCH_FRAMES = 5
+PREFETCH_THREADS = 2
+
+frame_cache = TileCache(max_bytes=FRAME_CACHE_SIZE)
+prefetcher = None
+prefetching = set()  # Keys of frames that are being rendered
+prefetching_lock = threading.Lock()
+
+
+def get_frame_cache():
+    return frame_cache
+
+
+def get_prefetcher():
+    global prefetcher
+    with prefetching_lock:
+        if prefetcher is None:
+            prefetcher = ThreadPool(PREFETCH_THREADS)
+        return prefetcher
+
 
 class Raster(models.Model):
     uuid = UUIDField(unique=True)
@@ -83,10 +114,12 @@ class Raster(models.Model):
 
 
 class Animation(models.Model):
-    """We don't store animations in pyramids anymore, but as
-    individual geotiffs.  Filenames are of the form 'dataset0001.tiff'
-    and they are stored in the results directory (same place as the
-    old .pngs).
+    """We don't store animations in pyramids anymore, but as a single
+    multi-band geotiff, see cube.py. It is called 'animation.tiff' and
+    stored in the results directory (same place as the old .pngs).
+    Animations generated before that have individual geotiffs of the
+    form 'dataset0001.tiff' in the same directory, those are still
+    read.
 
     This model keeps metadata of the animation. We _assume_ all frames
     are RD projection (28992).
@@ -102,15 +135,108 @@ class Animation(models.Model):
     geotransform = JSONField()
     basedir = models.TextField()
 
-    def get_dataset_path(self, i):
+    def check_frame(self, i):
         if not (0 <= i < self.frames):
             raise ValueError(
                 "i must be a valid frame number, is {}, num frames is {}."
                 .format(i, self.frames))
 
+    def get_dataset_path(self, i):
+        self.check_frame(i)
         return os.path.join(
             self.basedir.encode('utf8'), b'dataset{:04d}.tiff'.format(i))
 
+    def get_cube_path(self):
+        return os.path.join(self.basedir.encode('utf8'), cube.FILENAME)
+
+    def read_frame(self, i, window=None, size=None):
+        """Return frame i as an array, or None if it can't be read.
+        Window is an optional (xoff, yoff, xsize, ysize) tuple, size an
+        optional (width, height) to read it at."""
+        self.check_frame(i)
+
+        cube_path = self.get_cube_path()
+        if os.path.exists(cube_path):
+            return cube.read_frame(cube_path, i, window=window, size=size)
+
+        dataset = gdal.Open(self.get_dataset_path(i))
+        if dataset is None:
+            return None
+        return cube.read_band(dataset.GetRasterBand(1), window, size)
+
+    def read_view(self, i, bbox, size):
+        """Return frame i as an array of size (width, height) covering
+        bbox (x1, y1, x2, y2), or None if it can't be read. Coordinates
+        are in the projection of the animation, pixels outside the
+        animation are 0.
+
+        Only the window of the frame that is inside bbox is read, at no
+        more than the resolution of the result."""
+        width, height = size
+        x1, y1, x2, y2 = bbox
+        p, a, b, q, c, d = self.get_geotransform()  # Assume north up
+
+        # Frame pixels at the centers of the result pixels
+        us = np.floor((x1 - p + (np.arange(width) + 0.5) *
+                       (x2 - x1) / width) / a).astype(int)
+        vs = np.floor((y2 - q - (np.arange(height) + 0.5) *
+                       (y2 - y1) / height) / d).astype(int)
+        uvalid = (0 <= us) & (us < self.cols)
+        vvalid = (0 <= vs) & (vs < self.rows)
+
+        result = np.zeros((height, width), dtype=np.float32)
+        if not (uvalid.any() and vvalid.any()):
+            return result
+
+        us, vs = us[uvalid], vs[vvalid]
+        xoff, yoff = int(us.min()), int(vs.min())
+        xsize, ysize = int(us.max()) + 1 - xoff, int(vs.max()) + 1 - yoff
+        bufsize = min(xsize, int(us.size)), min(ysize, int(vs.size))
+
+        data = self.read_frame(
+            i, window=(xoff, yoff, xsize, ysize), size=bufsize)
+        if data is None:
+            return None
+
+        cols = (us - xoff) * bufsize[0] // xsize
+        rows = (vs - yoff) * bufsize[1] // ysize
+        result[np.ix_(vvalid, uvalid)] = data[np.ix_(rows, cols)]
+        return result
+
+    def point_timeseries(self, x, y):
+        """Return an array with the value at (x, y) in every frame, or
+        None if the point is outside the animation. Coordinates are in
+        the projection of the animation."""
+        pixel = self.get_pixel(x, y)
+        if pixel is None:
+            return None
+        u, v = pixel
+
+        cube_path = self.get_cube_path()
+        if os.path.exists(cube_path):
+            return cube.read_pixel(cube_path, u, v)
+
+        values = np.zeros(self.frames, dtype=np.float32)
+        for i in range(self.frames):
+            data = self.read_frame(i, window=(u, v, 1, 1))
+            if data is not None:
+                values[i] = data[0, 0]
+        return values
+
+    def get_pixel(self, x, y):
+        """Return (u, v) pixel indices of point (x, y), or None if the
+        point is outside the animation."""
+        p, a, b, q, c, d = self.get_geotransform()
+        minv = np.linalg.inv([[a, b], [c, d]])
+        u, v = np.dot(minv, [x - p, y - q])
+
+        u = int(np.floor(u))
+        v = int(np.floor(v))
+
+        if not ((0 <= u < self.cols) and (0 <= v < self.rows)):
+            return None
+        return u, v
+
     @property
     def bounds(self):
 
@@ -138,35 +264,101 @@ class Animation(models.Model):
 
     def save_image_to_response(
             self, response, framenr=0,
-            colormap=None, maxvalue=None):
+            colormap=None, maxvalue=None, bbox=None, size=None):
+        response['Content-type'] = 'image/png'
+        response.write(self.get_frame_image(
+            framenr, colormap, maxvalue, bbox, size))
+
+    def get_frame_image(
+            self, framenr=0, colormap=None, maxvalue=None,
+            bbox=None, size=None):
+        """Return png data of a frame, from the frame cache if possible.
+        With bbox and size, only that view of the frame is rendered, see
+        read_view.
+
+        Views are rendered every time, since the bboxes of panning and
+        zooming clients hardly ever repeat. If the previous whole frame
+        is in the cache as well, the animation is probably being played,
+        and the next PREFETCH_FRAMES frames are rendered in the
+        background."""
+        self.check_frame(framenr)
         if colormap is None:
             colormap = 'PuBu'
         if maxvalue is None:
             maxvalue = self.maxvalue
-
-        dataset = gdal.Open(self.get_dataset_path(framenr))
-        colormap = get_mpl_cmap(colormap)
+        maxvalue = float(maxvalue)
+        if bbox is not None:
+            bbox = tuple(float(x) for x in bbox)
+            size = tuple(int(x) for x in size)
+            return self.render_frame(framenr, colormap, maxvalue, bbox, size)
+
+        cache = get_frame_cache()
+        key = self.get_frame_key(framenr, colormap, maxvalue)
+        content = cache.get(key)
+        if content is None:
+            content = self.render_frame(framenr, colormap, maxvalue)
+            cache.set(key, content)
+
+        previous_key = self.get_frame_key(framenr - 1, colormap, maxvalue)
+        if framenr > 0 and cache.get(previous_key) is not None:
+            self.prefetch_frames(framenr + 1, colormap, maxvalue)
+
+        return content
+
+    def get_frame_key(self, framenr, colormap, maxvalue):
+        return 'animation_frame:{}:{}:{}:{!r}'.format(
+            self.id, framenr, colormap, maxvalue)
+
+    def render_frame(
+            self, framenr, colormap, maxvalue, bbox=None, size=None):
+        """Return png data of a frame, or of the view of it given by
+        bbox and size."""
+        lut = get_lut(colormap)
 
         # Colormaps from CSVs have a fixed maxvalue, which is in the
         # attribute 'csv_max_value'.
-        maxvalue = getattr(colormap, 'csv_max_value', maxvalue)
+        if lut.csv_max_value is not None:
+            maxvalue = lut.csv_max_value
 
         # Get data as masked array
-        data = np.ma.masked_less(
-            dataset.GetRasterBand(1).ReadAsArray(), LIMIT, copy=False)
-
-        # Normalize
-        normalize = colors.Normalize(vmin=0, vmax=maxvalue, clip=True)
+        if bbox is None:
+            data = self.read_frame(framenr)
+        else:
+            data = self.read_view(framenr, bbox, size)
+        data = np.ma.masked_less(data, LIMIT, copy=False)
 
         # Apply colormap
-        rgba = colormap(normalize(data), bytes=True)
-
-        # Turn into PIL image
-        image = Image.fromarray(rgba)
-
-        # Save into response
-        response['Content-type'] = 'image/png'
-        image.save(response, 'png')
+        rgba = lut.apply(data, vmin=0, vmax=maxvalue)
+
+        # Turn into PIL image and encode
+        buf = io.BytesIO()
+        Image.fromarray(rgba).save(buf, 'png')
+        return buf.getvalue()
+
+    def prefetch_frames(self, first, colormap, maxvalue):
+        """Render whole frames from first on into the cache, in the
+        background."""
+        last = min(first + PREFETCH_FRAMES, self.frames)
+        for framenr in range(first, last):
+            key = self.get_frame_key(framenr, colormap, maxvalue)
+            with prefetching_lock:
+                if key in prefetching:
+                    continue
+                prefetching.add(key)
+            get_prefetcher().apply_async(
+                self._prefetch_frame, (key, framenr, colormap, maxvalue))
+
+    def _prefetch_frame(self, key, framenr, *args):
+        try:
+            cache = get_frame_cache()
+            if cache.get(key) is None:
+                cache.set(key, self.render_frame(framenr, *args))
+        except Exception:
+            logger.exception("Prefetching frame {} of {} failed.".format(
+                    framenr, self))
+        finally:
+            with prefetching_lock:
+                prefetching.discard(key)
 
     def get_geotransform(self):
         return [float(g) for g in self.geotransform['geotransform']]
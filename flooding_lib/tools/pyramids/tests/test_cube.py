@@ -0,0 +1,105 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+
+# Python 3 is coming
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import shutil
+import tempfile
+
+import mock
+import numpy as np
+
+from django.test import TestCase
+
+from flooding_lib.tools.pyramids import cube
+
+GEOTRANSFORM = [100000.0, 25.0, 0.0, 400000.0, 0.0, -25.0]
+
+
+class TestCube(TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.path = os.path.join(
+            self.data_dir.encode('utf8'), cube.FILENAME)
+
+    def tearDown(self):
+        cube.datasets.clear()
+        shutil.rmtree(self.data_dir)
+
+    def write(self, frames):
+        writer = cube.Writer(self.path, GEOTRANSFORM)
+        for i in range(frames):
+            writer.append(np.full((3, 4), i, dtype=np.float64), i / 2)
+        return writer.close()
+
+    def test_writes_one_file(self):
+        self.assertEquals(self.write(3), 3)
+        self.assertEquals(os.listdir(self.data_dir), [cube.FILENAME])
+
+    def test_no_frames_no_cube(self):
+        self.assertEquals(self.write(0), 0)
+        self.assertEquals(os.listdir(self.data_dir), [])
+
+    def test_read_frame(self):
+        self.write(3)
+        frame = cube.read_frame(self.path, 2)
+        self.assertEquals(frame.dtype, np.float32)
+        self.assertEquals(frame.shape, (3, 4))
+        self.assertTrue((frame == 2).all())
+
+    def test_read_window(self):
+        self.write(3)
+        frame = cube.read_frame(self.path, 1, window=(1, 1, 2, 1))
+        self.assertEquals(frame.shape, (1, 2))
+
+    def test_read_pixel(self):
+        self.write(3)
+        self.assertEquals(
+            cube.read_pixel(self.path, 3, 2).tolist(), [0, 1, 2])
+
+    def test_timestamps(self):
+        self.write(3)
+        self.assertEquals(cube.get_timestamps(self.path), [0, 0.5, 1])
+
+    def test_raises_on_other_shape(self):
+        writer = cube.Writer(self.path, GEOTRANSFORM)
+        writer.append(np.zeros((3, 4)))
+        self.assertRaises(
+            ValueError, lambda: writer.append(np.zeros((4, 3))))
+        writer.close()
+
+    def test_abort_removes_scratch_file(self):
+        writer = cube.Writer(self.path, GEOTRANSFORM)
+        writer.append(np.zeros((3, 4)))
+        writer.abort()
+        self.assertEquals(os.listdir(self.data_dir), [])
+
+    def test_failed_write_removes_partial_cube(self):
+        def write(writer):
+            open(writer.path + b'.part', 'w').close()
+            raise IOError("Disk full")
+
+        with mock.patch.object(cube.Writer, '_write', write):
+            self.assertRaises(IOError, self.write, 3)
+        self.assertEquals(os.listdir(self.data_dir), [])
+
+    def test_read_frame_decimated(self):
+        self.write(2)
+        frame = cube.read_frame(self.path, 1, window=(0, 0, 4, 2),
+                                size=(2, 1))
+        self.assertEquals(frame.shape, (1, 2))
+        self.assertTrue((frame == 1).all())
+
+
+class TestOverviewFactors(TestCase):
+    def test_small(self):
+        self.assertEquals(cube.get_overview_factors(3, 4), [])
+
+    def test_large(self):
+        self.assertEquals(
+            cube.get_overview_factors(1000, 4096), [2, 4, 8])
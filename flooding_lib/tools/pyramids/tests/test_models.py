@@ -1,3 +1,7 @@
+import mock
+import numpy as np
+
+from django.core.cache import cache
 from django.test import TestCase
 
 from flooding_lib.tools.pyramids import models
@@ -11,3 +15,132 @@ class TestRaster(TestCase):
             raster.uuid_parts(),
             ['4', 'a', '8', '0', '2', 'a', 'd90241447495dcf93e01915b86']
             )
+
+
+class TestAnimation(TestCase):
+    def setUp(self):
+        self.animation = models.Animation(
+            cols=4, rows=3, geotransform={
+                'geotransform': [1000, 10, 0, 2000, 0, -10]})
+
+    def test_get_pixel(self):
+        self.assertEquals(self.animation.get_pixel(1015, 1975), (1, 2))
+
+    def test_get_pixel_outside(self):
+        self.assertEquals(self.animation.get_pixel(995, 1975), None)
+        self.assertEquals(self.animation.get_pixel(1015, 2005), None)
+
+    def test_point_timeseries_outside(self):
+        self.assertEquals(self.animation.point_timeseries(0, 0), None)
+
+    def test_read_view_whole(self):
+        data = np.arange(12, dtype=np.float32).reshape(3, 4)
+        with mock.patch.object(
+                self.animation, 'read_frame',
+                return_value=data) as read_frame:
+            view = self.animation.read_view(
+                0, (1000, 1970, 1040, 2000), (4, 3))
+        read_frame.assert_called_once_with(
+            0, window=(0, 0, 4, 3), size=(4, 3))
+        self.assertTrue((view == data).all())
+
+    def test_read_view_partly_outside(self):
+        data = np.arange(1, 7, dtype=np.float32).reshape(3, 2)
+        with mock.patch.object(
+                self.animation, 'read_frame',
+                return_value=data) as read_frame:
+            view = self.animation.read_view(
+                0, (980, 1970, 1020, 2000), (4, 3))
+        read_frame.assert_called_once_with(
+            0, window=(0, 0, 2, 3), size=(2, 3))
+        self.assertTrue((view[:, :2] == 0).all())
+        self.assertTrue((view[:, 2:] == data).all())
+
+    def test_read_view_decimated(self):
+        data = np.ones((1, 2), dtype=np.float32)
+        with mock.patch.object(
+                self.animation, 'read_frame',
+                return_value=data) as read_frame:
+            view = self.animation.read_view(
+                0, (1000, 1990, 1040, 2000), (2, 1))
+        read_frame.assert_called_once_with(
+            0, window=(1, 0, 3, 1), size=(2, 1))
+        self.assertEquals(view.shape, (1, 2))
+
+    def test_read_view_outside(self):
+        with mock.patch.object(self.animation, 'read_frame') as read_frame:
+            view = self.animation.read_view(
+                0, (0, 0, 100, 100), (4, 3))
+        self.assertFalse(read_frame.called)
+        self.assertFalse(view.any())
+
+
+class TestFrameCache(TestCase):
+    def setUp(self):
+        self.animation = models.Animation(id=1, frames=10, maxvalue=1.0)
+        self.cache = cache
+        self.cache.clear()
+        patcher = mock.patch(
+            'flooding_lib.tools.pyramids.models.get_frame_cache',
+            return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_renders_once(self):
+        with mock.patch.object(
+                self.animation, 'render_frame',
+                return_value=b'png') as render_frame:
+            self.animation.get_frame_image(3, 'PuBu', '2.0')
+            content = self.animation.get_frame_image(3, 'PuBu', 2)
+        self.assertEquals(content, b'png')
+        render_frame.assert_called_once_with(3, 'PuBu', 2.0)
+
+    def test_views_are_not_cached(self):
+        with mock.patch.object(
+                self.animation, 'render_frame',
+                return_value=b'png') as render_frame:
+            for i in range(2):
+                self.animation.get_frame_image(
+                    3, 'PuBu', 2.0, bbox=(0, 0, 10, 10), size=(5, 5))
+                self.animation.get_frame_image(
+                    4, 'PuBu', 2.0, bbox=(0, 0, 10, 10), size=(5, 5))
+        self.assertEquals(render_frame.call_count, 4)
+        self.assertIsNone(self.cache.get(
+            self.animation.get_frame_key(3, 'PuBu', 2.0)))
+
+    def test_key_depends_on_colormap_and_maxvalue(self):
+        self.assertNotEquals(
+            self.animation.get_frame_key(3, 'PuBu', 2.0),
+            self.animation.get_frame_key(3, 'jet', 2.0))
+        self.assertNotEquals(
+            self.animation.get_frame_key(3, 'PuBu', 2.0),
+            self.animation.get_frame_key(3, 'PuBu', 3.0))
+
+    def test_invalid_frame(self):
+        self.assertRaises(
+            ValueError, self.animation.get_frame_image, 10)
+
+    def test_prefetch_on_sequential_access(self):
+        with mock.patch.object(
+                self.animation, 'render_frame', return_value=b'png'):
+            with mock.patch.object(
+                    self.animation, 'prefetch_frames') as prefetch_frames:
+                self.animation.get_frame_image(3)
+                self.assertFalse(prefetch_frames.called)
+                self.animation.get_frame_image(4)
+        prefetch_frames.assert_called_once_with(5, 'PuBu', 1.0)
+
+    def test_prefetch_fills_cache(self):
+        with mock.patch.object(
+                self.animation, 'render_frame', return_value=b'png'):
+            with mock.patch(
+                    'flooding_lib.tools.pyramids.models.get_prefetcher'
+            ) as get_prefetcher:
+                # Run "in the background" right away
+                get_prefetcher.return_value.apply_async.side_effect = (
+                    lambda f, args: f(*args))
+                self.animation.prefetch_frames(8, 'PuBu', 1.0)
+        for framenr in (8, 9):
+            self.assertEquals(self.cache.get(
+                self.animation.get_frame_key(framenr, 'PuBu', 1.0)), b'png')
+        self.assertFalse(models.prefetching)
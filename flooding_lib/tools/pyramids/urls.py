@@ -9,5 +9,7 @@ from . import views
 urlpatterns = [
     url(r'^pyramid_parameters/$', views.pyramid_parameters, name='pyramids_parameters'),
     url(r'^pyramid_value/$', views.pyramid_value, name='pyramid_value'),
-    url(r'^animation_value/$', views.animation_value, name='animation_value')
+    url(r'^animation_value/$', views.animation_value, name='animation_value'),
+    url(r'^animation_timeseries/$', views.animation_timeseries,
+        name='animation_timeseries'),
 ]
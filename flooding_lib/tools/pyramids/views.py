@@ -2,10 +2,6 @@
 
 import logging
 
-from osgeo import gdal
-from osgeo import gdal_array
-import numpy as np
-
 from django.http import Http404
 from django.views.decorators.http import require_GET
 
@@ -128,23 +124,48 @@ def animation_value(request):
         return JSONResponse({})
 
 
-def point_from_dataset(animation, framenr, point):
-    x, y = point
-    p, a, b, q, c, d = animation.get_geotransform()
-    minv = np.linalg.inv([[a, b], [c, d]])
-    u, v = np.dot(minv, [x - p, y - q])
+@require_GET
+def animation_timeseries(request):
+    """Get the values in all frames of an animation at some lat/lon
+    coordinate, for graphing them over time. Values below LIMIT are
+    returned as 0."""
+    presentationlayer_id = request.GET.get('presentationlayer_id')
+    x = request.GET.get('lon')  # In Google
+    y = request.GET.get('lat')
 
-    u = int(u)
-    v = int(v)
+    if None in (presentationlayer_id, x, y):
+        raise Http404()
+
+    result, presentation_layer = get_result_by_presentationlayer_id(
+        presentationlayer_id, return_layer=True)
+    unit = presentation_layer.presentationtype.unit
+
+    animation = result.animation
 
-    if not ((0 <= u < animation.cols) and (0 <= v < animation.rows)):
+    if animation is None:
+        return JSONResponse({})
+
+    rd_x, rd_y = geo.google_to_rd(x, y)
+
+    values = animation.point_timeseries(rd_x, rd_y)
+
+    if values is None:
+        # Outside animation
+        return JSONResponse({})
+
+    values[values < LIMIT] = 0
+    return JSONResponse({'values': values.tolist(), 'unit': unit})
+
+
+def point_from_dataset(animation, framenr, point):
+    pixel = animation.get_pixel(*point)
+    if pixel is None:
         # Outside animation
         return None
+    u, v = pixel
 
-    dataset = gdal.Open(animation.get_dataset_path(framenr))
-    if dataset is None:
+    data = animation.read_frame(framenr, window=(u, v, 1, 1))
+    if data is None:
         return None
 
-    data = dataset.ReadRaster(u, v, 1, 1, band_list=[1])
-    data_type = gdal_array.flip_code(dataset.GetRasterBand(1).DataType)
-    return np.fromstring(data, dtype=data_type)[0]
+    return float(data[0, 0])
@@ -26,6 +26,13 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Number of colors in a lookup table, more than the 256 colors that
+# matplotlib colormaps have by default.
+LUT_SIZE = 4096
+
+# Lookup tables per colormap name, see get_lut()
+luts = {}
+
 
 def get_mpl_cmap(colormap, settings_module=settings):
     """We supprort 2 kinds of colormap: default matplotlib colormaps,
@@ -44,6 +51,78 @@ def get_mpl_cmap(colormap, settings_module=settings):
     return cm.get_cmap(colormap)
 
 
+def get_lut(colormap, settings_module=settings):
+    """Return the Lut for a colormap name, see get_mpl_cmap().
+
+    Lookup tables are built once per process. The range of the data is
+    passed to Lut.apply(), so the same table serves every vmin and
+    vmax."""
+    try:
+        return luts[colormap]
+    except KeyError:
+        pass
+
+    if colormap.lower().endswith('.csv'):
+        colormap_path = os.path.join(
+            settings_module.FLOODING_LIB_COLORMAP_DIR, colormap)
+        lut = ColorMap(colormap_path).to_lut()
+    else:
+        lut = Lut(cm.get_cmap(colormap))
+
+    luts[colormap] = lut
+    return lut
+
+
+class Lut(object):
+    """Lookup table of uint8 rgba colors for a matplotlib colormap.
+
+    Applying it is a single numpy.take() on quantized data, instead of
+    the float interpolation that calling the colormap itself does. The
+    last entry of the table holds the color for masked data."""
+    def __init__(self, mpl_cmap, size=LUT_SIZE):
+        self.size = size
+        self.csv_max_value = getattr(mpl_cmap, 'csv_max_value', None)
+
+        # Sample the colormap at the centers of the bins
+        centers = (numpy.arange(size) + 0.5) / size
+        bad = numpy.ma.masked_all(1)
+        self.table = numpy.concatenate([
+            mpl_cmap(centers, bytes=True),
+            mpl_cmap(bad, bytes=True),
+        ])
+
+    def apply(self, data, vmin=None, vmax=None):
+        """Return a uint8 rgba array with an extra last axis of 4.
+
+        Data is clipped to vmin and vmax. Both default to the range of
+        the unmasked data, like matplotlib's Normalize does. Masked and
+        NaN values get the color for masked data."""
+        values = numpy.ma.getdata(data)
+        mask = numpy.ma.getmaskarray(data) | numpy.isnan(values)
+
+        if vmin is None or vmax is None:
+            valid = values[~mask]
+            if valid.size:
+                if vmin is None:
+                    vmin = valid.min()
+                if vmax is None:
+                    vmax = valid.max()
+            else:
+                vmin = vmax = 0
+
+        if vmax > vmin:
+            scale = self.size / (vmax - vmin)
+        else:
+            scale = 0
+
+        scaled = (values - vmin) * scale
+        scaled[mask] = 0  # avoid casting nans
+        numpy.clip(scaled, 0, self.size - 1, out=scaled)
+        index = scaled.astype(numpy.intp)
+        index[mask] = self.size
+        return numpy.take(self.table, index, axis=0)
+
+
 def to_color_tuple(s):
     if len(s) != 6:
         raise ValueError(
@@ -112,23 +191,24 @@ class ColorMap(object):
 
         The values that have data will get an opacity equal to
         opacity_value, the others are fully transparent (opacity
-        0)."""
+        0).
+
+        Colors are looked up in a table, like Lut does, indexed by the
+        class of each value. Leftbounds are ascending, as they are for
+        to_matplotlib()."""
         n, m = grid.shape
 
         colorgrid = numpy.zeros((4, n, m), dtype=numpy.uint8)
 
-        for i, leftbound in enumerate(self.leftbounds):
-            if i + i >= len(self.leftbounds):
-                # Last leftbound
-                mask = (grid >= leftbound)
-            else:
-                mask = (leftbound <= grid) & (self.leftbounds[i + 1] > grid)
-
-            red, green, blue = self.colors[i]
-
-            colorgrid[0, mask] = red
-            colorgrid[1, mask] = green
-            colorgrid[2, mask] = blue
+        # Entry 0 is for values below the first leftbound
+        table = numpy.zeros((len(self.leftbounds) + 1, 3), dtype=numpy.uint8)
+        if self.colors:
+            table[1:] = self.colors
+        values = numpy.ma.getdata(grid)
+        index = numpy.searchsorted(self.leftbounds, values, side='right')
+        if values.dtype.kind == 'f':
+            index[numpy.isnan(values)] = 0
+        colorgrid[:3] = numpy.rollaxis(numpy.take(table, index, axis=0), 2)
 
         # The opacity should be equal to 'opacity_value' wherever
         # there is a color, and 0 elsewhere. There is a color defined
@@ -151,6 +231,11 @@ class ColorMap(object):
         mpl_cmap.csv_max_value = scale_factor  # Hack
         return mpl_cmap
 
+    def to_lut(self):
+        """Return a Lut for this colormap. Apply it with vmin=0 and
+        vmax=self.csv_max_value, like the matplotlib colormap."""
+        return Lut(self.to_matplotlib())
+
     def _matplotlib_segments_from_list(self, values, scale_factor):
         """Value is a list of (leftbound, (r, g, b)) tuples."""
         segmentdata = {
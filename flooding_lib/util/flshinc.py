@@ -21,6 +21,11 @@ one_per_hour: only yield the first grid of each hour (assumes
 mutate: constantly yield the same grid object. Means that previously
         yielded grids change. Faster because no copies are made, but
         only use when you understand the risk.
+source_path: the file that path was unpacked from, if any. The index
+             of the file is kept next to it.
+
+Flsh.iter_deltas() yields the cells that changed per timestamp as well,
+for consumers that only need to look at those.
 
 If anything unexpected is encountered in a file, a possibly cryptic
 ValueError is raised.
@@ -30,10 +35,13 @@ ValueError is raised.
 from __future__ import print_function, unicode_literals
 from __future__ import absolute_import, division
 
+import json
 import logging
 import math
+import os
 import numpy
 import numpy.ma
+import re
 import zipfile
 
 from flooding_lib.util import files
@@ -41,6 +49,21 @@ from flooding_lib.util import files
 
 logger = logging.getLogger(__name__)
 
+# Number of bytes that Flsh reads at once, the rest of the last line
+# is added to it.
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# Timestamp lines have a '.' in their first word, cell lines are ints
+TIMESTAMP_LINE = re.compile(br'^[ \t]*[^\s.]*\.[^\n]*', re.M)
+EMPTY_LINE = re.compile(br'^[ \t\r]*\n', re.M)
+
+# Index files are stored next to the file the .inc was unpacked from
+INDEX_SUFFIX = '.index.json'
+INDEX_VERSION = 3
+
+# Kinds of records in the part after the header
+TIMESTAMP, CELLS, END = 'timestamp', 'cells', 'end'
+
 
 def splitline(f):
     return f.readline().decode('utf8').strip().split()
@@ -94,8 +117,10 @@ def y0_is_south(header, helper_geotransform):
 class Flsh(object):
     def __init__(
         self, path, no_data_value=-999.0, one_per_hour=False,
-        mutate=False, helper_geotransform=None):
+        mutate=False, helper_geotransform=None, source_path=None):
         self.path = path
+        # The .zip file path was unpacked from, if any, see get_index()
+        self.source_path = source_path or path
         self.no_data_value = no_data_value
         self.one_per_hour = one_per_hour
         self.mutate = mutate
@@ -117,7 +142,10 @@ class Flsh(object):
         header = self._parse_header()
         return header['classes']
 
-    def _open_path(self):
+    def _open_path(self, binary=False):
+        """Open path, or the only file in it if it is a zip. Binary
+        files are read without translating line endings, so that
+        positions in them are byte offsets."""
         if self.path.endswith('.zip'):
             try:
                 zipf = zipfile.ZipFile(self.path)
@@ -126,13 +154,13 @@ class Flsh(object):
                     raise ValueError(
                         "Can only open .zip files with 1 file inside, "
                         "{p} has {n}.".format(p=self.path, n=len(namelist)))
-                return zipf.open(namelist[0], mode='rU')
+                return zipf.open(namelist[0], mode='r' if binary else 'rU')
             except zipfile.BadZipfile:
                 raise ValueError(
                     "{} ends in .zip but can't be opened as one."
                     .format(self.path))
         else:
-            return file(self.path, 'rU')
+            return file(self.path, 'rb' if binary else 'rU')
 
     @property
     def ncols(self):
@@ -213,80 +241,245 @@ class Flsh(object):
         return self._header
 
     def find_max_col(self):
-        opened = self._open_path()
+        index = self.get_index()
+        logger.debug("Found max col: {}".format(index['maxcol']))
+        logger.debug("Found max row: {}".format(index['maxrow']))
+        return index['maxcol'], index['maxrow']
+
+    @property
+    def index_path(self):
+        """Path of the sidecar file of the index. A zip can hold
+        several .inc files, so the name of the unpacked file is part
+        of it."""
+        if self.source_path == self.path:
+            return self.path + INDEX_SUFFIX
+        return '{}.{}{}'.format(
+            self.source_path, os.path.basename(self.path), INDEX_SUFFIX)
+
+    def get_index(self):
+        """Return the index of the file: a dict with the max row and
+        col of all cells, and under 'timesteps' a [timestamp, offset,
+        lines] list per timestep. Offset is the byte offset of the
+        timestamp line in the uncompressed file, lines the number of
+        cell lines that follow it.
+
+        The index takes a full pass over the file to build. It is
+        stored in a sidecar file next to the source path, and reused
+        as long as the size and modification time of the source and
+        the size of the file don't change. Files unpacked to a
+        temporary directory should pass the file they came from as
+        source_path, so that the index outlives the unpacked file."""
+        if hasattr(self, '_index'):
+            return self._index
+
+        stat = os.stat(self.source_path)
+        key = dict(
+            version=INDEX_VERSION, size=stat.st_size, mtime=stat.st_mtime,
+            file_size=os.path.getsize(self.path))
+        index_path = self.index_path
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+            if all(index[k] == v for k, v in key.items()):
+                self._index = index
+                return index
+        except (IOError, ValueError, KeyError):
+            pass  # Missing or outdated
+
+        index = self._build_index()
+        index.update(key)
+        try:
+            tmp_path = index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.rename(tmp_path, index_path)
+        except (IOError, OSError) as e:
+            logger.warning("Could not save index of {}: {}".format(
+                    self.path, e))
+
+        self._index = index
+        return index
+
+    def _build_index(self):
+        opened = self._open_path(binary=True)
+
+        # Skip the header
+        offset = 0
+        for line in iter(opened.readline, b''):
+            offset += len(line)
+            if line.strip() == b'ENDCLASSES':
+                break
+
         maxcol = 0
         maxrow = 0
-        for line in opened:
-            line = line.strip().decode('utf8').split()
-            if not line or '.' in line[0]:
-                continue
-            try:
-                row, col, value = [int(elem) for elem in line]
-            except ValueError:
-                continue
-            maxcol = max(maxcol, col)
-            maxrow = max(maxrow, row)
-
-        logger.debug("Found max col: {}".format(maxcol))
-        logger.debug("Found max row: {}".format(maxrow))
-        return maxcol, maxrow
+        timesteps = []
+        for kind, offset, record in read_records(opened, offset):
+            if kind == TIMESTAMP:
+                timesteps.append([float(record.split()[0]), offset, 0])
+            elif kind == CELLS and len(record):
+                maxrow = max(maxrow, int(record[:, 0].max()))
+                maxcol = max(maxcol, int(record[:, 1].max()))
+                if timesteps:
+                    timesteps[-1][2] += len(record)
+        opened.close()
+
+        return {
+            'maxrow': maxrow,
+            'maxcol': maxcol,
+            'timesteps': timesteps,
+        }
 
     def __iter__(self):
+        for timestamp, the_array, written in self._timesteps():
+            if self.mutate:
+                yield timestamp, the_array
+            else:
+                yield timestamp, numpy.array(the_array)
+
+    def iter_deltas(self):
+        """Yield (timestamp, indices, values, grid) tuples.
+
+        Indices are the flat indices into the grid of the cells that
+        were set since the previous yield, values are their current
+        values. The grid is the dense view; it is always the same
+        array, changed in place, regardless of the mutate option. This
+        way consumers can do work per changed cell instead of per
+        cell."""
+        for timestamp, the_array, written in self._timesteps(track=True):
+            if written:
+                indices = numpy.unique(numpy.concatenate(written))
+            else:
+                indices = numpy.empty(0, dtype=numpy.int64)
+            yield timestamp, indices, the_array.take(indices), the_array
+
+    def _timesteps(self, track=False):
+        """Yield (timestamp, the_array, written) for every grid that
+        should be yielded. If track is True, written is a list of
+        arrays with the flat indices of the cells set since the
+        previous yield."""
         header = self._parse_header()
 
         the_array = numpy.zeros((header['nrows'] + 1, header['ncols'] + 1))
         current_timestamp = False
         yield_this_grid = False
         last_yielded_hour = None
+        lookup = None
+        written = []
 
-        for line in self.f:
-            line = line.strip().decode('utf8').split()
-
-            if not line or '.' in line[0]:
-                if yield_this_grid:
-                    if self.mutate:
-                        yield current_timestamp, the_array
-                    else:
-                        yield current_timestamp, numpy.array(the_array)
-                    last_yielded_hour = int(current_timestamp)
-
-                    if not line:
-                        # End of file
-                        return
-
-                # Start of a new timestamp
-                timestamp, _, class_column = line[:3]
-                current_timestamp = float(timestamp)
-                class_column = int(class_column) - 1
-                yield_this_grid = (
-                    not self.one_per_hour
-                    or int(current_timestamp) != last_yielded_hour)
-            else:
-                row, col, classvalue = [int(l) for l in line]
-
-                if classvalue == 0:
-                    value = 0.0
-                else:
-                    value = header['classes'][classvalue - 1][class_column]
-                try:
-                    the_array[-col, row - 1] = value
-                except IndexError:
-                    print(the_array.shape)
-                    print("col: {}".format(col))
-                    print("row: {}".format(row))
-                    raise
+        for kind, offset, record in read_records(self.f):
+            if kind == CELLS:
+                if lookup is None:
+                    raise ValueError(
+                        "{} has values before the first timestamp."
+                        .format(self.path))
+                set_cells(the_array, record, lookup)
+                if track:
+                    written.append(get_flat_indices(the_array, record))
+                continue
+
+            # A new timestamp, or the empty line that ends the file
+            if yield_this_grid:
+                yield current_timestamp, the_array, written
+                written = []
+                last_yielded_hour = int(current_timestamp)
+
+            if kind == END:
+                return
+
+            # Start of a new timestamp
+            timestamp, _, class_column = record.split()[:3]
+            current_timestamp = float(timestamp)
+            lookup = get_lookup(header['classes'], int(class_column) - 1)
+            yield_this_grid = (
+                not self.one_per_hour
+                or int(current_timestamp) != last_yielded_hour)
 
         self.f.close()  # When the file is closed, it can be deleted
                         # on Windows
 
+def read_records(f, offset=0):
+    """Read the rest of f in chunks and yield (kind, offset, record)
+    tuples: (TIMESTAMP, offset, line) for timestamp lines, (CELLS,
+    offset, array) for the 'row col class' lines in between and (END,
+    offset, None) for the empty line that ends the file. Offset is the
+    position in f of the start of the record, given that f is at
+    offset now."""
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        if not chunk.endswith(b'\n'):
+            # Complete the last line
+            chunk += f.readline()
+            if not chunk.endswith(b'\n'):
+                chunk += b'\n'
+
+        empty_line = EMPTY_LINE.search(chunk)
+        stop = empty_line.start() if empty_line else len(chunk)
+
+        position = 0
+        for match in TIMESTAMP_LINE.finditer(chunk, 0, stop):
+            if match.start() > position:
+                yield (CELLS, offset + position,
+                       parse_cells(chunk[position:match.start()]))
+            yield (TIMESTAMP, offset + match.start(),
+                   match.group().decode('utf8'))
+            position = match.end()
+        if stop > position:
+            yield CELLS, offset + position, parse_cells(chunk[position:stop])
+
+        if empty_line:
+            yield END, offset + stop, None
+            return
+        offset += len(chunk)
+
+
+def parse_cells(text):
+    """Return an (n, 3) int array of the 'row col class' lines in text."""
+    text = text.strip()
+    if not text:
+        return numpy.empty((0, 3), dtype=numpy.int64)
+
+    values = numpy.fromstring(text, dtype=numpy.int64, sep=' ')
+    if values.size != 3 * (text.count(b'\n') + 1):
+        raise ValueError(
+            "Expected lines of 3 integers, found {!r}...".format(text[:80]))
+    return values.reshape(-1, 3)
+
+
+def get_lookup(classes, class_column):
+    """Return array with the value of each class in a column of the
+    classes table. Class 0 means 0.0, classes start at 1."""
+    return numpy.array(
+        [0.0] + [values[class_column] for values in classes])
+
+
+def get_flat_indices(the_array, cells):
+    """Return the flat indices into the_array of cells, in the same
+    way set_cells() indexes it."""
+    rows, cols, classvalues = cells.T
+    nrows, ncols = the_array.shape
+    return (-cols % nrows) * ncols + (rows - 1) % ncols
+
+
+def set_cells(the_array, cells, lookup):
+    rows, cols, classvalues = cells.T
+    try:
+        the_array[-cols, rows - 1] = lookup[classvalues]
+    except IndexError:
+        logger.error("Cells outside grid of shape {}: cols {}-{}, rows {}-{}"
+                     .format(the_array.shape, cols.min(), cols.max(),
+                             rows.min(), rows.max()))
+        raise
+
 
 def save_grid_to_image(grid, path, classes, colormap, geo_transform=None):
     """Save this grid as an image.
 
     Assumes that all values in the grid are values that come from
     one of the classes. Translates the values in the classes to colors
-    from the colormap, then finds all the places in the grid that are
-    equal to that class and sets all those to the right color.
+    from the colormap, then looks up the color of every cell in a
+    table of those colors, with one np.take like colormap.Lut does.
 
     Because of the above (classes) this save functions is not exactly
     the same as the ColorMap.apply_to_grid() and files.save_geopng()
@@ -300,31 +493,24 @@ def save_grid_to_image(grid, path, classes, colormap, geo_transform=None):
         for value in classline:
             classvalues.add(value)
 
-    class_to_color = dict()
-    for classvalue in classvalues:
-        class_to_color[classvalue] = (
-            colormap.value_to_color(classvalue) or (0, 0, 0, 0))
+    # Lookup table of the colors of the sorted class values, with a
+    # last entry for values that are not a class value.
+    classvalues = numpy.array(sorted(classvalues))
+    table = numpy.zeros((len(classvalues) + 1, 3), dtype=numpy.uint8)
+    for i, classvalue in enumerate(classvalues):
+        table[i] = (colormap.value_to_color(classvalue) or (0, 0, 0))[:3]
+
+    index = numpy.searchsorted(classvalues, grid)
+    if len(classvalues):
+        found = numpy.minimum(index, len(classvalues) - 1)
+        index[classvalues[found] != grid] = len(classvalues)
 
     n, m = grid.shape
     colorgrid = numpy.zeros((4, n, m), dtype=numpy.uint8)
-
-    redgrid = numpy.zeros((n, m))
-    greengrid = numpy.zeros((n, m))
-    bluegrid = numpy.zeros((n, m))
-
-    for classvalue, color in class_to_color.items():
-        mask = (grid == classvalue)
-        redgrid += mask * color[0]
-        greengrid += mask * color[1]
-        bluegrid += mask * color[2]
-
-    colorgrid[0] = redgrid
-    colorgrid[1] = greengrid
-    colorgrid[2] = bluegrid
+    colorgrid[:3] = numpy.rollaxis(numpy.take(table, index, axis=0), 2)
 
     # Colored pixels get opacity 255, non-colored pixels opacity 0
     # (transparent)
-    colorgrid[3] = (
-        ((redgrid > 0) | (greengrid > 0) | (bluegrid > 0)) * 255)
+    colorgrid[3] = colorgrid[:3].any(axis=0) * 255
 
     files.save_geopng(path, colorgrid, geo_transform)
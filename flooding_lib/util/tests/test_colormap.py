@@ -74,6 +74,14 @@ class TestColorMap(TestCase):
         self.assertEquals(colorgrid[3, 1, 0], 0)
         self.assertEquals(colorgrid[3, 1, 1], 0)
 
+    def test_grid_apply_classes(self):
+        grid = np.array([[0.0, 0.5, 1.0, 2.0, np.nan]])
+
+        colorgrid = self.cm.apply_to_grid(grid)
+
+        self.assertEquals(colorgrid[0, 0].tolist(), [17, 17, 255, 255, 0])
+        self.assertEquals(colorgrid[3, 0].tolist(), [0, 255, 255, 255, 0])
+
     def test_matplotlib_colormap(self):
         mpl_cmap = self.cm.to_matplotlib()
 
@@ -87,3 +95,38 @@ class TestColorMap(TestCase):
         print(rgba)
         self.assertTrue(compare.all())
 
+    def test_lut_matches_matplotlib(self):
+        mpl_cmap = self.cm.to_matplotlib()
+        lut = self.cm.to_lut()
+
+        data = np.array([0.0, 0.25, 0.5, 1.0, 2.0])
+        normalized = np.clip(data / mpl_cmap.csv_max_value, 0, 1)
+
+        self.assertTrue((lut.apply(data, 0, lut.csv_max_value) ==
+                         mpl_cmap(normalized, bytes=True)).all())
+
+
+class TestLut(TestCase):
+    def setUp(self):
+        self.lut = colormap.get_lut('gray')
+
+    def test_get_lut_is_cached(self):
+        self.assertIs(colormap.get_lut('gray'), self.lut)
+
+    def test_shape_and_dtype(self):
+        rgba = self.lut.apply(np.zeros((2, 3)), 0, 1)
+        self.assertEquals(rgba.shape, (2, 3, 4))
+        self.assertEquals(rgba.dtype, np.uint8)
+
+    def test_clips_to_range(self):
+        rgba = self.lut.apply(np.array([-5.0, 0.0, 1.0, 5.0]), 0, 1)
+        self.assertEquals(rgba[:, 0].tolist(), [0, 0, 255, 255])
+
+    def test_masked_and_nan_are_transparent(self):
+        data = np.ma.array([0.5, 0.5, np.nan], mask=[False, True, False])
+        rgba = self.lut.apply(data, 0, 1)
+        self.assertEquals(rgba[:, 3].tolist(), [255, 0, 0])
+
+    def test_autoscale(self):
+        rgba = self.lut.apply(np.array([10.0, 20.0]))
+        self.assertEquals(rgba[:, 0].tolist(), [0, 255])
@@ -9,10 +9,35 @@ from __future__ import print_function
 from __future__ import absolute_import
 from __future__ import division
 
+import os
+import shutil
+import tempfile
+
+import mock
+import numpy
+
 from django.test import TestCase
 
 from flooding_lib.util import flshinc
 
+INC = b"""MAIN DIMENSIONS MMAX NMAX
+   3   2
+GRID DX X0 Y0
+  100.0 1000.0 2000.0
+CLASSES OF INCREMENTAL FILE
+ 0.1 1.0
+ 0.5 2.0
+ENDCLASSES
+  0.00  0  1
+1 1 1
+3 2 2
+  0.50  0  1
+2 1 2
+  1.00  0  2
+1 1 2
+
+"""
+
 
 class TestY0IsSouth(TestCase):
     def test_from_scenario_980(self):
@@ -60,3 +85,164 @@ class TestY0IsSouth(TestCase):
 
         self.assertTrue(flshinc.y0_is_south(
                 flsh_header, maxwaterdepth_gt))
+
+
+class TestIter(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'fls_h.inc')
+        with open(self.path, 'wb') as f:
+            f.write(INC)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_yields_grids(self):
+        grids = list(flshinc.Flsh(self.path))
+        self.assertEquals([t for t, g in grids], [0.0, 0.5, 1.0])
+
+        first, second, third = [g for t, g in grids]
+        self.assertEquals(first.shape, (3, 4))
+        self.assertEquals(first[2, 0], 0.1)
+        self.assertEquals(first[1, 2], 0.5)
+        self.assertAlmostEqual(first.sum(), 0.6)
+
+        # Values stay until they are changed
+        self.assertEquals(second[2, 1], 0.5)
+        self.assertEquals(third[2, 0], 2.0)
+        self.assertEquals(third[1, 2], 0.5)
+
+    def test_one_per_hour(self):
+        timestamps = [t for t, g in flshinc.Flsh(self.path, one_per_hour=True)]
+        self.assertEquals(timestamps, [0.0, 1.0])
+
+    def test_small_chunks(self):
+        with mock.patch.object(flshinc, 'CHUNK_SIZE', 5):
+            grids = [g for t, g in flshinc.Flsh(self.path)]
+        self.assertEquals(grids[2][2, 0], 2.0)
+
+    def test_mutate_yields_same_grid(self):
+        grids = [g for t, g in flshinc.Flsh(self.path, mutate=True)]
+        self.assertIs(grids[0], grids[2])
+
+    def test_iter_deltas(self):
+        deltas = list(flshinc.Flsh(self.path).iter_deltas())
+        self.assertEquals([d[0] for d in deltas], [0.0, 0.5, 1.0])
+
+        timestamp, indices, values, grid = deltas[0]
+        self.assertEquals(indices.tolist(), [6, 8])
+        self.assertEquals(values.tolist(), [0.5, 0.1])
+
+        timestamp, indices, values, grid = deltas[2]
+        self.assertEquals(indices.tolist(), [8])
+        self.assertEquals(values.tolist(), [2.0])
+
+    def test_iter_deltas_one_per_hour(self):
+        deltas = list(
+            flshinc.Flsh(self.path, one_per_hour=True).iter_deltas())
+        timestamp, indices, values, grid = deltas[1]
+        self.assertEquals(indices.tolist(), [8, 9])
+        self.assertEquals(values.tolist(), [2.0, 0.5])
+        self.assertEquals(grid.take(indices).tolist(), [2.0, 0.5])
+
+
+class TestIndex(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'fls_h.inc')
+        with open(self.path, 'wb') as f:
+            f.write(INC)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_index(self):
+        index = flshinc.Flsh(self.path).get_index()
+        self.assertEquals((index['maxrow'], index['maxcol']), (3, 2))
+
+    def test_index_has_offsets_and_lines_per_timestep(self):
+        timesteps = flshinc.Flsh(self.path).get_index()['timesteps']
+        self.assertEquals([(t, lines) for t, offset, lines in timesteps],
+                          [(0.0, 2), (0.5, 1), (1.0, 1)])
+        with open(self.path, 'rb') as f:
+            for timestamp, offset, lines in timesteps:
+                f.seek(offset)
+                self.assertEquals(float(f.readline().split()[0]), timestamp)
+
+    def test_index_is_saved_and_reused(self):
+        flshinc.Flsh(self.path).get_index()
+        self.assertTrue(os.path.exists(self.path + flshinc.INDEX_SUFFIX))
+
+        with mock.patch.object(flshinc.Flsh, '_build_index') as build:
+            flshinc.Flsh(self.path).get_index()
+        self.assertFalse(build.called)
+
+    def test_index_is_kept_next_to_source(self):
+        source_path = os.path.join(self.tmp_dir, 'result.zip')
+        with open(source_path, 'wb') as f:
+            f.write(b'zip')
+        flsh = flshinc.Flsh(self.path, source_path=source_path)
+        flsh.get_index()
+        self.assertEquals(os.path.dirname(flsh.index_path), self.tmp_dir)
+        self.assertTrue(os.path.exists(flsh.index_path))
+        self.assertFalse(os.path.exists(self.path + flshinc.INDEX_SUFFIX))
+
+        # As if unpacked again, to a new file
+        os.remove(self.path)
+        with open(self.path, 'wb') as f:
+            f.write(INC)
+        with mock.patch.object(flshinc.Flsh, '_build_index') as build:
+            index = flshinc.Flsh(
+                self.path, source_path=source_path).get_index()
+        self.assertFalse(build.called)
+        self.assertEquals((index['maxrow'], index['maxcol']), (3, 2))
+
+    def test_files_from_one_source_have_their_own_index(self):
+        source_path = os.path.join(self.tmp_dir, 'result.zip')
+        with open(source_path, 'wb') as f:
+            f.write(b'zip')
+        other_path = os.path.join(self.tmp_dir, 'other.inc')
+        with open(other_path, 'wb') as f:
+            f.write(INC.replace(b'3 2 2\n', b'3 2 2\n4 5 1\n'))
+
+        flsh = flshinc.Flsh(self.path, source_path=source_path)
+        other = flshinc.Flsh(other_path, source_path=source_path)
+        self.assertNotEquals(flsh.index_path, other.index_path)
+        self.assertEquals(flsh.get_index()['maxrow'], 3)
+        self.assertEquals(other.get_index()['maxrow'], 4)
+
+    def test_unknown_dimensions(self):
+        with open(self.path, 'wb') as f:
+            f.write(INC.replace(b'   3   2\n', b'   ***\n'))
+        flsh = flshinc.Flsh(self.path)
+        self.assertEquals((flsh.nrows, flsh.ncols), (2, 3))
+
+
+class TestParseCells(TestCase):
+    def test_parses_lines(self):
+        cells = flshinc.parse_cells(b"\n1 2 3\n4 5 6\r\n")
+        self.assertEquals(cells.tolist(), [[1, 2, 3], [4, 5, 6]])
+
+    def test_empty(self):
+        self.assertEquals(flshinc.parse_cells(b" \n").shape, (0, 3))
+
+    def test_raises_on_wrong_number_of_values(self):
+        self.assertRaises(
+            ValueError, lambda: flshinc.parse_cells(b"1 2 3\n4 5\n"))
+
+
+class TestSaveGridToImage(TestCase):
+    def test_colors_class_values_only(self):
+        colormap = mock.Mock()
+        colormap.value_to_color.side_effect = lambda value: {
+            0.1: (10, 20, 30), 0.5: (40, 50, 60)}.get(value)
+        grid = numpy.array([[0.1, 0.5], [0.3, 1.0]])
+
+        with mock.patch('flooding_lib.util.files.save_geopng') as save:
+            flshinc.save_grid_to_image(
+                grid, 'a.png', [(0.1, 1.0), (0.5, 2.0)], colormap)
+        colorgrid = save.call_args[0][1]
+        self.assertEquals(colorgrid[:, 0, 0].tolist(), [10, 20, 30, 255])
+        self.assertEquals(colorgrid[:, 0, 1].tolist(), [40, 50, 60, 255])
+        self.assertEquals(colorgrid[:, 1, 0].tolist(), [0, 0, 0, 0])
+        self.assertEquals(colorgrid[:, 1, 1].tolist(), [0, 0, 0, 0])
@@ -11,7 +11,7 @@ from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.core.cache import cache
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, HttpResponseBadRequest, Http404
 from django.shortcuts import render, get_object_or_404
 from django.views.decorators.cache import never_cache
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
@@ -39,6 +39,9 @@ from nens.sobek import HISFile
 
 log = logging.getLogger('nens.web.presentation.views')
 
+# Largest width and height of a rendered view of an animation frame
+GRIDFRAME_MAX_SIZE = getattr(settings, 'GRIDFRAME_MAX_SIZE', 2048)
+
 
 def external_file_location(filename):
     """Return full filename of file that's on smb (currently)
@@ -478,6 +481,10 @@ def service_get_gridframe(request, presentationlayer_id, legend_id, framenr=0):
 
     output:
         png
+
+    New style animations can also render a view of the frame, with
+    bbox=x1,y1,x2,y2 (in the projection of the animation, see its
+    bounds) and width and height in pixels, at most GRIDFRAME_MAX_SIZE.
     """
     pl = get_object_or_404(PresentationLayer, pk=presentationlayer_id)
 
@@ -487,8 +494,23 @@ def service_get_gridframe(request, presentationlayer_id, legend_id, framenr=0):
         response = HttpResponse()
         colormap = request.GET.get('colormap')
         maxvalue = request.GET.get('maxvalue')
+        bbox = size = None
+        if 'bbox' in request.GET:
+            try:
+                bbox = [float(x) for x in request.GET['bbox'].split(',')]
+                size = (int(request.GET['width']),
+                        int(request.GET['height']))
+            except (KeyError, ValueError):
+                return HttpResponseBadRequest(
+                    "bbox needs width and height, all numbers.")
+            if len(bbox) != 4:
+                return HttpResponseBadRequest("bbox needs 4 numbers.")
+            if min(size) < 1 or max(size) > GRIDFRAME_MAX_SIZE:
+                return HttpResponseBadRequest(
+                    "width and height should be between 1 and {}."
+                    .format(GRIDFRAME_MAX_SIZE))
         result.animation.save_image_to_response(
-            response, framenr, colormap, maxvalue)
+            response, framenr, colormap, maxvalue, bbox, size)
         return response
 
     log.debug('get png name')
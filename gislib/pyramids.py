@@ -5,6 +5,8 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 from __future__ import division
 
+import collections
+import contextlib
 import datetime
 import glob
 import logging
@@ -12,8 +14,11 @@ import math
 import multiprocessing
 import os
 import tempfile
+import threading
 import time
 
+from multiprocessing.pool import ThreadPool
+
 from osgeo import gdal
 from osgeo import gdal_array
 from osgeo import ogr
@@ -32,27 +37,182 @@ ogr.UseExceptions()
 osr.UseExceptions()
 
 logger = logging.getLogger(__name__)
-transport = None
 
 GDAL_DRIVER_GTIFF = gdal.GetDriverByName(b'gtiff')
 TIMEOUT = 60  # seconds
+POOL_SIZE = 256  # idle open datasets, over all pyramids and levels
+WORKERS = multiprocessing.cpu_count()  # threads building levels
+
+shared_pool = None
+lock = threading.Lock()  # for creating shared_pool and workers
+workers = None
+
+
+def get_workers():
+    """
+    Return the long-lived pool of threads that build pyramid levels.
+
+    Threads suffice, because gdal releases the gil while reading,
+    reprojecting, compressing and writing.
+    """
+    global workers
+    with lock:
+        if workers is None:
+            workers = ThreadPool(WORKERS)
+    return workers
+
+
+def get_window(dataset, blocks):
+    """
+    Return pixel window (u1, v1, u2, v2) spanning blocks of dataset.
+
+    Blocks are indices as generated by Grid.get_tiles_and_blocks.
+    """
+    width, height = dataset.GetRasterBand(1).GetBlockSize()
+    us = [i for i, j in blocks]
+    vs = [-j - 1 for i, j in blocks]
+    return (min(us) * width,
+            min(vs) * height,
+            min(dataset.RasterXSize, (max(us) + 1) * width),
+            min(dataset.RasterYSize, (max(vs) + 1) * height))
+
+
+def get_source(dataset):
+    """ Return in-memory copy of dataset as dictionary for warp_tile. """
+    return dict(
+        array=dataset.ReadAsArray().reshape(rasters.get_shape(dataset)),
+        geotransform=dataset.GetGeoTransform(),
+        projection=dataset.GetProjection(),
+        nodatavalue=rasters.get_no_data_value(dataset),
+    )
+
+
+def warp_tile(job):
+    """
+    Warp source into the window spanning blocks of the tile at path.
+
+    The tile is opened, read and written once. Source is a dictionary
+    suitable for rasters.dict2dataset. Every call makes its own dataset
+    from the source array, so that threads do not share datasets.
+    """
+    path, blocks, source = job
+    target = gdal.Open(path, gdal.GA_Update)
+    u1, v1, u2, v2 = get_window(target, blocks)
+    band_list = range(1, target.RasterCount + 1)
+
+    # Read the window into a dataset
+    array = np.frombuffer(target.ReadRaster(
+        u1, v1, u2 - u1, v2 - v1, band_list=band_list,
+    ), dtype=gdal_array.flip_code(target.GetRasterBand(1).DataType)).copy()
+    array.shape = target.RasterCount, v2 - v1, u2 - u1
+    p, a, b, q, c, d = target.GetGeoTransform()
+    window = rasters.dict2dataset(dict(
+        array=array,
+        geotransform=(p + a * u1 + b * v1, a, b, q + c * u1 + d * v1, c, d),
+        projection=target.GetProjection(),
+        nodatavalue=target.GetRasterBand(1).GetNoDataValue(),
+    ))
+
+    rasters.reproject(source=rasters.dict2dataset(source), target=window)
+    window.FlushCache()  # really update underlying numpy array
+
+    target.WriteRaster(
+        u1, v1, u2 - u1, v2 - v1, array.tostring(), band_list=band_list,
+    )
+    target = None  # close, so that the tile is flushed to disk
+
+
+def warp_children(job):
+    """
+    Warp tiles from the level below into the tile at path, one after
+    the other.
+
+    Children is a list of (child path, blocks) tuples. Every child is
+    read only when it is warped, so that a job holds one child in
+    memory at a time.
+    """
+    path, children = job
+    for child, blocks in children:
+        with get_pool().borrow(child) as dataset:
+            source = get_source(dataset)
+        warp_tile((path, blocks, source))
+
+
+def decimate_tile(job):
+    """
+    Fill the window spanning blocks of the tile at path from the level
+    below, taking every other pixel in both directions.
+
+    Children is a dictionary that maps (column, row) of a quadrant of
+    the tile to the path of the tile in the level below that covers
+    it. Row 0 is the northern half. Missing children yield no data.
+    """
+    path, blocks, children = job
+    target = gdal.Open(path, gdal.GA_Update)
+    u1, v1, u2, v2 = get_window(target, blocks)
+    band = target.GetRasterBand(1)
+    count = target.RasterCount
+    array = np.empty((count, v2 - v1, u2 - u1),
+                     dtype=gdal_array.flip_code(band.DataType))
+    array.fill(band.GetNoDataValue())
+
+    half_width, half_height = target.RasterXSize // 2, target.RasterYSize // 2
+    for (a, b), child_path in children.items():
+        # Part of the window covered by this child
+        q1, q2 = max(u1, a * half_width), min(u2, (a + 1) * half_width)
+        r1, r2 = max(v1, b * half_height), min(v2, (b + 1) * half_height)
+        if q1 >= q2 or r1 >= r2:
+            continue
+        try:
+            child = gdal.Open(child_path)
+        except RuntimeError:
+            continue  # no data in the level below
+        data = child.ReadAsArray(2 * (q1 - a * half_width),
+                                 2 * (r1 - b * half_height),
+                                 2 * (q2 - q1),
+                                 2 * (r2 - r1))
+        data.shape = count, 2 * (r2 - r1), 2 * (q2 - q1)
+        array[:, r1 - v1:r2 - v1, q1 - u1:q2 - u1] = data[:, ::2, ::2]
+
+    target.WriteRaster(
+        u1, v1, u2 - u1, v2 - v1, array.tostring(),
+        band_list=range(1, count + 1),
+    )
+    target = None  # close, so that the tile is flushed to disk
 
 
-def initialize(arg_transport):
-    """ Set some pool data globally. """
-    global transport
-    transport = arg_transport
+def map_window(path, dataset, window):
+    """
+    Return read-only view on the file for a window, or None.
 
+    This only works for windows within a single block of an
+    uncompressed, single band tiff, whose block bytes can be mapped
+    into memory directly. Gdal writes tiffs in native byte order.
+    """
+    band = dataset.GetRasterBand(1)
+    compression = dataset.GetMetadataItem(b'COMPRESSION', b'IMAGE_STRUCTURE')
+    if dataset.RasterCount != 1 or compression:
+        return None
+
+    width, height = band.GetBlockSize()
+    u1, v1, u2, v2 = window
+    i, j = u1 // width, v1 // height
+    if (u2 - 1) // width != i or (v2 - 1) // height != j:
+        return None
+
+    offset = band.GetMetadataItem(
+        'BLOCK_OFFSET_{}_{}'.format(i, j).encode('ascii'), b'TIFF',
+    )
+    if not offset or not int(offset):
+        return None  # sparse block, not on disk
 
-def warp(path_and_blocks):
-    """ Warp global transport into specified blocks from dataset at path. """
-    path, blocks = path_and_blocks
-    for i, j in blocks:
-        dataset = rasters.Dataset(gdal.Open(path, gdal.GA_Update))
-        block = dataset.read_block((i, -j - 1))
-        rasters.reproject(source=transport.dataset, target=block['dataset'])
-        block['dataset'].FlushCache()  # really update underlying numpy array
-        dataset.write_block((i, -j - 1), block['array'])
+    block = np.memmap(path,
+                      mode='r',
+                      dtype=gdal_array.flip_code(band.DataType),
+                      offset=int(offset),
+                      shape=(height, width))
+    return block[v1 - j * height:v2 - j * height,
+                 u1 - i * width:u2 - i * width]
 
 
 def point_from_dataset(dataset, point):
@@ -218,6 +378,90 @@ class LockError(Exception):
     pass
 
 
+class DatasetPool(object):
+    """
+    Bounded pool of open read-only datasets, keyed by path.
+
+    A borrowed dataset is used by one thread at a time. Idle datasets
+    are kept open, up to size, and reused if the file did not change
+    since it was opened.
+    """
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = collections.OrderedDict()  # path: [(stamp, dataset)]
+        self.count = 0  # number of idle datasets
+
+    def _pop(self, path, stamp):
+        """ Return idle dataset or None, discarding stale ones. """
+        with self.lock:
+            entries = self.idle.get(path, [])
+            while entries:
+                entry_stamp, dataset = entries.pop()
+                self.count -= 1
+                if entry_stamp == stamp:
+                    if not entries:
+                        del self.idle[path]
+                    return dataset
+            self.idle.pop(path, None)
+
+    def _push(self, path, stamp, dataset):
+        """ Make dataset available again, evicting the least recent. """
+        with self.lock:
+            entries = self.idle.pop(path, [])
+            entries.append((stamp, dataset))
+            self.idle[path] = entries
+            self.count += 1
+            while self.count > self.size:
+                oldest = next(iter(self.idle))
+                self.idle[oldest].pop(0)
+                self.count -= 1
+                if not self.idle[oldest]:
+                    del self.idle[oldest]
+
+    @contextlib.contextmanager
+    def borrow(self, path):
+        """
+        Context manager yielding an open dataset for path.
+
+        Raises RuntimeError, like gdal.Open, if no dataset can be opened.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError as error:
+            raise RuntimeError(str(error))
+        stamp = stat.st_mtime, stat.st_size
+
+        dataset = self._pop(path, stamp)
+        if dataset is None:
+            dataset = gdal.Open(path)
+        try:
+            yield dataset
+        finally:
+            self._push(path, stamp, dataset)
+
+    def clear(self):
+        """ Close all idle datasets. """
+        with self.lock:
+            self.idle.clear()
+            self.count = 0
+
+
+def get_pool():
+    """
+    Return the dataset pool.
+
+    All levels of all pyramids share one pool, keyed by tile path, so
+    that the number of open files is bounded by POOL_SIZE however many
+    layers a long running server reads.
+    """
+    global shared_pool
+    with lock:
+        if shared_pool is None:
+            shared_pool = DatasetPool()
+    return shared_pool
+
+
 class Grid(object):
     """
     Represent a grid of rastertiles.
@@ -274,6 +518,13 @@ class Grid(object):
         for i in range(self.raster_count):
             dataset.GetRasterBand(i + 1).SetNoDataValue(self.no_data_value)
 
+    def get_blocks(self):
+        """ Return indices of all blocks of a tile. """
+        counts = tuple(int(math.ceil(r / b))
+                       for r, b in zip(self.raster_size, self.block_size))
+        return tuple((i, -j - 1)
+                     for j in range(counts[1]) for i in range(counts[0]))
+
     def get_tiles(self, dataset):
         """
         Return generator of tile indices.
@@ -312,13 +563,17 @@ class Grid(object):
         generator.
         """
         for tile, blocks in self.get_tiles_and_blocks(dataset):
-            path = self.tile2path(tile)
-            if not os.path.exists(path):
-                logger.debug('Create {}'.format(path))
-                self.create(tile)
-            else:
-                logger.debug('Update {}'.format(path))
-            yield path, blocks
+            yield self.get_path(tile), blocks
+
+    def get_path(self, tile):
+        """ Return path for tile, creating the tile if necessary. """
+        path = self.tile2path(tile)
+        if not os.path.exists(path):
+            logger.debug('Create {}'.format(path))
+            self.create(tile)
+        else:
+            logger.debug('Update {}'.format(path))
+        return path
 
     def get_datasets(self, dataset):
         """
@@ -327,26 +582,138 @@ class Grid(object):
         The generator yields only datasets whose extent intersect with
         datasets extent.
         """
+        pool = get_pool()
         paths = (
             self.tile2path(tile) for tile in self.get_tiles(dataset))
         for path in paths:
             try:
-                yield gdal.Open(path)
+                with pool.borrow(path) as dataset:
+                    yield dataset
             except RuntimeError:
                 continue
 
     def fetch_single_point(self, x, y):
         tile = get_tile(self.spacing, (x, y))
         path = self.tile2path(tile)
+        logger.debug("Fetching single point: {}".format(path))
         try:
-            logger.debug("Fetching single point: {}".format(path))
-            dataset = gdal.Open(path)
+            with get_pool().borrow(path) as dataset:
+                values = point_from_dataset(dataset, (x, y))
         except RuntimeError:
             return [None]  #* self.rastercount
 
-        values = point_from_dataset(dataset, (x, y))
         return np.ma.masked_equal(values, self.no_data_value).tolist()
 
+    def fetch_points(self, xs, ys):
+        """
+        Return masked array with values of the first band at points.
+
+        Points are grouped by tile, so that every tile is opened once
+        and read once for all its points.
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        values = np.ma.masked_all(
+            xs.shape, dtype=gdal_array.flip_code(self.data_type),
+        )
+        if not xs.size:
+            return values
+
+        # Group the point indices by tile
+        tx = np.floor(xs / self.spacing[0]).astype(np.int64)
+        ty = np.floor(ys / self.spacing[1]).astype(np.int64)
+        order = np.lexsort((ty, tx))
+        starts = np.flatnonzero(
+            (np.diff(tx[order]) != 0) | (np.diff(ty[order]) != 0),
+        ) + 1
+
+        pool = get_pool()
+        for group in np.split(order, starts):
+            path = self.tile2path((tx[group[0]], ty[group[0]]))
+            try:
+                with pool.borrow(path) as dataset:
+                    p, a, b, q, c, d = dataset.GetGeoTransform()
+                    minv = np.linalg.inv([[a, b], [c, d]])
+                    u, v = np.floor(
+                        np.dot(minv, [xs[group] - p, ys[group] - q]),
+                    ).astype(np.int64)
+                    u = u.clip(0, dataset.RasterXSize - 1)
+                    v = v.clip(0, dataset.RasterYSize - 1)
+
+                    # Read the window spanned by the points at once
+                    u1, v1 = u.min(), v.min()
+                    window = dataset.GetRasterBand(1).ReadAsArray(
+                        int(u1), int(v1),
+                        int(u.max() - u1 + 1), int(v.max() - v1 + 1),
+                    )
+            except RuntimeError:
+                continue  # no tile, values stay masked
+            values[group] = window[v - v1, u - u1]
+
+        return np.ma.masked_equal(values, self.no_data_value, copy=False)
+
+    def read(self, extent, size):
+        """
+        Return array of shape (1, height, width) for extent, or None.
+
+        No warping is done, so extent must be aligned with the pixels of
+        this grid and size must match its cell size. Data within a
+        single block of an uncompressed tile is returned as a view on
+        the memory mapped file, otherwise tiles are read directly into
+        the resulting array.
+        """
+        width, height = size
+        x1, y1, x2, y2 = extent
+        cx, cy = self.cell_size
+
+        # Global pixel indices, rows increasing southwards
+        u1, v1 = x1 / cx, -y2 / cy
+        if abs(u1 - round(u1)) > 1e-6 or abs(v1 - round(v1)) > 1e-6:
+            return None
+        u1, v1 = int(round(u1)), int(round(v1))
+        u2, v2 = u1 + width, v1 + height
+
+        # Tiles covering the pixels
+        columns, rows = self.raster_size
+        tiles_x = range(u1 // columns, (u2 - 1) // columns + 1)
+        tiles_y = range(-((v2 - 1) // rows) - 1, -(v1 // rows))
+
+        pool = get_pool()
+        if len(tiles_x) == 1 and len(tiles_y) == 1:
+            tile = tiles_x[0], tiles_y[0]
+            path = self.tile2path(tile)
+            window = (u1 - tile[0] * columns, v1 + (tile[1] + 1) * rows,
+                      u2 - tile[0] * columns, v2 + (tile[1] + 1) * rows)
+            try:
+                with pool.borrow(path) as dataset:
+                    view = map_window(path, dataset, window)
+            except RuntimeError:
+                view = None
+            if view is not None:
+                return view[np.newaxis]
+
+        array = np.empty((1, height, width),
+                         dtype=gdal_array.flip_code(self.data_type))
+        array.fill(self.no_data_value)
+        for tile in ((x, y) for y in tiles_y for x in tiles_x):
+            # Tile window, clipped by the requested pixels
+            p1 = max(u1, tile[0] * columns)
+            p2 = min(u2, (tile[0] + 1) * columns)
+            q1 = max(v1, -(tile[1] + 1) * rows)
+            q2 = min(v2, -tile[1] * rows)
+            try:
+                with pool.borrow(self.tile2path(tile)) as dataset:
+                    dataset.GetRasterBand(1).ReadAsArray(
+                        p1 - tile[0] * columns,
+                        q1 + (tile[1] + 1) * rows,
+                        p2 - p1,
+                        q2 - q1,
+                        buf_obj=array[0, q1 - v1:q2 - v1, p1 - u1:p2 - u1],
+                    )
+            except RuntimeError:
+                continue  # no tile, keep no data
+        return array
+
     def warpinto(self, dataset):
         """ Warp appropriate tiles into dataset. """
         for source in self.get_datasets(dataset):
@@ -403,6 +770,23 @@ class Manager(object):
         except RuntimeError:
             return None
 
+    @property
+    def data_extent(self):
+        """
+        Return extent tuple of the tiles of the lowest level, or None.
+
+        Unlike extent, this does not need a .pyramid.tif with data, so
+        it works for the pyramids that sync() writes.
+        """
+        if not self.levels:
+            return None
+        grid = self[self.levels[0]]
+        extents = [grid.tile2extent(tile) for tile in self.get_tiles(0)]
+        if not extents:
+            return None
+        x1, y1, x2, y2 = zip(*extents)
+        return min(x1), min(y1), max(x2), max(y2)
+
     def bootstrap(self, dataset, overrides):
         """ Bootstrap manager for a new pyramid. """
         self.__dict__.update(get_config(dataset))
@@ -417,11 +801,14 @@ class Manager(object):
         exists by creating it as an empty file. The .pyramid.tif is
         needed so that the rasterserver demo page (flooding branch) can
         tell where a pyramid directory structure starts.
+
+        Its modification time is updated on every sync, so that
+        caches of rendered data can tell the pyramid has changed.
         """
         peakpath = self.peakpath
         if not os.path.exists(peakpath):
-            open(peakpath, 'w')
-        return
+            open(peakpath, 'w').close()
+        os.utime(peakpath, None)
 
     def get_level(self, dataset):
         """
@@ -457,54 +844,130 @@ class Manager(object):
 
         Note that it assumes a two-deep directory structure for the level.
         """
+        pool = get_pool()
+        for path in self.get_dataset_paths(index):
+            with pool.borrow(path) as dataset:
+                yield dataset
+
+    def get_dataset_paths(self, index):
+        """ Return generator of the paths of the datasets of a level. """
         level = self.levels[index]
-        paths = glob.iglob(os.path.join(
+        return glob.iglob(os.path.join(
             self.path, str(level), b'*', b'*',
         ))
-        for path in paths:
-            yield gdal.Open(path)
 
-    def extend(self, levels):
+    def extend(self, level):
         """
-        Extend levels to include level.
+        Extend levels up to and including level and return timings.
 
         Used if there is data in the pyramid, but the amount of levels
-        need to be extended.
+        need to be extended. Every new level is built once from the
+        level below it, starting at the current top level, so only the
+        tiles that have data below are written.
         """
-        addlevels = [1 + self.levels[-1] + l for l in range(levels)]
-        for source in self.get_datasets(-1):
-            transport = rasters.SharedMemoryDataset(source)
-            paths = (p for l in addlevels for p in self[l].get_paths(source))
-            for path in paths:
-                initialize(transport)
-                map(warp, paths)
-        self.levels.extend(addlevels)
+        timings = []
+        pool = get_workers()
+        for l in range(self.levels[-1] + 1, level + 1):
+            start = time.time()
+            tiles = set((x // 2, y // 2)
+                        for x, y in self.get_tiles(-1))
+            grid = self[l]
+            if self.can_decimate():
+                tile_blocks = grid.get_blocks()
+                jobs = [(grid.get_path(tile), tile_blocks,
+                         self.get_children(l, tile)) for tile in tiles]
+                pool.map(decimate_tile, jobs)
+            else:
+                # Up to four tiles below cover a tile, so jobs are per
+                # tile to have every tile written by one thread.
+                children = collections.defaultdict(list)
+                for child in self.get_dataset_paths(-1):
+                    with get_pool().borrow(child) as dataset:
+                        for path, blocks in grid.get_paths(dataset):
+                            if blocks:
+                                children[path].append((child, blocks))
+                jobs = children.items()
+                pool.map(warp_children, jobs)
+            self.levels.append(l)
+            timings.append((l, time.time() - start))
+            logger.debug('Level {} ({} tiles): {:.2f}s'.format(
+                l, len(jobs), timings[-1][1],
+            ))
+        return timings
+
+    def get_tiles(self, index):
+        """ Return generator of the indices of the tiles of a level. """
+        level = self.levels[index]
+        paths = glob.iglob(os.path.join(
+            self.path, str(level), b'*', b'*.tif',
+        ))
+        for path in paths:
+            x = os.path.basename(os.path.dirname(path))
+            y = os.path.splitext(os.path.basename(path))[0]
+            yield int(x), int(y)
 
     def add(self, dataset, **kwargs):
         """ Add a dataset to manager. """
         # prepare for data addition
         if self.levels:
-            oldlevel = self.levels[-1]
-            newlevel = self.get_toplevel(dataset)
-            if newlevel > oldlevel:
-                self.extend(newlevel)
+            toplevel = self.get_toplevel(dataset)
+            if toplevel > self.levels[-1]:
+                self.extend(toplevel)
         else:
             self.bootstrap(dataset=dataset, overrides=kwargs)
 
         # do the data addition
-        transport = rasters.SharedMemoryDataset(dataset)
-        paths = (p for l in self.levels for p in self[l].get_paths(dataset))
+        return self.build(dataset)
 
-        # Single process addition
-        #initialize(transport)
-        #map(warp, paths)
+    def can_decimate(self):
+        """ Return if levels can be built from the level below. """
+        width, height = self.raster_size
+        return not (width % 2 or height % 2)
 
-        # Multiprocessed addition
-        pool = multiprocessing.Pool(
-            initializer=initialize, initargs=[transport]
-        )
-        pool.map(warp, paths)
-        pool.close()
+    def build(self, dataset):
+        """
+        Write dataset into all levels and return per-level timings.
+
+        Levels up to the level of the dataset get the dataset warped
+        into them, higher levels are decimated from the level below.
+        Every tile is written once per level, by a pool of threads.
+        """
+        source = get_source(dataset)
+        level = max(self.get_level(dataset), self.levels[0])
+        pool = get_workers()
+
+        timings = []
+        for l in self.levels:
+            start = time.time()
+            grid = self[l]
+            if l <= level or not self.can_decimate():
+                jobs = [(path, blocks, source)
+                        for path, blocks in grid.get_paths(dataset)
+                        if blocks]
+                pool.map(warp_tile, jobs)
+            else:
+                jobs = [(grid.get_path(tile), blocks,
+                         self.get_children(l, tile))
+                        for tile, blocks in grid.get_tiles_and_blocks(dataset)
+                        if blocks]
+                pool.map(decimate_tile, jobs)
+            timings.append((l, time.time() - start))
+            logger.debug('Level {} ({} tiles): {:.2f}s'.format(
+                l, len(jobs), timings[-1][1],
+            ))
+        return timings
+
+    def get_children(self, level, tile):
+        """
+        Return dictionary of tile paths in the level below.
+
+        Keys are (column, row) of the quadrants of tile, row 0 being the
+        northern half.
+        """
+        grid = self[level - 1]
+        x, y = tile
+        return {(a, b): grid.tile2path((2 * x + a, 2 * y + 1 - b))
+                for a in (0, 1) for b in (0, 1)}
 
     def warpinto(self, dataset):
         """
@@ -519,6 +982,29 @@ class Manager(object):
             level = self.levels[0]
         return self[level].warpinto(dataset)
 
+    def read(self, extent, size, projection):
+        """
+        Return array for extent without warping, or None.
+
+        Only possible if projection is the projection of the pyramid
+        and the cell size of the request is the cell size of a level.
+        """
+        if not self.levels:
+            return None
+        sr1 = projections.get_spatial_reference(projection)
+        sr2 = projections.get_spatial_reference(self.projection)
+        if not sr1.IsSame(sr2):
+            return None
+
+        x1, y1, x2, y2 = extent
+        cellsize = (x2 - x1) / size[0]
+        if cellsize <= 0 or abs((y2 - y1) / size[1] - cellsize) > 1e-9:
+            return None
+        level = int(round(math.log(cellsize, 2)))
+        if abs(cellsize - 2 ** level) > 1e-9 or level not in self.levels:
+            return None
+        return self[level].read(extent, size)
+
     def single(self, point):
         """ Return value from lowest level. """
         pass
@@ -556,6 +1042,15 @@ class Pyramid(stores.BaseStore):
         grid = self.manager.get_bottomlevel()
         return grid.fetch_single_point(x, y)
 
+    def fetch_points(self, xs, ys):
+        """
+        Return masked array of values at points from the lowest level.
+
+        Xs and ys are arrays of coordinates in the pyramid's projection.
+        """
+        grid = self.manager.get_bottomlevel()
+        return grid.fetch_points(xs, ys)
+
     @property
     def lockpath(self):
         return os.path.join(self.path, '.pyramid.lock')
@@ -603,6 +1098,10 @@ class Pyramid(stores.BaseStore):
         """ See manager. """
         self.manager.warpinto(dataset)
 
+    def read(self, extent, size, crs):
+        """ See manager. """
+        return self.manager.read(extent, size, crs)
+
     def sync(self):
         return self.manager.sync()
 
@@ -611,6 +1110,11 @@ class Pyramid(stores.BaseStore):
         """ Return pyramid extent tuple. """
         return self.manager.extent
 
+    @property
+    def data_extent(self):
+        """ Return extent tuple of the tiles with data. """
+        return self.manager.data_extent
+
     #def single(self, point):
         #""" Return value from lowest level. """
         #pass
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from osgeo import gdal
+import numpy as np
+
+from gislib import projections
+from gislib import pyramids
+
+MEM_DRIVER = gdal.GetDriverByName(b'mem')
+
+description = """
+Benchmark extending a pyramid with an increasing number of levels.
+
+Builds a pyramid from a synthetic dataset once, then extends copies of
+it and prints the time it takes per number of levels added.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def get_parser():
+    """ Return argument parser. """
+    parser = argparse.ArgumentParser(
+        description=description
+    )
+    parser.add_argument('-s', '--size',
+                        type=int,
+                        default=4096,
+                        help='Width and height of the synthetic dataset')
+    parser.add_argument('-l', '--levels',
+                        type=int,
+                        nargs='+',
+                        default=[1, 2, 4, 8],
+                        help='Numbers of levels to add')
+    return parser
+
+
+def get_dataset(size):
+    """ Return synthetic float32 dataset with 1 m cells in RD. """
+    dataset = MEM_DRIVER.Create(b'', size, size, 1, gdal.GDT_Float32)
+    dataset.SetProjection(projections.get_wkt(projections.RD))
+    dataset.SetGeoTransform((100000, 1, 0, 400000 + size, 0, -1))
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(-9999)
+    band.WriteArray(np.random.random((size, size)).astype(np.float32))
+    return dataset
+
+
+def benchmark(size, levels):
+    """ Print seconds per number of levels added. """
+    tmp = tempfile.mkdtemp()
+    try:
+        base = os.path.join(tmp, 'base')
+        manager = pyramids.Manager(base)
+        manager.add(get_dataset(size),
+                    raster_size=(1024, 1024),
+                    block_size=(256, 256))
+        print('Base pyramid: levels {}-{}'.format(
+            manager.levels[0], manager.levels[-1],
+        ))
+
+        print('{:>8} {:>10} {:>10}'.format('levels', 'seconds', 's/level'))
+        for count in levels:
+            path = os.path.join(tmp, str(count))
+            shutil.copytree(base, path)
+            manager = pyramids.Manager(path)
+            start = time.time()
+            manager.extend(manager.levels[-1] + count)
+            seconds = time.time() - start
+            print('{:>8} {:>10.3f} {:>10.3f}'.format(
+                count, seconds, seconds / count,
+            ))
+            shutil.rmtree(path)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def main():
+    """ Call command with args from parser. """
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    benchmark(**vars(get_parser().parse_args()))
+
+
+if __name__ == '__main__':
+    exit(main())
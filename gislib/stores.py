@@ -32,6 +32,14 @@ class BaseStore(object):
         handler = self.HANDLERS[wkb.GetGeometryType()]
         return handler(self, wkb, crs, size=size)
 
+    def read(self, extent, size, crs):
+        """
+        Return array for extent without warping, or None.
+
+        Stores that can read data in place override this.
+        """
+        return None
+
     def get_data_for_polygon(self, wkb, crs, size):
         """
         Return a numpy array for the data.
@@ -45,12 +53,18 @@ class BaseStore(object):
         datatype = getattr(
             self.manager, 'data_type', getattr(self, 'data_type', None))
 
+        # Read without warping if the request matches the store
+        if envelope.Equals(wkb):
+            array = self.read(extent=extent, size=size, crs=crs)
+            if array is not None:
+                return np.ma.masked_equal(array, nodatavalue, copy=False)
+
         # Initialize resulting array to nodatavalue
-        dtype = gdal_array.flip_code(datatype)
-        array = np.ones(
+        array = np.empty(
             (1, size[1], size[0]),
-            dtype=dtype,
-        ) * dtype(nodatavalue)
+            dtype=gdal_array.flip_code(datatype),
+        )
+        array.fill(nodatavalue)
 
         # Create dataset and use it to retrieve data from the store
         array_dict = dict(
@@ -1,9 +1,15 @@
 from unittest import TestCase
+import glob
+import os
+import shutil
+import tempfile
 
+from osgeo import gdal
 from osgeo import gdal_array
 import numpy as np
 import mock
 
+from gislib import projections
 from gislib import pyramids
 
 
@@ -99,3 +105,333 @@ class TestManager(TestCase):
             self.assertEquals(manager.projection, "Huh?")
             self.assertEquals(manager.raster_count, 1)
             self.assertEquals(manager.raster_size, (1024, 2048))
+
+
+class FakeStat(object):
+    def __init__(self, st_mtime, st_size=100):
+        self.st_mtime = st_mtime
+        self.st_size = st_size
+
+
+class TestDatasetPool(TestCase):
+    def borrow(self, pool, path, mtime=1):
+        with mock.patch('os.stat', return_value=FakeStat(mtime)):
+            with pool.borrow(path) as dataset:
+                return dataset
+
+    @mock.patch('gislib.pyramids.gdal.Open', side_effect=lambda p: object())
+    def test_reuses_dataset(self, patched_open):
+        pool = pyramids.DatasetPool(size=2)
+        dataset1 = self.borrow(pool, 'a.tif')
+        dataset2 = self.borrow(pool, 'a.tif')
+        self.assertIs(dataset1, dataset2)
+        self.assertEquals(patched_open.call_count, 1)
+
+    @mock.patch('gislib.pyramids.gdal.Open', side_effect=lambda p: object())
+    def test_changed_file_is_reopened(self, patched_open):
+        pool = pyramids.DatasetPool(size=2)
+        dataset1 = self.borrow(pool, 'a.tif', mtime=1)
+        dataset2 = self.borrow(pool, 'a.tif', mtime=2)
+        self.assertIsNot(dataset1, dataset2)
+        self.assertEquals(pool.count, 1)
+
+    @mock.patch('gislib.pyramids.gdal.Open', side_effect=lambda p: object())
+    def test_size_is_bounded(self, patched_open):
+        pool = pyramids.DatasetPool(size=2)
+        for path in ('a.tif', 'b.tif', 'c.tif'):
+            self.borrow(pool, path)
+        self.assertEquals(pool.count, 2)
+        self.assertEquals(list(pool.idle), ['b.tif', 'c.tif'])
+
+    def test_one_pool_for_all_levels(self):
+        self.assertIs(pyramids.get_pool(), pyramids.get_pool())
+
+    def test_missing_file_raises_runtimeerror(self):
+        pool = pyramids.DatasetPool()
+        with mock.patch('os.stat', side_effect=OSError('missing')):
+            self.assertRaises(
+                RuntimeError, lambda: pool.borrow('a.tif').__enter__())
+
+
+class TestFetchPoints(TestCase):
+    def setUp(self):
+        self.grid = pyramids.Grid(
+            cell_size=(2, 2),
+            raster_size=(4, 4),
+            data_type=gdal_array.flip_type_code(np.int32),
+            no_data_value=-999,
+            path='',
+        )
+        array = np.arange(16, dtype=np.int32).reshape(4, 4)
+        array[3, 3] = -999
+        self.dataset = gdal_array.OpenArray(array)
+        self.dataset.SetGeoTransform([0, 2, 0, 8, 0, -2])
+
+    def fetch_points(self, xs, ys):
+        pool = pyramids.DatasetPool()
+        pool.borrow = mock.MagicMock()
+        pool.borrow.return_value.__enter__.return_value = self.dataset
+        with mock.patch('gislib.pyramids.get_pool', return_value=pool):
+            return self.grid.fetch_points(xs, ys), pool
+
+    def test_values_from_one_tile(self):
+        values, pool = self.fetch_points([1, 7, 3], [7, 1, 5])
+        self.assertEquals(values.tolist(), [0, None, 5])
+        self.assertEquals(pool.borrow.call_count, 1)
+
+    def test_opens_every_tile_once(self):
+        values, pool = self.fetch_points([1, 9, 3, 11], [7, 7, 5, 5])
+        self.assertEquals(pool.borrow.call_count, 2)
+
+    def test_no_points(self):
+        values, pool = self.fetch_points([], [])
+        self.assertEquals(values.tolist(), [])
+
+
+class FakeTile(object):
+    RasterXSize = 1024
+    RasterYSize = 1024
+
+    def GetRasterBand(self, i):
+        band = mock.Mock()
+        band.GetBlockSize.return_value = [256, 256]
+        return band
+
+
+class TestGetWindow(TestCase):
+    def test_single_block(self):
+        self.assertEquals(
+            pyramids.get_window(FakeTile(), [(0, -1)]),
+            (0, 0, 256, 256))
+
+    def test_spans_blocks(self):
+        self.assertEquals(
+            pyramids.get_window(FakeTile(), [(1, -2), (2, -2), (1, -3)]),
+            (256, 256, 768, 768))
+
+
+class TestGetChildren(TestCase):
+    def test_quadrants(self):
+        manager = manager_factory()
+        manager.__dict__.update(
+            block_size=(256, 256), data_type=6, no_data_value=-999,
+            projection='', raster_count=1, raster_size=(1024, 1024))
+        manager.path = 'pyramid'
+        children = manager.get_children(5, (3, 7))
+        self.assertEquals(children[0, 0], 'pyramid/4/6/15.tif')
+        self.assertEquals(children[1, 0], 'pyramid/4/7/15.tif')
+        self.assertEquals(children[0, 1], 'pyramid/4/6/14.tif')
+        self.assertEquals(children[1, 1], 'pyramid/4/7/14.tif')
+
+
+class TestWarpChildren(TestCase):
+    @mock.patch('gislib.pyramids.warp_tile')
+    @mock.patch('gislib.pyramids.get_source', side_effect=lambda d: d)
+    def test_children_are_warped_one_by_one(self, get_source, warp_tile):
+        def borrow(path):
+            context = mock.MagicMock()
+            context.__enter__.return_value = path
+            return context
+
+        pool = mock.Mock()
+        pool.borrow.side_effect = borrow
+        with mock.patch('gislib.pyramids.get_pool', return_value=pool):
+            pyramids.warp_children((
+                'p/5/3/7.tif', [('p/4/6/15.tif', [(0, -1)]),
+                                ('p/4/7/15.tif', [(1, -1)])]))
+        self.assertEquals(warp_tile.call_args_list, [
+            mock.call(('p/5/3/7.tif', [(0, -1)], 'p/4/6/15.tif')),
+            mock.call(('p/5/3/7.tif', [(1, -1)], 'p/4/7/15.tif'))])
+
+
+class TestGetBlocks(TestCase):
+    def test_all_blocks_span_tile(self):
+        grid = pyramids.Grid(cell_size=(1, 1),
+                             raster_size=(1024, 1024),
+                             block_size=(256, 256))
+        blocks = grid.get_blocks()
+        self.assertEquals(len(blocks), 16)
+        self.assertEquals(
+            pyramids.get_window(FakeTile(), blocks), (0, 0, 1024, 1024))
+
+
+class TestGridRead(TestCase):
+    def setUp(self):
+        self.grid = pyramids.Grid(
+            cell_size=(1, 1),
+            raster_size=(4, 4),
+            data_type=gdal_array.flip_type_code(np.int32),
+            no_data_value=-999,
+            path='grid',
+        )
+        self.arrays = {
+            'grid/0/0.tif': np.arange(16, dtype=np.int32).reshape(4, 4),
+            'grid/1/0.tif': np.arange(100, 116, dtype=np.int32).reshape(4, 4),
+        }
+
+    def read(self, extent, size):
+        def borrow(path):
+            if path not in self.arrays:
+                raise RuntimeError(path)
+            context = mock.MagicMock()
+            context.__enter__.return_value = gdal_array.OpenArray(
+                self.arrays[path])
+            return context
+
+        pool = mock.Mock()
+        pool.borrow.side_effect = borrow
+        with mock.patch('gislib.pyramids.get_pool', return_value=pool):
+            return self.grid.read(extent, size)
+
+    def test_unaligned_returns_none(self):
+        self.assertIsNone(self.read((0.5, 0, 4.5, 4), (4, 4)))
+
+    def test_spanning_tiles(self):
+        array = self.read((2, 0, 6, 4), (4, 4))
+        self.assertEquals(array.shape, (1, 4, 4))
+        self.assertEquals(array[0, 0].tolist(), [2, 3, 100, 101])
+        self.assertEquals(array[0, 3].tolist(), [14, 15, 112, 113])
+
+    def test_missing_tile_is_no_data(self):
+        array = self.read((6, 0, 10, 4), (4, 4))
+        self.assertEquals(array[0, 0].tolist(), [102, 103, -999, -999])
+
+
+def get_dataset(array, origin):
+    """ Return float32 dataset in RD with 1 m pixels for array. """
+    height, width = array.shape
+    dataset = gdal.GetDriverByName(b'mem').Create(
+        b'', width, height, 1, gdal.GDT_Float32)
+    dataset.SetProjection(projections.get_wkt(projections.RD))
+    dataset.SetGeoTransform((origin[0], 1, 0, origin[1], 0, -1))
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(-9999)
+    band.WriteArray(array)
+    return dataset
+
+
+def read_level(path, level):
+    """ Return dictionary of tile arrays of a level by tile path. """
+    paths = glob.glob(os.path.join(path, str(level), '*', '*.tif'))
+    return {os.path.relpath(p, path): gdal.Open(p).ReadAsArray()
+            for p in paths}
+
+
+class PyramidTestCase(TestCase):
+    """ Pyramids with tiles of 32 by 32 pixels in a temporary directory. """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def add(self, name, dataset):
+        path = os.path.join(self.tmp_dir, name)
+        pyramids.Pyramid(path).add(
+            dataset, raster_size=(32, 32), block_size=(16, 16))
+        return path
+
+
+class TestBuild(PyramidTestCase):
+    def setUp(self):
+        super(TestBuild, self).setUp()
+        # Values are constant per 8 by 8 pixels, so that decimation and
+        # nearest neighbour warping agree up to 8 m cells. The origin is
+        # not on a tile corner, so edge tiles are partially filled, and
+        # the north west corner has no data.
+        rows, columns = np.indices((80, 96))
+        array = (columns // 8 * 100 + rows // 8 + 1).astype(np.float32)
+        array[:24, :40] = -9999
+        self.dataset = get_dataset(array, origin=(121008, 487072))
+
+    def test_decimated_levels_match_warped_levels(self):
+        decimated = self.add('decimated', self.dataset)
+        with mock.patch.object(pyramids.Manager, 'can_decimate',
+                               return_value=False):
+            warped = self.add('warped', self.dataset)
+
+        levels = pyramids.Manager(decimated).levels
+        self.assertEquals(levels, [0, 1, 2])
+        self.assertEquals(pyramids.Manager(warped).levels, levels)
+        for level in levels[1:]:
+            expected = read_level(warped, level)
+            actual = read_level(decimated, level)
+            self.assertEquals(sorted(actual), sorted(expected))
+            for name in expected:
+                np.testing.assert_array_equal(actual[name], expected[name])
+
+        # The top level has tiles with data and no data alike
+        top = read_level(decimated, levels[-1])
+        self.assertTrue(any((a == -9999).any() and (a != -9999).any()
+                            for a in top.values()))
+
+    def test_every_tile_is_written_once_per_level(self):
+        decimate_tile = mock.Mock(side_effect=pyramids.decimate_tile)
+        warp_tile = mock.Mock(side_effect=pyramids.warp_tile)
+        with mock.patch('gislib.pyramids.decimate_tile', decimate_tile):
+            with mock.patch('gislib.pyramids.warp_tile', warp_tile):
+                path = self.add('pyramid', self.dataset)
+
+        written = [c[0][0][0] for c in warp_tile.call_args_list +
+                   decimate_tile.call_args_list]
+        self.assertEquals(len(written), len(set(written)))
+        self.assertEquals(len(written),
+                          len(glob.glob(os.path.join(path, '*', '*', '*'))))
+
+
+class TestExtend(PyramidTestCase):
+    """
+    A small dataset gives a pyramid of one level, a larger dataset next
+    to it makes Manager.add extend that pyramid before building it.
+    """
+    def setUp(self):
+        super(TestExtend, self).setUp()
+        self.small = get_dataset(
+            np.ones((16, 16), dtype=np.float32), origin=(121008, 487072))
+        self.large = get_dataset(
+            2 * np.ones((64, 64), dtype=np.float32), origin=(121024, 487072))
+
+    def assert_extends(self, function):
+        path = self.add('pyramid', self.small)
+        manager = pyramids.Manager(path)
+        self.assertEquals(manager.levels, [0])
+
+        spy = mock.Mock(side_effect=getattr(pyramids, function))
+        with mock.patch('gislib.pyramids.' + function, spy):
+            manager.extend(2)
+        self.assertEquals(manager.levels, [0, 1, 2])
+
+        # Every tile of the new levels is written by exactly one job
+        written = [c[0][0][0] for c in spy.call_args_list]
+        self.assertEquals(len(written), len(set(written)))
+        self.assertEquals(
+            sorted(written),
+            sorted(glob.glob(os.path.join(path, '[12]', '*', '*.tif'))))
+        for level in (1, 2):
+            for array in read_level(path, level).values():
+                self.assertIn(1, array)
+
+        # The large dataset ends up next to the small one on top
+        manager.build(self.large)
+        top = np.concatenate([a.ravel()
+                              for a in read_level(path, 2).values()])
+        self.assertIn(1, top)
+        self.assertIn(2, top)
+
+    def test_extend_decimates(self):
+        self.assert_extends('decimate_tile')
+
+    def test_extend_warps_children_without_decimation(self):
+        with mock.patch.object(pyramids.Manager, 'can_decimate',
+                               return_value=False):
+            self.assert_extends('warp_children')
+
+    def test_add_extends_pyramid(self):
+        path = self.add('pyramid', self.small)
+        self.add('pyramid', self.large)
+        self.assertEquals(pyramids.Manager(path).levels, [0, 1, 2])
+        for level in (1, 2):
+            values = np.concatenate(
+                [a.ravel() for a in read_level(path, level).values()])
+            self.assertIn(1, values)
+            self.assertIn(2, values)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+"""
+Cache for rendered responses.
+
+Entries live in a byte-bounded LRU in memory. When a directory is
+configured, entries evicted from or missing in memory can still be
+found on disk.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+
+import collections
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def get_digest(key):
+    """ Return hexdigest for a key tuple. """
+    return hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+
+
+class TileCache(object):
+    """
+    Byte-bounded LRU cache with an optional on-disk tier.
+
+    Keys are tuples whose first item is the tuple of layers and whose
+    second item is the tuple of versions of these layers. Since the
+    versions are part of the key, a changed pyramid never gets served
+    from stale entries; stale entries just age out of the LRU. Without
+    a path, any hashable key will do.
+    """
+    def __init__(self, max_bytes, path=None):
+        self.max_bytes = max_bytes
+        self.path = path
+
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get_path(self, key):
+        """ Return path on disk for key. """
+        layers, versions = key[:2]
+        return os.path.join(self.path,
+                            get_digest(layers),
+                            get_digest(versions),
+                            get_digest(key[2:]) + '.png')
+
+    def _read(self, key):
+        """ Return content from disk or None. """
+        try:
+            with open(self._get_path(key), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _write(self, key, content):
+        """
+        Write content to disk.
+
+        When the version directory is new, directories of other
+        versions of the same layers are removed.
+        """
+        path = self._get_path(key)
+        version_dir = os.path.dirname(path)
+        if not os.path.exists(version_dir):
+            layers_dir = os.path.dirname(version_dir)
+            try:
+                names = os.listdir(layers_dir)
+            except OSError:
+                names = []
+            for name in names:
+                shutil.rmtree(os.path.join(layers_dir, name),
+                              ignore_errors=True)
+            try:
+                os.makedirs(version_dir)
+            except OSError:
+                pass  # another worker created it
+
+        # Write to a temporary file first, so that concurrent readers
+        # never see partial content.
+        fd, tmp = tempfile.mkstemp(dir=version_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.rename(tmp, path)
+
+    def _store(self, key, content):
+        """ Put content in memory, evicting as needed. Not locked. """
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        if len(content) > self.max_bytes:
+            return
+        self.entries[key] = content
+        self.size += len(content)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def get(self, key):
+        """ Return cached content or None. """
+        with self.lock:
+            try:
+                content = self.entries.pop(key)
+            except KeyError:
+                content = None
+            else:
+                self.entries[key] = content  # mark as recently used
+                self.hits += 1
+                return content
+
+        if self.path is not None:
+            content = self._read(key)
+
+        with self.lock:
+            if content is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+                self._store(key, content)
+        return content
+
+    def set(self, key, content):
+        """ Store content for key. """
+        with self.lock:
+            self._store(key, content)
+        if self.path is not None:
+            try:
+                self._write(key, content)
+            except (IOError, OSError) as e:
+                logger.warning('Could not write tile to disk: {}'.format(e))
+
+    def clear(self):
+        """ Remove all entries from memory. """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    @property
+    def stats(self):
+        """ Return dictionary with counters. """
+        with self.lock:
+            return dict(
+                entries=len(self.entries),
+                size=self.size,
+                max_size=self.max_bytes,
+                hits=self.hits,
+                disk_hits=self.disk_hits,
+                misses=self.misses,
+                evictions=self.evictions,
+            )
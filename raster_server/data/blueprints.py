@@ -6,7 +6,10 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 from __future__ import division
 
-from flask import jsonify, request, abort
+import csv
+import io
+
+from flask import jsonify, request, abort, Response
 
 from raster_server import blueprints
 
@@ -38,3 +41,33 @@ def rasterprofile():
     wktline = request.values['geom']
     profile = responses.get_profile(wktline, src_srs)
     return jsonify(profile=profile)
+
+
+@rasterapp.route('/points', methods=['GET', 'POST'])
+def rasterpoints():
+    """
+    Return json or csv with [x, y, raster value] for many points at once.
+
+    The geometry must be a POINT or MULTIPOINT, otherwise the response is
+    a 400.
+
+    Example:
+    ``http://127.0.0.1:5000/profile/points?layer=a:b&srs=EPSG:28992&geom=MULTIPOINT(155000 463000,155100 463000)&format=csv``
+    """
+    if not {'layer', 'srs', 'geom'}.issubset(request.values):
+        abort(400)
+    try:
+        points = responses.get_points(layer=request.values['layer'],
+                                      wktpoints=request.values['geom'],
+                                      src_srs=request.values['srs'])
+    except ValueError:
+        abort(400)
+    if request.values.get('format', 'json').lower() != 'csv':
+        return jsonify(points=points)
+
+    buf = io.BytesIO()
+    writer = csv.writer(buf)
+    writer.writerow([b'x', b'y', b'value'])
+    writer.writerows(
+        ['' if v is None else repr(v) for v in p] for p in points)
+    return Response(buf.getvalue(), mimetype='text/csv')
@@ -9,6 +9,7 @@ from __future__ import division
 import math
 
 from osgeo import gdal
+from osgeo import ogr
 from osgeo.gdalconst import GDT_Float32
 from shapely import wkt
 import numpy as np
@@ -17,6 +18,7 @@ from gislib import rasters
 from gislib import vectors
 from gislib import projections
 
+from raster_server import utils
 from raster_server.data import config
 
 
@@ -94,3 +96,45 @@ def get_profile(wktline, src_srs=900913, rastersize=512):
     mem_ds = None
 
     return profile_data
+
+
+def get_points(layer, wktpoints, src_srs):
+    """
+    Return list of [x, y, value] for the points of a point or multipoint.
+
+    :param layer: raster server layer name
+    :param wktpoints: WKT point or multipoint for which values should be
+        sampled
+    :param src_srs: spatial reference system of the points
+
+    Values are None where the pyramid has no data. Raises ValueError if
+    wktpoints can not be parsed or is not a point or multipoint.
+    """
+    try:
+        geometry = ogr.CreateGeometryFromWkt(wktpoints)
+    except RuntimeError:
+        geometry = None
+    if geometry is None:
+        raise ValueError('Invalid WKT geometry: {}'.format(wktpoints))
+
+    geometry_type = ogr.GT_Flatten(geometry.GetGeometryType())
+    if geometry_type == ogr.wkbPoint:
+        points = [] if geometry.IsEmpty() else [geometry.GetPoint_2D()]
+    elif geometry_type == ogr.wkbMultiPoint:
+        points = [geometry.GetGeometryRef(i).GetPoint_2D()
+                  for i in range(geometry.GetGeometryCount())]
+    else:
+        raise ValueError('Geometry should be a point or multipoint, not {}'
+                         .format(geometry.GetGeometryName()))
+    if not points:
+        return []
+
+    pyramid = utils.get_pyramid(layer)
+    transformation = projections.get_coordinate_transformation(
+        src_srs, pyramid.projection,
+    )
+    transformed = np.array(transformation.TransformPoints(points))
+    values = pyramid.fetch_points(transformed[:, 0], transformed[:, 1])
+
+    return [[x, y, value]
+            for (x, y), value in zip(points, values.tolist())]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+
+import argparse
+import logging
+import sys
+
+from gislib import projections
+from gislib.utils import get_transformed_extent
+
+from raster_server import tiles
+from raster_server import utils
+from raster_server.wms import responses
+
+description = """
+Pre-render google mercator png tiles for a layer, so that they can be
+served as static files by the wms and the tiles endpoints.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def get_parser():
+    """ Return argument parser. """
+    parser = argparse.ArgumentParser(
+        description=description
+    )
+    parser.add_argument('layer', metavar='LAYER')
+    parser.add_argument('-s', '--style', default='')
+    parser.add_argument('-z', '--zoom',
+                        nargs=2,
+                        type=int,
+                        default=(8, 13),
+                        metavar=('MIN', 'MAX'))
+    return parser
+
+
+def seed(layer, style, zoom):
+    """ Render and store tiles for a zoom range, including both ends. """
+    pyramid = utils.get_pyramid(layer)
+    extent = pyramid.data_extent
+    if extent is None:
+        logger.warning('Layer {} has no data, skipping.'.format(layer))
+        return
+    extent = get_transformed_extent(
+        extent, pyramid.projection, projections.GOOGLE,
+    )
+
+    first, last = zoom
+    for level in range(first, last + 1):
+        count = 0
+        for x, y in tiles.get_tiles(extent, level):
+            content, timings = responses.render_getmap(
+                tiles.get_parameters(layer, style, level, x, y),
+            )
+            tiles.write(layer, style, level, x, y, content)
+            count += 1
+        logger.debug('Zoom {}: {} tiles.'.format(level, count))
+
+
+def main():
+    """ Call command with args from parser. """
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+    seed(**vars(get_parser().parse_args()))
@@ -43,6 +43,23 @@ FLOODING_SHARE = SETTINGS_FROM_FILE.get(
 FLOODING_LIB_COLORMAP_DIR = os.path.join(
     FLOODING_SHARE, 'colormaps')
 
+# Cache for rendered GetMap responses. The size is in bytes, set the
+# directory to also keep rendered images on disk.
+TILE_CACHE_SIZE = SETTINGS_FROM_FILE.get(
+    'tile_cache_size', 64 * 1024 * 1024)
+TILE_CACHE_DIR = SETTINGS_FROM_FILE.get('tile_cache_dir')
+
+# Zlib compression level of png images, 1 is fastest, 9 is smallest
+PNG_COMPRESS_LEVEL = SETTINGS_FROM_FILE.get('png_compress_level', 1)
+
+# Maximum number of layers of a single request fetched concurrently
+FETCH_THREADS = SETTINGS_FROM_FILE.get('fetch_threads', 4)
+
+# Pre-rendered google mercator tiles, see raster_server.seed
+TILE_DIR = SETTINGS_FROM_FILE.get(
+    'tile_dir',
+    os.path.join(BUILDOUT_DIR, 'var', 'tiles'))
+
 # Import local settings
 try:
     from raster_server.localsettings import *
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+
+import json
+import os
+import tempfile
+
+# The raster server settings need a flooding share
+if not os.environ.get('RASTER_SERVER_SETTINGS'):
+    fd, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'flooding_share': tempfile.gettempdir()}, f)
+    os.environ['RASTER_SERVER_SETTINGS'] = path
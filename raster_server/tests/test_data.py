@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+
+from unittest import TestCase
+
+import flask
+import mock
+import numpy as np
+
+from gislib import projections
+
+from raster_server.data import blueprints
+from raster_server.data import responses
+
+
+def get_pyramid():
+    """ Return mock pyramid with value 1 for every point. """
+    pyramid = mock.MagicMock()
+    pyramid.projection = projections.get_wkt(projections.RD)
+    pyramid.fetch_points.side_effect = lambda x, y: np.ones(len(x))
+    return pyramid
+
+
+class TestGetPoints(TestCase):
+    def setUp(self):
+        patcher = mock.patch('raster_server.utils.get_pyramid',
+                             return_value=get_pyramid())
+        self.pyramid = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_multipoint(self):
+        points = responses.get_points(
+            'layer', 'MULTIPOINT(155000 463000,155100 463000)', 'EPSG:28992')
+        self.assertEquals(points, [[155000, 463000, 1],
+                                   [155100, 463000, 1]])
+
+    def test_point(self):
+        points = responses.get_points(
+            'layer', 'POINT(155000 463000)', 'EPSG:28992')
+        self.assertEquals(points, [[155000, 463000, 1]])
+
+    def test_invalid_wkt(self):
+        self.assertRaises(ValueError, responses.get_points,
+                          'layer', 'POINT(155000', 'EPSG:28992')
+
+    def test_other_geometry(self):
+        self.assertRaises(
+            ValueError, responses.get_points, 'layer',
+            'LINESTRING(155000 463000,155100 463000)', 'EPSG:28992')
+
+
+class TestPointsView(TestCase):
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.register_blueprint(blueprints.rasterapp, url_prefix='/profile')
+        self.client = app.test_client()
+
+        patcher = mock.patch('raster_server.utils.get_pyramid',
+                             return_value=get_pyramid())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, geom):
+        return self.client.get('/profile/points', query_string={
+            'layer': 'layer', 'srs': 'EPSG:28992', 'geom': geom})
+
+    def test_point(self):
+        self.assertEquals(self.get('POINT(155000 463000)').status_code, 200)
+
+    def test_invalid_wkt(self):
+        self.assertEquals(self.get('MULTIPOINT(155000').status_code, 400)
+
+    def test_other_geometry(self):
+        response = self.get('POLYGON((0 0,1 0,1 1,0 0))')
+        self.assertEquals(response.status_code, 400)
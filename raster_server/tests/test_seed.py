@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from osgeo import gdal
+import mock
+import numpy as np
+
+from gislib import projections
+from gislib import pyramids
+
+from raster_server import seed
+from raster_server import tiles
+
+
+def get_dataset():
+    """ Return float32 dataset of 64 by 64 m in RD. """
+    dataset = gdal.GetDriverByName(b'mem').Create(
+        b'', 64, 64, 1, gdal.GDT_Float32)
+    dataset.SetProjection(projections.get_wkt(projections.RD))
+    dataset.SetGeoTransform((121000, 1, 0, 487064, 0, -1))
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(-9999)
+    band.WriteArray(np.ones((64, 64), dtype=np.float32))
+    return dataset
+
+
+class TestSeed(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pyramid = pyramids.Pyramid(os.path.join(self.tmp_dir, 'layer'))
+        self.pyramid.add(
+            get_dataset(), raster_size=(256, 256), block_size=(256, 256))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_seeds_pyramid_written_by_manager(self):
+        with mock.patch('raster_server.utils.get_pyramid',
+                        return_value=self.pyramid):
+            with mock.patch('raster_server.seed.responses.render_getmap',
+                            return_value=(b'png', {})):
+                with mock.patch('raster_server.seed.tiles.write') as write:
+                    seed.seed('layer', '', (14, 15))
+
+        written = [c[0][2:5] for c in write.call_args_list]
+        self.assertTrue(written)
+        self.assertEquals(set(zoom for zoom, x, y in written), {14, 15})
+
+        # The tile of the center of the data is among them
+        x1, y1, x2, y2 = seed.get_transformed_extent(
+            (121030, 487030, 121034, 487034),
+            projections.RD, projections.GOOGLE)
+        self.assertIn((15, ) + next(tiles.get_tiles((x1, y1, x2, y2), 15)),
+                      written)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+"""
+Google Mercator tile matrix and storage of pre-rendered tiles.
+
+Tiles are numbered the XYZ way: the origin is in the top left corner
+and y increases southwards. The same numbering is used for the WMTS
+GoogleMapsCompatible matrix set, with TileCol as x and TileRow as y.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+
+import math
+import os
+import tempfile
+
+from raster_server import settings
+from raster_server import utils
+
+ORIGIN = 20037508.342789244  # Half the width of the mercator world
+SIZE = 256  # Pixels per tile
+TOLERANCE = 1e-3  # Fraction of a pixel
+MERCATOR = ('epsg:3857', 'epsg:900913')
+
+
+def get_span(zoom):
+    """ Return width of a tile in meters. """
+    return 2 * ORIGIN / 2 ** zoom
+
+
+def tile2bbox(zoom, x, y):
+    """ Return bbox tuple for a tile. """
+    span = get_span(zoom)
+    return (x * span - ORIGIN,
+            ORIGIN - (y + 1) * span,
+            (x + 1) * span - ORIGIN,
+            ORIGIN - y * span)
+
+
+def bbox2tile(bbox, width, height):
+    """
+    Return (zoom, x, y) tuple or None.
+
+    Only requests that coincide with a tile of the matrix, within the
+    tolerance, can be served from pre-rendered tiles.
+    """
+    if (width, height) != (SIZE, SIZE):
+        return None
+    x1, y1, x2, y2 = bbox
+    if x2 <= x1:
+        return None
+    zoom = int(round(math.log(2 * ORIGIN / (x2 - x1), 2)))
+    if zoom < 0:
+        return None
+    span = get_span(zoom)
+    x = int(round((x1 + ORIGIN) / span))
+    y = int(round((ORIGIN - y2) / span))
+    tolerance = TOLERANCE * span / SIZE
+    if any(abs(a - b) > tolerance
+           for a, b in zip(bbox, tile2bbox(zoom, x, y))):
+        return None
+    return zoom, x, y
+
+
+def get_tiles(extent, zoom):
+    """ Return generator of (x, y) for tiles intersecting extent. """
+    span = get_span(zoom)
+    last = 2 ** zoom - 1
+    x1, y1, x2, y2 = extent
+    xs = xrange(max(0, int(math.floor((x1 + ORIGIN) / span))),
+                min(last, int(math.floor((x2 + ORIGIN) / span))) + 1)
+    ys = xrange(max(0, int(math.floor((ORIGIN - y2) / span))),
+                min(last, int(math.floor((ORIGIN - y1) / span))) + 1)
+    for y in ys:
+        for x in xs:
+            yield x, y
+
+
+def get_parameters(layer, style, zoom, x, y):
+    """ Return wms getmap parameters for a tile. """
+    return dict(
+        layers=layer,
+        styles=style,
+        bbox=','.join(map(repr, tile2bbox(zoom, x, y))),
+        width=SIZE,
+        height=SIZE,
+        srs=MERCATOR[0],
+    )
+
+
+def get_path(layer, style, zoom, x, y):
+    """ Return path for a pre-rendered tile, or None if not allowed. """
+    parts = layer.split(':') + [style or 'default']
+    if any(p in ('', '.', '..') or os.sep in p for p in parts):
+        return None
+    return os.path.join(settings.TILE_DIR, *(
+        parts + [str(zoom), str(x), '{}.png'.format(y)]
+    ))
+
+
+def read(layer, style, zoom, x, y):
+    """
+    Return content of pre-rendered tile or None.
+
+    Tiles older than the pyramid of the layer are ignored, as are all
+    tiles of a layer without a pyramid.
+    """
+    path = get_path(layer, style, zoom, x, y)
+    if path is None:
+        return None
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    version = utils.get_version(layer)
+    if version is None or mtime < version:
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def write(layer, style, zoom, x, y, content):
+    """ Store content as pre-rendered tile. """
+    path = get_path(layer, style, zoom, x, y)
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        pass  # directory already exists
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+    os.rename(tmp, path)
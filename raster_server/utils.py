@@ -67,6 +67,27 @@ def get_pyramid(layer):
         return pyramid
 
 
+def get_version(layer):
+    """
+    Return a stamp that changes whenever the pyramid of a layer changes.
+
+    Based on the modification times of '.pyramid.tif', which is touched
+    by every sync of the pyramid, and of the level directories. None if
+    the pyramid does not exist or is empty.
+    """
+    path = get_pyramid(layer).path
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return None
+    mtimes = [os.path.getmtime(os.path.join(path, name))
+              for name in names
+              if name == '.pyramid.tif' or not name.startswith('.')]
+    if not mtimes:
+        return None
+    return max(mtimes)
+
+
 def get_leafno(geometry):
     """ Return leafno based on geometry. """
     index = ogr.Open(os.path.join(settings.DATA_DIR, 'index'))
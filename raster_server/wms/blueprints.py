@@ -11,6 +11,7 @@ from matplotlib import cm
 
 from raster_server import blueprints
 from raster_server import colors
+from raster_server import tiles
 from raster_server import utils
 
 from raster_server.wms import responses
@@ -44,10 +45,33 @@ def wms():
         getlimits=responses.get_response_for_getlimits,
         getfeatureinfo=responses.get_response_for_getfeatureinfo,
         getcapabilities=responses.get_response_for_getcapabilities,
+        gettile=responses.get_response_for_gettile,
     )
     return request_handlers[request](get_parameters=get_parameters)
 
 
+@blueprint.route('/tiles/<layer>/<int:zoom>/<int:x>/<int:y>.png')
+def tile(layer, zoom, x, y):
+    """ Return png image for an XYZ tile in google mercator. """
+    get_parameters = utils.get_parameters()
+    tile_parameters = tiles.get_parameters(
+        layer=layer,
+        style=get_parameters.get('styles', ''),
+        zoom=zoom,
+        x=x,
+        y=y,
+    )
+    if 'effects' in get_parameters:
+        tile_parameters.update(effects=get_parameters['effects'])
+    return responses.get_response_for_getmap(tile_parameters)
+
+
+@blueprint.route('/cache')
+def cache():
+    """ Return tile cache counters. """
+    return responses.jsonify(responses.tile_cache.stats)
+
+
 @blueprint.route('/demo')
 def demo():
     layers = sorted(utils.get_layers())
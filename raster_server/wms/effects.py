@@ -14,12 +14,11 @@ from __future__ import division
 
 import re
 
-from matplotlib import cm
-from matplotlib import colors
-from PIL import Image
 from scipy import ndimage
 import numpy as np
 
+from flooding_lib.util.colormap import get_lut
+
 
 WKT = re.compile('POLYGON \(\((?P<x1>[^\ ]+) [^,]+,(?P<x2>[^ ]+)')
 SHADE = np.array([[0,  1,  1,  1,  0],
@@ -30,7 +29,7 @@ SHADE = np.array([[0,  1,  1,  1,  0],
 
 
 def shade(args, data, geometry, **kwargs):
-    """ Return PIL image. """
+    """ Return uint8 rgba array. """
     # Determine index, strength from effect
     index = int(args[0])
     strength = float(args[1])
@@ -39,14 +38,11 @@ def shade(args, data, geometry, **kwargs):
     w, h = geometry['size']
     magnitude = w / (x2 - x1)
     # Perform the shade
-    colormap = cm.get_cmap('shade')
-    normalize = colors.Normalize(vmin=-1, vmax=1)
     shade = np.ma.array(
         magnitude * strength * ndimage.convolve(data[index].data, SHADE),
         mask=data[index].mask,
     )
-    rgba = colormap(normalize(shade), bytes=True)
-    return Image.fromarray(rgba)
+    return get_lut('shade').apply(shade, vmin=-1, vmax=1)
 
 
 def drought(args, data, **kwargs):
@@ -57,7 +53,4 @@ def drought(args, data, **kwargs):
     # Subtract data from level
     depth = data[index] - level
     # Colorize
-    colormap = cm.get_cmap('drought')
-    normalize = colors.Normalize(vmin=0.1, vmax=1.5)
-    rgba = colormap(normalize(depth), bytes=True)
-    return Image.fromarray(rgba)
+    return get_lut('drought').apply(depth, vmin=0.1, vmax=1.5)
@@ -8,6 +8,9 @@ from __future__ import division
 
 import io
 import json
+import time
+
+from multiprocessing.pool import ThreadPool
 
 from matplotlib import cm
 from matplotlib import colors
@@ -19,9 +22,12 @@ from gislib import projections
 from gislib import statistics
 from gislib.utils import get_transformed_extent
 
+from flooding_lib.util.colormap import get_lut
 from flooding_lib.util.colormap import get_mpl_cmap
 
+from raster_server import cache
 from raster_server import settings
+from raster_server import tiles
 from raster_server import utils
 from raster_server.wms import effects
 
@@ -116,14 +122,33 @@ CAPABILITIES = ('epsg:3857',
                 'epsg:4326',
                 'epsg:28992')
 
+tile_cache = cache.TileCache(max_bytes=settings.TILE_CACHE_SIZE,
+                             path=settings.TILE_CACHE_DIR)
+fetchers = ThreadPool(settings.FETCH_THREADS)
+
 
-def jsonify(content):
+def jsonify(content, timings=None):
     """ Return flask response tuple for json with some headers. """
-    return json.dumps(content), 200, {
+    headers = {
         'content-type': 'application/json',
         'Access-Control-Allow-Origin': '*',
         'Access-Control-Allow-Methods': 'GET'
     }
+    if timings:
+        headers.update(get_timing_header(timings))
+    return json.dumps(content), 200, headers
+
+
+def get_timing_header(timings):
+    """
+    Return Server-Timing header dictionary.
+
+    Timings is a sequence of (layer, seconds) tuples.
+    """
+    return {'Server-Timing': ', '.join(
+        'layer{};dur={:.1f};desc="{}"'.format(i, 1000 * seconds, layer)
+        for i, (layer, seconds) in enumerate(timings)
+    )}
 
 
 def float_or_none(string):
@@ -136,19 +161,39 @@ def float_or_none(string):
 
 def merge(images):
     """
-    Return a pil image.
+    Return a uint8 rgba array.
 
-    Merge a list of pil images with equal sizes top down based on
-    the alpha channel.
+    Merge a list of uint8 rgba arrays with equal sizes top down based on
+    the alpha channel: every image is composited over the images after
+    it. Intermediate values are kept as uint16, which fits 255 * 255.
     """
-    def paste(image1, image2):
-        image = image2.copy()
-        mask = Image.fromarray(np.array(image1)[:, :, 3])
-        rgb = Image.fromarray(np.array(image1)[:, :, 0:3])
-        image.paste(rgb, None, mask)
-        return image
+    if len(images) == 1:
+        return images[0]
 
-    return reduce(paste, images)
+    result = np.array(images[-1], dtype=np.uint16)
+    for image in reversed(images[:-1]):
+        alpha = image[:, :, 3:].astype(np.uint16)
+        result *= 255 - alpha
+        result[:, :, :3] += image[:, :, :3] * alpha
+        result[:, :, 3:] += 255 * alpha
+        result += 127  # round, rather than truncate
+        result //= 255
+    return result.astype(np.uint8)
+
+
+def encode(rgba, format='image/png'):
+    """
+    Return png image data for a uint8 rgba array.
+
+    Format 'image/png8' yields a palette png, which is smaller and
+    faster to compress.
+    """
+    image = Image.fromarray(rgba)
+    if format.lower() == 'image/png8':
+        image = image.quantize(colors=256, method=2)  # fast octree, rgba
+    buf = io.BytesIO()
+    image.save(buf, 'png', compress_level=settings.PNG_COMPRESS_LEVEL)
+    return buf.getvalue()
 
 
 def get_geometry(bbox, width, height,
@@ -182,30 +227,106 @@ def get_data(layer, geometry):
     return pyramid.get_data(**geometry)[0]
 
 
+def get_data_for_layers(layers, geometry):
+    """
+    Return tuples of numpy arrays and of (layer, seconds) timings.
+
+    Multiple layers are fetched concurrently on a shared pool of
+    threads, gdal releases the gil while reading and warping.
+    """
+    def fetch(layer):
+        start = time.time()
+        data = get_data(layer, geometry)
+        return data, (layer, time.time() - start)
+
+    if len(layers) == 1:
+        results = [fetch(layers[0])]
+    else:
+        results = fetchers.map(fetch, layers)
+    return tuple(d for d, t in results), tuple(t for d, t in results)
+
+
 def get_image(data, style):
-    """ Return PIL image. """
+    """ Return uint8 rgba array. """
     parts = style.split(':')
-    colormap = get_mpl_cmap(
-        parts[0] if parts[0] else 'jet',
-        settings_module=settings)
-
-    if isinstance(colormap, colors.ListedColormap):
-        normalize = lambda x: x
-    if (isinstance(colormap, colors.LinearSegmentedColormap) and
-        hasattr(colormap, 'csv_max_value')):
-        normalize = lambda x: x / colormap.csv_max_value
-    else:
-        normalize = colors.Normalize(*map(float_or_none, parts[1:]), clip=True)
-    rgba = colormap(normalize(data), bytes=True)
-    return Image.fromarray(rgba)
+    lut = get_lut(parts[0] if parts[0] else 'jet', settings_module=settings)
+    if lut.csv_max_value is not None:
+        return lut.apply(data, vmin=0, vmax=lut.csv_max_value)
+    return lut.apply(data, *map(float_or_none, parts[1:3]))
+
+
+def get_tile_key(get_parameters):
+    """
+    Return key for the tile cache.
+
+    The versions of the layers are part of the key, so that changes to
+    the pyramids are picked up.
+    """
+    layers = tuple(get_parameters['layers'].split(','))
+    versions = tuple(utils.get_version(l) for l in layers)
+    return (
+        layers,
+        versions,
+        get_parameters['styles'],
+        get_parameters.get('effects', ''),
+        get_parameters['bbox'],
+        get_parameters['width'],
+        get_parameters['height'],
+        get_parameters.get('srs', get_parameters.get('crs')),
+        get_parameters.get('version', '1.1.1'),
+        get_parameters.get('format', 'image/png').lower(),
+    )
+
+
+def get_seeded_tile(get_parameters):
+    """
+    Return pre-rendered png image data or None.
+
+    Only single layer requests without effects, whose geometry matches
+    a tile of the google mercator tile matrix, can be pre-rendered.
+    """
+    if get_parameters.get('effects'):
+        return None
+    if get_parameters.get('format', 'image/png').lower() != 'image/png':
+        return None
+    layer = get_parameters['layers']
+    if ',' in layer:
+        return None
+    geometry = get_geometry(**get_parameters)
+    if (geometry['crs'] or '').lower() not in tiles.MERCATOR:
+        return None
+    extent = map(float, get_parameters['bbox'].split(','))
+    tile = tiles.bbox2tile(extent, *geometry['size'])
+    if tile is None:
+        return None
+    return tiles.read(layer, get_parameters['styles'], *tile)
 
 
 def get_response_for_getmap(get_parameters):
     """ Return png image. """
+    headers = {
+        'content-type': 'image/png',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET'
+    }
+    content = get_seeded_tile(get_parameters)
+    if content is None:
+        key = get_tile_key(get_parameters)
+        content = tile_cache.get(key)
+    if content is None:
+        content, timings = render_getmap(get_parameters)
+        tile_cache.set(key, content)
+        headers.update(get_timing_header(timings))
+
+    return content, 200, headers
+
+
+def render_getmap(get_parameters):
+    """ Return png image data and layer timings. """
     # Retrieve data
     geometry = get_geometry(**get_parameters)
     layers = get_parameters['layers'].split(',')
-    data = tuple(get_data(l, geometry) for l in layers)
+    data, timings = get_data_for_layers(layers, geometry)
 
     # Prepare images
     images = []
@@ -224,43 +345,56 @@ def get_response_for_getmap(get_parameters):
     images.extend([get_image(d, s) for d, s in zip(data, styles)])
 
     # Composite
-    buf = io.BytesIO()
-    merge(images).save(buf, 'png')
+    content = encode(merge(images),
+                     format=get_parameters.get('format', 'image/png'))
+    return content, timings
 
-    return buf.getvalue(), 200, {
-        'content-type': 'image/png',
-        'Access-Control-Allow-Origin': '*',
-        'Access-Control-Allow-Methods': 'GET'
-    }
+
+def get_response_for_gettile(get_parameters):
+    """
+    Return png image for a WMTS GetTile request.
+
+    Only the GoogleMapsCompatible tile matrix set is supported.
+    """
+    tile_parameters = tiles.get_parameters(
+        layer=get_parameters['layer'],
+        style=get_parameters.get('style', ''),
+        zoom=int(get_parameters['tilematrix'].split(':')[-1]),
+        x=int(get_parameters['tilecol']),
+        y=int(get_parameters['tilerow']),
+    )
+    if 'effects' in get_parameters:
+        tile_parameters.update(effects=get_parameters['effects'])
+    return get_response_for_getmap(tile_parameters)
 
 
 def get_response_for_getlimits(get_parameters):
     """ Return json with limits per layer. """
     geometry = get_geometry(**get_parameters)
     layers = get_parameters['layers'].split(',')
-    data = tuple(get_data(l, geometry) for l in layers)
+    data, timings = get_data_for_layers(layers, geometry)
     limits = [np.ma.array([d.min(),
                            d.max()]).tolist() for d in data]
-    return jsonify(limits)
+    return jsonify(limits, timings)
 
 
 def get_response_for_getcurves(get_parameters):
     """ Return json with curve coordinates. """
     geometry = get_geometry(**get_parameters)
     layers = get_parameters['layers'].split(',')
-    data = tuple(get_data(l, geometry) for l in layers)
+    data, timings = get_data_for_layers(layers, geometry)
     curves = tuple(map(
         lambda d: np.array(statistics.get_curve(d)).transpose().tolist(),
         data,
     ))
-    return jsonify(curves)
+    return jsonify(curves, timings)
 
 
 def get_response_for_getcounts(get_parameters):
     """ Return json with curve coordinates. """
     geometry = get_geometry(**get_parameters)
     layers = get_parameters['layers'].split(',')
-    data = tuple(get_data(l, geometry) for l in layers)
+    data, timings = get_data_for_layers(layers, geometry)
     bins = np.arange(0, 256)
     histograms = [np.histogram(d.compressed(), bins)[0] for d in data]
     nonzeros = [h.nonzero() for h in histograms]
@@ -288,7 +422,7 @@ def get_response_for_getcounts(get_parameters):
     for r, s in zip(result, rests):
         if s:
             r.append(dict(label='Overig', data=float(s), color='#ffffff'))
-    return jsonify(result)
+    return jsonify(result, timings)
 
 
 def get_response_for_getfeatureinfo(get_parameters):
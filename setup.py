@@ -89,5 +89,6 @@ setup(name='flooding',
       entry_points={
           'console_scripts': [
               'runflask=raster_server.server:run',
+              'seedtiles=raster_server.seed:main',
           ]},
       )